@@ -0,0 +1,56 @@
+"""Stream a skills/lessons catalog file to a running server's admin import endpoint.
+
+    python import_catalog.py catalog.ndjson --url http://localhost:8001 --token $ADMIN_TOKEN
+
+Files ending in .json are sent as a JSON array of records, anything else
+(including - for stdin) as NDJSON. The file is sent in chunks as it is read,
+so its size does not matter. Prints the server's report and exits non-zero
+if any record was rejected.
+"""
+import argparse
+import json
+import os
+import sys
+
+import httpx
+
+CHUNK_SIZE = 256 * 1024
+
+
+def read_chunks(path):
+    stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        while chunk := stream.read(CHUNK_SIZE):
+            yield chunk
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='catalog file (.json for a JSON array, otherwise NDJSON; - for stdin)')
+    parser.add_argument('--url', default=os.environ.get('SKILLTREE_URL', 'http://localhost:8001'))
+    parser.add_argument('--token', default=os.environ.get('SKILLTREE_TOKEN'), help='admin bearer token')
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for the import to finish')
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error('an admin token is required (--token or SKILLTREE_TOKEN)')
+
+    content_type = 'application/json' if args.path.endswith('.json') else 'application/x-ndjson'
+    response = httpx.post(
+        f"{args.url.rstrip('/')}/api/admin/import",
+        content=read_chunks(args.path),
+        headers={'Authorization': f'Bearer {args.token}', 'Content-Type': content_type},
+        timeout=args.timeout
+    )
+    if response.status_code != 200:
+        print(f'Import failed: {response.status_code} {response.text}', file=sys.stderr)
+        return 1
+    report = response.json()
+    print(json.dumps(report, indent=2))
+    return 0 if report['error_count'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
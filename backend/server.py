@@ -1,26 +1,280 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse, RedirectResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring, CursorType, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError
+from typing import List, Optional, Dict, Any, Union
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import httpx
+import hashlib
+import math
+import re
+import bisect
+from array import array
+import base64
+import functools
+import secrets
+import asyncio
+import contextlib
+import orjson
+import zlib
+from collections import OrderedDict, defaultdict
+from contextvars import ContextVar
+import time
+import sys
+import threading
+import numpy as np
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # optional, gzip is always available
+    zstandard = None
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ============= METRICS =============
+# prometheus_client metrics are plain in-process counters, cheap enough to
+# leave on in production. They are exposed in text format at /metrics.
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'])
+HTTP_REQUESTS_IN_PROGRESS = Gauge('http_requests_in_progress', 'HTTP requests currently being served', ['method'])
+MONGO_COMMANDS = Counter('mongo_commands_total', 'MongoDB commands', ['collection', 'command', 'outcome'])
+MONGO_COMMAND_DURATION = Histogram(
+    'mongo_command_duration_seconds', 'MongoDB command latency', ['collection', 'command'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+)
+LLM_REQUESTS = Counter('llm_requests_total', 'LLM calls', ['provider', 'model', 'outcome'])
+LLM_REQUEST_DURATION = Histogram(
+    'llm_request_duration_seconds', 'LLM call latency', ['provider', 'model'],
+    buckets=(.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+LLM_TOKENS = Counter('llm_tokens_estimated_total', 'Estimated LLM tokens (4 characters per token)', ['provider', 'model', 'direction'])
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups', ['cache', 'result'])
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+# ============= REQUEST CONTEXT =============
+# Set by RequestContextMiddleware for the lifetime of one HTTP request. Motor
+# copies contextvars into its executor threads, so command listeners see it too.
+request_context = ContextVar('request_context', default=None)
+
+MONGO_SLOW_QUERY_MS = float(os.environ.get('MONGO_SLOW_QUERY_MS', 100))
+# When set, exceeding a declared query budget raises instead of logging (for tests)
+MONGO_QUERY_BUDGET_STRICT = os.environ.get('MONGO_QUERY_BUDGET_STRICT', '').lower() in ('1', 'true', 'yes')
+
+class RequestContext:
+    def __init__(self, request_id: str, scope: Optional[dict] = None):
+        self.request_id = request_id
+        self.scope = scope or {}
+        self.query_count = 0
+        self.commands = []  # (command, collection) in issue order
+        self.loaders = {}
+
+    @property
+    def route(self) -> str:
+        return route_template(self.scope) if self.scope else ''
+
+    def loader(self, collection: str, key: str) -> 'DocumentLoader':
+        loader = self.loaders.get((collection, key))
+        if loader is None:
+            loader = self.loaders[(collection, key)] = DocumentLoader(collection, key)
+        return loader
+
+class DocumentLoader:
+    """Batches lookups by `key` issued in the same event-loop tick into one $in query.
+
+    Results, including misses, are memoized for the rest of the request, so
+    handlers must call `clear` after writing a document they will read again.
+    """
+    def __init__(self, collection: str, key: str):
+        self.collection = collection
+        self.key = key
+        self.results = {}  # value -> Future
+        self.pending = {}
+
+    def load(self, value: str) -> 'asyncio.Future':
+        future = self.results.get(value)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.results[value] = loop.create_future()
+            record_cache('loader', False)
+            if not self.pending:
+                loop.call_soon(self._dispatch)
+            self.pending[value] = future
+        else:
+            record_cache('loader', True)
+        return future
+
+    def clear(self, value: str):
+        self.results.pop(value, None)
+
+    def _dispatch(self):
+        batch, self.pending = self.pending, {}
+        asyncio.ensure_future(self._fetch(batch))
+
+    async def _fetch(self, batch: dict):
+        try:
+            if len(batch) == 1:
+                (value,) = batch
+                docs = await db[self.collection].find({self.key: value}, {'_id': 0}).to_list(None)
+            else:
+                docs = await db[self.collection].find({self.key: {'$in': list(batch)}}, {'_id': 0}).to_list(None)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        found = {doc[self.key]: doc for doc in docs}
+        for value, future in batch.items():
+            if not future.done():
+                future.set_result(found.get(value))
+
+async def load_one(collection: str, value: str, key: str = 'id') -> Optional[dict]:
+    """find_one by a unique field, batched and memoized within the current request"""
+    ctx = request_context.get()
+    if ctx is None:
+        return await db[collection].find_one({key: value}, {'_id': 0})
+    return await ctx.loader(collection, key).load(value)
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+def query_budget(max_queries: int):
+    """Declare how many Mongo commands one call of a route handler may issue"""
+    def decorator(endpoint):
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorator
+
+def check_query_budget(ctx: RequestContext):
+    budget = getattr(ctx.scope.get('endpoint'), 'query_budget', None)
+    if budget is None or ctx.query_count <= budget:
+        return
+    message = (
+        f"{ctx.route} issued {ctx.query_count} Mongo commands, budget is {budget}: "
+        + ', '.join(f'{command}:{collection}' for command, collection in ctx.commands)
+    )
+    if MONGO_QUERY_BUDGET_STRICT:
+        raise QueryBudgetExceeded(message)
+    logger.warning("%s request_id=%s", message, ctx.request_id)
+
+def query_shape(value):
+    """Replace literal values with '?' so filters can be logged and grouped safely"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(value[0])] if value else []
+    return '?'
+
+def command_filter(command_name: str, command) -> Any:
+    if command_name in ('find', 'count', 'distinct', 'findAndModify'):
+        return command.get('filter', command.get('query'))
+    if command_name in ('update', 'delete'):
+        statements = command.get('updates' if command_name == 'update' else 'deletes') or [{}]
+        return statements[0].get('q')
+    if command_name == 'aggregate':
+        return next((stage['$match'] for stage in command.get('pipeline', []) if '$match' in stage), None)
+    return None
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Counts commands per request, records per-collection metrics and logs slow commands"""
+    def __init__(self):
+        self.inflight = {}  # (connection_id, request_id) -> (collection, filter shape, ctx)
+
+    def started(self, event):
+        ctx = request_context.get()
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        if not isinstance(collection, str):
+            collection = ''
+        if ctx is not None:
+            ctx.query_count += 1
+            ctx.commands.append((event.command_name, collection))
+        shape = query_shape(command_filter(event.command_name, event.command))
+        self.inflight[(event.connection_id, event.request_id)] = (collection, shape, ctx)
+
+    def _finish(self, event, outcome: str):
+        collection, shape, ctx = self.inflight.pop((event.connection_id, event.request_id), ('', None, None))
+        MONGO_COMMANDS.labels(collection, event.command_name, outcome).inc()
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        duration_ms = event.duration_micros / 1000
+        if duration_ms >= MONGO_SLOW_QUERY_MS:
+            logger.warning(
+                "Slow Mongo command %s.%s %.1fms outcome=%s filter=%s route=%s request_id=%s",
+                collection, event.command_name, duration_ms, outcome, shape,
+                ctx.route if ctx else '-', ctx.request_id if ctx else '-'
+            )
+
+    def succeeded(self, event):
+        self._finish(event, 'success')
+
+    def failed(self, event):
+        self._finish(event, 'error')
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+
+# Reads are routed by query class, each with its own client so pool size and
+# read preference are set independently. `db` is the primary and serves auth,
+# writes and every read that must see the caller's own writes. Catalog reads
+# tolerate bounded staleness and go through `reader()`, by default to a
+# secondary no more than MAX_STALENESS seconds behind. Catalog snapshots and
+# the search index are only rebuilt after a catalog version change, so they
+# read the primary: any worker's write is there. Dashboards show the caller's
+# own progress and leaderboards apply in-process deltas on top of what they
+# read, so both stay on the primary. Each class is configured with
+# MONGO_<CLASS>_POOL_SIZE, MONGO_<CLASS>_READ_PREFERENCE and
+# MONGO_<CLASS>_MAX_STALENESS (90 seconds at least, the driver's minimum).
+READ_CLASSES = ('catalog',)
+DEFAULT_POOL_SIZES = {'primary': 100, 'catalog': 50}
+
+def mongo_client_options(query_class: str) -> dict:
+    prefix = f'MONGO_{query_class.upper()}_'
+    options = {'maxPoolSize': int(os.environ.get(prefix + 'POOL_SIZE', DEFAULT_POOL_SIZES[query_class]))}
+    if query_class != 'primary':
+        options['readPreference'] = os.environ.get(prefix + 'READ_PREFERENCE', 'secondaryPreferred')
+        if options['readPreference'] != 'primary':
+            options['maxStalenessSeconds'] = int(os.environ.get(prefix + 'MAX_STALENESS', 90))
+    return options
+
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandListener()], **mongo_client_options('primary'))
 db = client[os.environ['DB_NAME']]
+read_clients = {
+    query_class: AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandListener()], **mongo_client_options(query_class))
+    for query_class in READ_CLASSES
+}
+read_databases = {query_class: read_client[os.environ['DB_NAME']] for query_class, read_client in read_clients.items()}
+read_staleness = {query_class: mongo_client_options(query_class).get('maxStalenessSeconds', 0) for query_class in READ_CLASSES}
+last_writes = {}  # query class -> time.monotonic() of the last write to that class's data this process made or saw
+
+def reader(query_class: str):
+    """Database for a staleness-tolerant read of `query_class` data"""
+    database = read_databases.get(query_class)
+    if database is None:
+        return db
+    if time.monotonic() - last_writes.get(query_class, -math.inf) < read_staleness[query_class]:
+        return db  # a secondary may not have that write yet
+    return database
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET')
@@ -28,7 +282,7 @@ JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 JWT_EXPIRATION_HOURS = int(os.environ.get('JWT_EXPIRATION_HOURS', 720))
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
@@ -64,6 +318,31 @@ class Skill(BaseModel):
     icon: str
     position: Dict[str, int]  # x, y coordinates for tree visualization
 
+class SkillWithStatus(Skill):
+    user_status: str  # locked, available, in_progress, completed
+    user_progress: int = 0
+
+class SkillCluster(BaseModel):
+    id: str
+    x: float
+    y: float
+    count: int
+    xp_value: int
+    categories: List[str]
+    statuses: Dict[str, int]  # user status -> number of member skills
+
+class SkillEdge(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+    source: str = Field(alias='from')  # skill or cluster id
+    to: str
+    path: List[List[float]]
+    count: int  # prerequisite edges merged into this one
+
+class SkillViewport(BaseModel):
+    skills: List[SkillWithStatus]
+    clusters: List[SkillCluster]
+    edges: List[SkillEdge]
+
 class UserSkill(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -84,6 +363,9 @@ class Lesson(BaseModel):
     estimated_time: int  # in minutes
     resources: List[Dict[str, str]] = []  # external links
 
+class LessonWithStatus(Lesson):
+    completed: bool = False
+
 class UserLesson(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -124,11 +406,11 @@ async def get_current_user_from_request(request: Request) -> dict:
     session_token = request.cookies.get('session_token')
     
     if session_token:
-        session = await db.user_sessions.find_one({'session_token': session_token}, {'_id': 0})
+        session = await load_one('user_sessions', session_token, key='session_token')
         if session:
             expires_at = datetime.fromisoformat(session['expires_at'])
             if expires_at > datetime.now(timezone.utc):
-                user = await db.users.find_one({'id': session['user_id']}, {'_id': 0})
+                user = await load_one('users', session['user_id'])
                 if user:
                     return user
     
@@ -137,7 +419,7 @@ async def get_current_user_from_request(request: Request) -> dict:
     if auth_header and auth_header.startswith('Bearer '):
         token = auth_header.split(' ')[1]
         payload = decode_token(token)
-        user = await db.users.find_one({'id': payload['user_id']}, {'_id': 0})
+        user = await load_one('users', payload['user_id'])
         if user:
             return user
     
@@ -146,7 +428,7 @@ async def get_current_user_from_request(request: Request) -> dict:
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     token = credentials.credentials
     payload = decode_token(token)
-    user = await db.users.find_one({'id': payload['user_id']}, {'_id': 0})
+    user = await load_one('users', payload['user_id'])
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     return user
@@ -158,6 +440,721 @@ async def get_admin_user(request: Request) -> dict:
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+# ============= HTTP CACHING =============
+# Responses are versioned rather than hashed: every write that can change a
+# cached payload bumps the catalog or the user's progress version, so a
+# revalidation is answered from these counters without reading the data.
+# Both live in Mongo so every worker agrees on them. The catalog version is a
+# counter document, which each worker polls every CATALOG_VERSION_POLL_SECONDS
+# and re-reads before reporting an unknown skill; its epoch changes if the
+# document is ever recreated, so versions are never reused. A user's version
+# is users.cache_version, read with the user on every request anyway.
+# cache_versions['catalog'] is this process's own generation number: it moves
+# whenever the shared version does and keys the in-memory catalog caches.
+BOOT_ID = uuid.uuid4().hex[:8]
+CACHE_CONTROL = 'private, no-cache'
+CATALOG_VERSION_ID = 'catalog_version'
+CATALOG_VERSION_POLL_SECONDS = float(os.environ.get('CATALOG_VERSION_POLL_SECONDS', 1))
+cache_versions = {'catalog': 0, 'shared': (BOOT_ID, 0)}  # shared: (epoch, seq) last seen
+
+def observe_catalog_version(counter: dict, own_write: bool = False) -> bool:
+    """Adopt the shared catalog version in `counter`; True if this process's catalog caches are now out of date"""
+    epoch, seq = cache_versions['shared']
+    newer = counter['epoch'] != epoch or counter['seq'] > seq
+    if newer:
+        cache_versions['shared'] = (counter['epoch'], counter['seq'])
+        if not (own_write and counter['epoch'] == epoch and counter['seq'] == seq + 1):
+            rebuild_search_index()  # another worker wrote, so the incremental index updates missed it
+    if newer or own_write:
+        cache_versions['catalog'] += 1
+        last_writes['catalog'] = time.monotonic()
+    return newer or own_write
+
+async def bump_catalog_version():
+    counter = await db.counters.find_one_and_update(
+        {'_id': CATALOG_VERSION_ID},
+        {'$inc': {'seq': 1}, '$setOnInsert': {'epoch': uuid.uuid4().hex[:8]}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    observe_catalog_version(counter, own_write=True)
+
+async def refresh_catalog_version() -> bool:
+    """Pick up catalog writes made by other workers; True if there were any"""
+    counter = await db.counters.find_one({'_id': CATALOG_VERSION_ID})
+    return counter is not None and observe_catalog_version(counter)
+
+async def watch_catalog_version():
+    while True:
+        try:
+            await refresh_catalog_version()
+        except Exception as e:
+            logger.error(f"Catalog version poll failed: {e}")
+        await asyncio.sleep(CATALOG_VERSION_POLL_SECONDS)
+
+async def bump_user_version(*user_ids: str):
+    if len(user_ids) == 1:
+        await db.users.update_one({'id': user_ids[0]}, {'$inc': {'cache_version': 1}})
+    else:
+        await db.users.update_many({'id': {'$in': list(set(user_ids))}}, {'$inc': {'cache_version': 1}})
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1(':'.join(str(p) for p in parts).encode()).hexdigest()
+    return f'"{digest[:20]}"'
+
+def catalog_etag(*parts) -> str:
+    return make_etag('catalog', *cache_versions['shared'], *parts)
+
+def user_etag(user: dict, *parts) -> str:
+    return make_etag(
+        'user', *cache_versions['shared'], user['id'], user.get('cache_version', 0),
+        progress_buffer.revision(user['id']), *parts
+    )
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    # `*` is not honoured: the tag is checked before the resource is looked up, so it may not exist
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    matched = etag in candidates
+    record_cache('etag', matched)
+    return matched
+
+def set_cache_headers(response: Response, etag: str):
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = CACHE_CONTROL
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': CACHE_CONTROL})
+
+
+# ============= CATALOG CACHE =============
+# The skill catalog only changes through admin writes, so each catalog version
+# is loaded, validated and serialized once. Per-user responses are produced by
+# splicing the user's fields onto the cached JSON of each document.
+LESSON_CACHE_SKILLS = int(os.environ.get('LESSON_CACHE_SKILLS', 512))
+# Deleted skills stay behind as tombstones until their cascade finishes
+LIVE_SKILLS = {'deleted': {'$ne': True}}
+
+def splice_json(document_json: bytes, extra: bytes) -> bytes:
+    """Append pre-encoded `"key":value` pairs to a serialized JSON object"""
+    return document_json[:-1] + b',' + extra + b'}'
+
+def json_array(items) -> bytes:
+    return b'[' + b','.join(items) + b']'
+
+# Status codes of the per-user overlay, one byte per skill in catalog order
+SKILL_STATUS_CODES = ('locked', 'available', 'in_progress', 'completed')
+PUBLIC_CATALOG_MAX_AGE = int(os.environ.get('PUBLIC_CATALOG_MAX_AGE', 60))
+
+def validate_documents(model, docs: List[dict]) -> list:
+    """`model` instances of the documents that validate; a malformed one is logged and left out instead of failing the read"""
+    items = []
+    for doc in docs:
+        try:
+            items.append(model.model_validate(doc))
+        except ValidationError as e:
+            logger.warning(f"Skipping malformed {model.__name__} {doc.get('id')}: {e.error_count()} validation errors")
+    return items
+
+class CatalogSnapshot:
+    """One catalog version: validated skills, laid out, plus their serialized JSON.
+
+    Built in a worker thread. The layout, prerequisite graph and spatial index
+    are only rebuilt when the skills or their prerequisites differ from `previous`,
+    the version it replaces.
+    """
+    def __init__(self, version: int, skill_docs: List[dict], previous: Optional['CatalogSnapshot'] = None):
+        self.version = version
+        skills = validate_documents(Skill, skill_docs)
+        self.structure = [(skill.id, skill.category, tuple(skill.prerequisites)) for skill in skills]
+        reuse = previous is not None and previous.structure == self.structure
+        if reuse:
+            self.positions, self.layout_stats, self.graph = previous.positions, previous.layout_stats, previous.graph
+        else:
+            started = time.perf_counter()
+            self.positions, self.layout_stats = layered_layout(skills)
+            self.graph = PrerequisiteGraph(skills)
+            logger.info(f"Laid out {len(skills)} skills in {(time.perf_counter() - started) * 1000:.0f}ms: {self.layout_stats}")
+        self.skills = [skill.model_copy(update={'position': self.positions[skill.id]}) for skill in skills]
+        self.grid = previous.grid if reuse else SkillGrid(self.skills)
+        self.by_id = {skill.id: skill for skill in self.skills}
+        self.skill_json = {skill.id: Skill.__pydantic_serializer__.to_json(skill) for skill in self.skills}
+        self.lessons = OrderedDict()  # skill_id -> [(Lesson, bytes)], LRU
+        self._public = None
+        self.index = {skill.id: i for i, skill in enumerate(self.skills)}
+        # The prerequisites that gate each skill, for skill_status and status_overlay alike. Ones not in
+        # the catalog are left out, as by the prerequisite graph: a deleted skill's cascade takes it out
+        # of its dependents' prerequisites anyway.
+        self.required = [[p for p in skill.prerequisites if p in self.index] for skill in self.skills]
+        self.edge_src = np.array([self.index[p] for required in self.required for p in required], np.int64)
+        self.edge_dst = np.array([i for i, required in enumerate(self.required) for _ in required], np.int64)
+        self.prerequisite_counts = np.array([len(required) for required in self.required], np.int64)
+
+    async def lessons_for(self, skill_id: str) -> list:
+        cached = self.lessons.get(skill_id)
+        record_cache('lessons', cached is not None)
+        if cached is not None:
+            self.lessons.move_to_end(skill_id)
+            return cached
+        docs = await reader('catalog').lessons.find({'skill_id': skill_id}, {'_id': 0}).sort('order', 1).to_list(None)
+        lessons = validate_documents(Lesson, docs)
+        cached = [(lesson, Lesson.__pydantic_serializer__.to_json(lesson)) for lesson in lessons]
+        self.lessons[skill_id] = cached
+        if len(self.lessons) > LESSON_CACHE_SKILLS:
+            self.lessons.popitem(last=False)
+        return cached
+
+    def skill_status(self, skill: Skill, user_skill_map: dict) -> tuple:
+        """(status, progress) of one skill for the user whose user_skills are in `user_skill_map`"""
+        user_skill = user_skill_map.get(skill.id)
+        if user_skill:
+            return user_skill['status'], user_skill['progress_percent']
+        for prereq_id in self.required[self.index[skill.id]]:
+            prereq = user_skill_map.get(prereq_id)
+            if not prereq or prereq['status'] != 'completed':
+                return 'locked', 0
+        return 'available', 0
+
+    def render_skills(self, user_skill_map: dict, skills: Optional[List[Skill]] = None) -> bytes:
+        items = []
+        for skill in self.skills if skills is None else skills:
+            user_status, user_progress = self.skill_status(skill, user_skill_map)
+            extra = b'"user_status":' + orjson.dumps(user_status) + b',"user_progress":' + str(user_progress).encode()
+            items.append(splice_json(self.skill_json[skill.id], extra))
+        return json_array(items)
+
+    @property
+    def public(self) -> tuple:
+        """(content version, JSON) of the user-independent catalog, identical on every worker for the same data"""
+        if self._public is None:
+            skills = json_array(self.skill_json[skill.id] for skill in self.skills)
+            content_version = hashlib.sha1(skills).hexdigest()[:16]
+            self._public = content_version, b'{"version":"' + content_version.encode() + b'","skills":' + skills + b'}'
+        return self._public
+
+    def status_overlay(self, user_skill_map: dict) -> tuple:
+        """(status byte per skill in catalog order, {index: progress} where it differs from the status default)"""
+        completed = np.zeros(len(self.skills), bool)
+        explicit = []
+        for skill_id, user_skill in user_skill_map.items():
+            i = self.index.get(skill_id)
+            if i is not None:
+                explicit.append((i, user_skill))
+                completed[i] = user_skill['status'] == 'completed'
+        done = np.bincount(self.edge_dst, weights=completed[self.edge_src], minlength=len(self.skills))
+        codes = (done == self.prerequisite_counts).astype(np.uint8)  # available or locked
+        progress = {}
+        for i, user_skill in explicit:
+            codes[i] = SKILL_STATUS_CODES.index(user_skill['status'])
+            default = 100 if user_skill['status'] == 'completed' else 0
+            if user_skill['progress_percent'] != default:
+                progress[i] = user_skill['progress_percent']
+        return codes.tobytes(), progress
+
+    @staticmethod
+    def render_lessons(lessons: list, completed_ids: set) -> bytes:
+        return json_array(
+            splice_json(lesson_json, b'"completed":true' if lesson.id in completed_ids else b'"completed":false')
+            for lesson, lesson_json in lessons
+        )
+
+catalog_state = {'snapshot': None, 'watcher': None}
+catalog_lock = asyncio.Lock()
+
+async def get_catalog() -> CatalogSnapshot:
+    snapshot = catalog_state['snapshot']
+    if snapshot is not None and snapshot.version == cache_versions['catalog']:
+        record_cache('catalog', True)
+        return snapshot
+    record_cache('catalog', False)
+    async with catalog_lock:
+        snapshot = catalog_state['snapshot']
+        version = cache_versions['catalog']
+        if snapshot is None or snapshot.version != version:
+            # Straight after a version change, so from the primary: a secondary may not have the
+            # write yet, whichever worker made it. Sorted, so every worker yields the same order,
+            # layout and content hash.
+            docs = await db.skills.find(LIVE_SKILLS, {'_id': 0}).sort('id', 1).to_list(None)
+            snapshot = await asyncio.to_thread(CatalogSnapshot, version, docs, snapshot)
+            catalog_state['snapshot'] = snapshot
+    return snapshot
+
+async def get_catalog_with(skill_id: str) -> CatalogSnapshot:
+    """The catalog, re-checking the shared version first if `skill_id` is not in it: another worker may have just added it"""
+    catalog = await get_catalog()
+    if skill_id not in catalog.by_id and await refresh_catalog_version():
+        catalog = await get_catalog()
+    return catalog
+
+def json_bytes_response(content: bytes, etag: Optional[str] = None) -> Response:
+    response = Response(content=content, media_type='application/json')
+    if etag:
+        set_cache_headers(response, etag)
+    return response
+
+# ============= SKILL TREE LAYOUT =============
+# Sugiyama-style layered layout of the prerequisite DAG: longest-path layers,
+# then barycenter sweeps to reduce edge crossings, keeping the ordering with
+# the fewest crossings between adjacent layers. Edges spanning several layers
+# are not split into dummy nodes; barycenters use the endpoints' normalized
+# positions instead, which keeps each sweep a few linear numpy passes. Each
+# catalog snapshot is laid out as it is built, off the event loop, and skills
+# are served with the layout as their position.
+LAYOUT_SWEEPS = 8
+
+def count_crossings(layer: np.ndarray, order: np.ndarray, src: np.ndarray, dst: np.ndarray) -> int:
+    """Crossings among edges that join adjacent layers"""
+    adjacent = layer[dst] == layer[src] + 1
+    src, dst = src[adjacent], dst[adjacent]
+    if len(src) < 2:
+        return 0
+    # Sorted by (layer, source slot, target slot), every later edge ending left of an earlier one crosses it
+    ranked = np.lexsort((order[dst], order[src], layer[src]))
+    values = layer[src][ranked] * (len(layer) + 1) + order[dst][ranked]
+    # Bottom-up merge sort counting inversions, each pass merging all block pairs at once
+    stride = int(values.max()) + 1
+    position = np.arange(len(values))
+    crossings = 0
+    width = 1
+    while width < len(values):
+        pair = position // (2 * width)
+        keys = pair * stride + values
+        right = (position // width) % 2 == 1
+        left_keys = keys[~right]
+        at_or_below = np.searchsorted(left_keys, keys[right], 'right')
+        block_end = np.searchsorted(left_keys, (pair[right] + 1) * stride, 'left')
+        crossings += int((block_end - at_or_below).sum())
+        values = np.sort(keys) - pair * stride
+        width *= 2
+    return crossings
+
+def layered_layout(skills: List[Skill]) -> tuple:
+    """Layout of the catalog as ({skill id: {'x', 'y'}}, stats); cycles and unknown prerequisites are ignored"""
+    n = len(skills)
+    index = {skill.id: i for i, skill in enumerate(skills)}
+    prerequisites = [[index[p] for p in skill.prerequisites if p in index and p != skill.id] for skill in skills]
+    dependents = [[] for _ in skills]
+    for i, required in enumerate(prerequisites):
+        for p in required:
+            dependents[p].append(i)
+
+    # Longest-path layering in topological order; a cycle is broken at its lowest-index node
+    layers = [0] * n
+    waiting = [len(required) for required in prerequisites]
+    placed = [False] * n
+    ready = [i for i in range(n) if waiting[i] == 0]
+    next_forced = 0
+    for _ in range(n):
+        if not ready:
+            while placed[next_forced] or waiting[next_forced] == 0:
+                next_forced += 1
+            ready.append(next_forced)
+        node = ready.pop()
+        if placed[node]:
+            continue
+        placed[node] = True
+        for child in dependents[node]:
+            layers[child] = max(layers[child], layers[node] + 1)
+            waiting[child] -= 1
+            if waiting[child] == 0 and not placed[child]:
+                ready.append(child)
+
+    layer = np.array(layers, np.int64)
+    src = np.array([p for i, required in enumerate(prerequisites) for p in required], np.int64)
+    dst = np.array([i for i, required in enumerate(prerequisites) for _ in required], np.int64)
+    forward = layer[src] < layer[dst]  # drops the edges that closed a cycle
+    src, dst = src[forward], dst[forward]
+    sizes = np.bincount(layer, minlength=1)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    def slots(ranking):
+        order = np.empty(n, np.int64)
+        order[ranking] = np.arange(n) - starts[layer[ranking]]
+        return order
+
+    categories = {category: rank for rank, category in enumerate(sorted({skill.category for skill in skills}))}
+    order = slots(np.lexsort((np.arange(n), [categories[skill.category] for skill in skills], layer)))
+    best, best_crossings = order, count_crossings(layer, order, src, dst)
+    initial_crossings = best_crossings
+    for sweep in range(LAYOUT_SWEEPS):
+        if best_crossings == 0:
+            break
+        position = (order + 0.5) / sizes[layer]
+        # Even sweeps pull nodes towards their prerequisites, odd sweeps towards their dependents
+        anchor, moved = (src, dst) if sweep % 2 == 0 else (dst, src)
+        totals = np.bincount(moved, weights=position[anchor], minlength=n)
+        counts = np.bincount(moved, minlength=n)
+        barycenter = np.where(counts > 0, totals / np.maximum(counts, 1), position)
+        order = slots(np.lexsort((order, barycenter, layer)))
+        crossings = count_crossings(layer, order, src, dst)
+        if crossings < best_crossings:
+            best, best_crossings = order, crossings
+
+    x = best - (sizes[layer] - 1) // 2  # whole units, like the positions stored with each skill
+    positions = {skill.id: {'x': int(x[i]), 'y': int(layer[i])} for i, skill in enumerate(skills)}
+    stats = {'layers': int(len(sizes)) if n else 0, 'crossings': best_crossings, 'initial_crossings': initial_crossings}
+    return positions, stats
+
+# ============= PREREQUISITE GRAPH =============
+def strongly_connected_components(nodes: List[int], successors) -> List[List[int]]:
+    """Tarjan's algorithm without recursion; `successors(node)` lists a node's neighbours"""
+    order, low, on_stack, stack, components = {}, {}, set(), [], []
+    for root in nodes:
+        if root in order:
+            continue
+        order[root] = low[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in order:
+                    order[child] = low[child] = len(order)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                    break
+                if child in on_stack:
+                    low[node] = min(low[node], order[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == order[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+class PrerequisiteGraph:
+    """Prerequisite and dependent lists of every skill over a topological order.
+
+    `ids[i]` is the skill of rank i, so sorting by rank yields skills in an
+    order they can be learned in. Skills on a cycle come last and are reported
+    in `cycles`. Closures are not stored: each query walks just the part of the
+    graph it needs.
+    """
+    def __init__(self, skills: List[Skill]):
+        known = {skill.id for skill in skills}
+        edges = {skill.id: list(dict.fromkeys(p for p in skill.prerequisites if p in known)) for skill in skills}
+        self.missing = {
+            skill.id: [p for p in skill.prerequisites if p not in known]
+            for skill in skills if any(p not in known for p in skill.prerequisites)
+        }
+
+        waiting = {skill_id: len(prerequisites) for skill_id, prerequisites in edges.items()}
+        dependents = defaultdict(list)
+        for skill_id, prerequisites in edges.items():
+            for p in prerequisites:
+                dependents[p].append(skill_id)
+        ids = [skill_id for skill_id, count in waiting.items() if count == 0]
+        for skill_id in ids:  # grows while iterating
+            for child in dependents[skill_id]:
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ids.append(child)
+        self.acyclic = len(ids)  # ranks below this are on no cycle and only depend on lower ranks
+        ids.extend(skill_id for skill_id, count in waiting.items() if count > 0)
+
+        self.ids = ids
+        self.rank = {skill_id: i for i, skill_id in enumerate(ids)}
+        self.prerequisites = [[self.rank[p] for p in edges[skill_id]] for skill_id in ids]
+        self.dependents = [[self.rank[d] for d in dependents[skill_id]] for skill_id in ids]
+
+        tangled = range(self.acyclic, len(ids))
+        components = strongly_connected_components(tangled, lambda i: [p for p in self.prerequisites[i] if p >= self.acyclic])
+        self.cycles = [
+            [ids[i] for i in sorted(component)] for component in sorted(components, key=min)
+            if len(component) > 1 or component[0] in self.prerequisites[component[0]]
+        ]
+
+    def walk(self, starts, neighbors: List[List[int]], stop=frozenset()) -> List[str]:
+        """Skills reachable from the ranks in `starts` along `neighbors`, not going past skills in `stop`, by rank"""
+        seen = set()
+        stack = list(starts)
+        while stack:
+            i = stack.pop()
+            if i not in seen and self.ids[i] not in stop:
+                seen.add(i)
+                stack.extend(neighbors[i])
+        return [self.ids[i] for i in sorted(seen)]
+
+    def depends_on(self, skill_id: str, prerequisite_id: str) -> bool:
+        """Whether `prerequisite_id` has to be learned, directly or not, before `skill_id`"""
+        start, target = self.rank[skill_id], self.rank[prerequisite_id]
+        # Below `acyclic` a skill's prerequisites all rank lower, so the walk can skip branches that passed the target
+        def may_reach(i):
+            return i >= self.acyclic or target < i
+        if not may_reach(start):
+            return False
+        seen = set()
+        stack = list(self.prerequisites[start])
+        while stack:
+            i = stack.pop()
+            if i == target:
+                return True
+            if i not in seen and may_reach(i):
+                seen.add(i)
+                stack.extend(self.prerequisites[i])
+        return False
+
+    def ancestors_of(self, skill_id: str) -> List[str]:
+        return self.walk(self.prerequisites[self.rank[skill_id]], self.prerequisites)
+
+    def unlocks(self, skill_id: str) -> List[str]:
+        return self.walk(self.dependents[self.rank[skill_id]], self.dependents)
+
+    def creates_cycle(self, skill_id: str, prerequisites: List[str]) -> bool:
+        if skill_id not in self.rank:
+            return skill_id in prerequisites
+        return any(p == skill_id or (p in self.rank and self.depends_on(p, skill_id)) for p in prerequisites)
+
+    def remaining(self, skill_id: str, completed: set) -> List[str]:
+        """Smallest set of skills, in learning order, to complete before `skill_id` unlocks.
+
+        The walk stops at completed skills, whose own prerequisites no longer matter.
+        """
+        return self.walk(self.prerequisites[self.rank[skill_id]], self.prerequisites, completed)
+
+def validate_prerequisites(catalog: CatalogSnapshot, skill_id: str, prerequisites: List[str]):
+    """Reject a catalog write whose prerequisites are unknown or would close a cycle"""
+    missing = [p for p in prerequisites if p not in catalog.by_id]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown prerequisites: {', '.join(missing)}")
+    if catalog.graph.creates_cycle(skill_id, prerequisites):
+        raise HTTPException(status_code=400, detail="Prerequisites would form a cycle")
+
+def skill_summaries(catalog: CatalogSnapshot, skill_ids: List[str]) -> List[dict]:
+    return [
+        {'id': skill_id, 'name': catalog.by_id[skill_id].name, 'xp_value': catalog.by_id[skill_id].xp_value}
+        for skill_id in skill_ids
+    ]
+
+# Writes that can break the prerequisite graph (new prerequisites, new or
+# deleted skills) are validated and made under a lease on the shared version
+# counter, so they are serialized across workers, not just within one. The
+# lease is only granted while no other worker holds it, and the catalog it
+# yields is read after the grant at the counter's version, so it already has
+# every earlier graph write. A lease whose holder died expires after
+# CATALOG_WRITE_LEASE_SECONDS.
+CATALOG_WRITE_LEASE_SECONDS = 30
+CATALOG_WRITE_RETRY_SECONDS = 0.05
+catalog_write_lock = asyncio.Lock()  # saves this worker's writers from polling each other
+
+@contextlib.asynccontextmanager
+async def catalog_write():
+    """Hold the catalog write lease; yields the catalog to validate the write against"""
+    async with catalog_write_lock:
+        token = uuid.uuid4().hex
+        while True:
+            now = time.time()
+            try:
+                counter = await db.counters.find_one_and_update(
+                    {'_id': CATALOG_VERSION_ID, '$or': [{'writer': {'$exists': False}}, {'writer_until': {'$lt': now}}]},
+                    {'$set': {'writer': token, 'writer_until': now + CATALOG_WRITE_LEASE_SECONDS},
+                     '$setOnInsert': {'epoch': uuid.uuid4().hex[:8], 'seq': 0}},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+                break
+            except DuplicateKeyError:
+                await asyncio.sleep(CATALOG_WRITE_RETRY_SECONDS)  # another worker holds it
+        try:
+            observe_catalog_version(counter)
+            yield await get_catalog()
+        finally:
+            await db.counters.update_one({'_id': CATALOG_VERSION_ID, 'writer': token}, {'$unset': {'writer': '', 'writer_until': ''}})
+
+# ============= SPATIAL INDEX =============
+# Uniform grid over the laid-out skill positions. Nodes are bucketed by cell;
+# prerequisite edges by every cell their bounding box touches, except edges
+# spanning more than SKILL_GRID_EDGE_CELLS cells, which are few and always
+# tested. Queries are first cut down to the area the skills occupy, so their
+# cost does not depend on how large a box the client asks for. Below
+# SKILL_MAX_ZOOM the visible nodes are merged into clusters of
+# 2**(SKILL_MAX_ZOOM - zoom) position units square.
+SKILL_GRID_CELL = int(os.environ.get('SKILL_GRID_CELL', 16))
+SKILL_GRID_EDGE_CELLS = 64
+SKILL_MAX_ZOOM = 4
+
+def segments_hit_box(segments: np.ndarray, box: tuple) -> np.ndarray:
+    """Which segments (rows of x1, y1, x2, y2) touch the box (min_x, min_y, max_x, max_y), by Liang-Barsky clipping"""
+    x1, y1, x2, y2 = segments.T
+    dx, dy = x2 - x1, y2 - y1
+    low, high = np.zeros(len(segments)), np.ones(len(segments))
+    hit = np.ones(len(segments), bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x1 - box[0]), (dx, box[2] - x1), (-dy, y1 - box[1]), (dy, box[3] - y1)):
+            hit &= (p != 0) | (q >= 0)
+            ratio = q / p
+            low = np.where(p < 0, np.maximum(low, ratio), low)
+            high = np.where(p > 0, np.minimum(high, ratio), high)
+    return hit & (low <= high)
+
+class SkillGrid:
+    """Skill positions and prerequisite edges bucketed by grid cell for viewport queries.
+
+    Only geometry is kept, by index into the catalog's skill list, so one grid
+    serves every catalog version with the same layout.
+    """
+    def __init__(self, skills: List[Skill], cell: int = SKILL_GRID_CELL):
+        self.cell = cell
+        self.points = [(skill.position.get('x', 0), skill.position.get('y', 0)) for skill in skills]
+        xs, ys = [x for x, _ in self.points], [y for _, y in self.points]
+        self.extent = (min(xs), min(ys), max(xs), max(ys)) if self.points else None
+        self.nodes = defaultdict(list)  # (cx, cy) -> skill indexes
+        for i, (x, y) in enumerate(self.points):
+            self.nodes[self.cell_of(x, y)].append(i)
+        index = {skill.id: i for i, skill in enumerate(skills)}
+        self.edges = [(index[p], i) for i, skill in enumerate(skills) for p in skill.prerequisites if p in index]
+        self.segments = np.array([self.points[a] + self.points[b] for a, b in self.edges], float).reshape(-1, 4)
+        self.edge_cells = defaultdict(list)  # (cx, cy) -> edge indexes
+        self.long_edges = []
+        for e, (a, b) in enumerate(self.edges):
+            box = self.bounds(a, b)
+            if self.cell_count(box) > SKILL_GRID_EDGE_CELLS:
+                self.long_edges.append(e)
+            else:
+                for key in self.cells_in(box):
+                    self.edge_cells[key].append(e)
+
+    def cell_of(self, x: float, y: float) -> tuple:
+        return (math.floor(x / self.cell), math.floor(y / self.cell))
+
+    def bounds(self, a: int, b: int) -> tuple:
+        (x1, y1), (x2, y2) = self.points[a], self.points[b]
+        return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+    def cell_count(self, box: tuple) -> int:
+        (cx1, cy1), (cx2, cy2) = self.cell_of(box[0], box[1]), self.cell_of(box[2], box[3])
+        return (cx2 - cx1 + 1) * (cy2 - cy1 + 1)
+
+    def cells_in(self, box: tuple) -> list:
+        (cx1, cy1), (cx2, cy2) = self.cell_of(box[0], box[1]), self.cell_of(box[2], box[3])
+        return [(cx, cy) for cx in range(cx1, cx2 + 1) for cy in range(cy1, cy2 + 1)]
+
+    def clip(self, box: tuple) -> Optional[tuple]:
+        """The part of `box` inside the area the skills occupy; None if they do not meet.
+
+        Every node and edge lies within that area, so the clipped box finds the same ones.
+        """
+        if self.extent is None:
+            return None
+        clipped = (max(box[0], self.extent[0]), max(box[1], self.extent[1]), min(box[2], self.extent[2]), min(box[3], self.extent[3]))
+        return clipped if clipped[0] <= clipped[2] and clipped[1] <= clipped[3] else None
+
+    def query(self, box: tuple) -> tuple:
+        """(indexes of skills inside `box`, indexes of edges crossing it), each in catalog order"""
+        box = self.clip(box)
+        if box is None:
+            return [], []
+        if self.cell_count(box) > len(self.nodes):  # large viewport: scanning the occupied cells is cheaper
+            cells = [key for key in self.nodes if box[0] <= (key[0] + 1) * self.cell and key[0] * self.cell <= box[2]
+                     and box[1] <= (key[1] + 1) * self.cell and key[1] * self.cell <= box[3]]
+        else:
+            cells = self.cells_in(box)
+        visible = sorted(
+            i for key in cells for i in self.nodes.get(key, ())
+            if box[0] <= self.points[i][0] <= box[2] and box[1] <= self.points[i][1] <= box[3]
+        )
+        candidates = {e for key in cells for e in self.edge_cells.get(key, ())}
+        candidates.update(self.long_edges)
+        candidates = np.array(sorted(candidates), np.int64)
+        crossing = candidates[segments_hit_box(self.segments[candidates], box)].tolist()
+        return visible, crossing
+
+    def viewport(self, box: tuple, zoom: int, skills: List[Skill], status_of) -> tuple:
+        """(visible skills, clusters, edges) for a viewport over `skills`; `status_of(skill)` is the caller's status.
+
+        At SKILL_MAX_ZOOM and above every visible skill is returned. Below it,
+        visible skills sharing a cluster cell are merged into one cluster node,
+        and edges are rewritten between clusters and counted.
+        """
+        visible, crossing = self.query(box)
+        if zoom >= SKILL_MAX_ZOOM:
+            edges = [self.edge_entry(skills[a].id, skills[b].id, self.points[a], self.points[b], 1)
+                     for a, b in (self.edges[e] for e in crossing)]
+            return [skills[i] for i in visible], [], edges
+
+        size = 2 ** (SKILL_MAX_ZOOM - zoom)
+        members = defaultdict(list)
+        for i in visible:
+            x, y = self.points[i]
+            members[(math.floor(x / size), math.floor(y / size))].append(i)
+        singles, clusters, node_of = [], [], {}
+        for (cx, cy), group in members.items():
+            if len(group) == 1:
+                singles.append(group[0])
+                node_of[group[0]] = (skills[group[0]].id, self.points[group[0]])
+                continue
+            cluster_id = f'cluster:{zoom}:{cx}:{cy}'
+            center = (sum(self.points[i][0] for i in group) / len(group), sum(self.points[i][1] for i in group) / len(group))
+            status_counts = defaultdict(int)
+            for i in group:
+                status_counts[status_of(skills[i])] += 1
+            clusters.append({
+                'id': cluster_id, 'x': center[0], 'y': center[1], 'count': len(group),
+                'xp_value': sum(skills[i].xp_value for i in group),
+                'categories': sorted({skills[i].category for i in group}),
+                'statuses': dict(status_counts)
+            })
+            for i in group:
+                node_of[i] = (cluster_id, center)
+        counts = defaultdict(int)
+        ends = {}
+        for e in crossing:
+            a, b = self.edges[e]
+            (source, source_point), (target, target_point) = (
+                node_of.get(i, (skills[i].id, self.points[i])) for i in (a, b)
+            )
+            if source != target:
+                counts[(source, target)] += 1
+                ends[(source, target)] = (source_point, target_point)
+        edges = [self.edge_entry(source, target, *ends[(source, target)], count) for (source, target), count in counts.items()]
+        return [skills[i] for i in sorted(singles)], clusters, edges
+
+    @staticmethod
+    def edge_entry(source: str, target: str, source_point: tuple, target_point: tuple, count: int) -> dict:
+        return {'from': source, 'to': target, 'path': [list(source_point), list(target_point)], 'count': count}
+
+
+# ============= LLM HELPERS =============
+class InstrumentedChat:
+    """LlmChat wrapper that records latency, outcome and estimated tokens per provider and model"""
+    def __init__(self, chat, provider: str, model: str):
+        self.chat = chat
+        self.provider = provider
+        self.model = model
+
+    async def send_message(self, message):
+        started = time.perf_counter()
+        try:
+            response = await self.chat.send_message(message)
+        except Exception:
+            LLM_REQUESTS.labels(self.provider, self.model, 'error').inc()
+            raise
+        finally:
+            LLM_REQUEST_DURATION.labels(self.provider, self.model).observe(time.perf_counter() - started)
+        LLM_REQUESTS.labels(self.provider, self.model, 'success').inc()
+        LLM_TOKENS.labels(self.provider, self.model, 'prompt').inc(len(message.text) // 4)
+        LLM_TOKENS.labels(self.provider, self.model, 'completion').inc(len(str(response)) // 4)
+        return response
+
+def llm_chat(provider: str, model: str, session_id: str, system_message: str, api_key: Optional[str] = None) -> InstrumentedChat:
+    chat = LlmChat(
+        api_key=api_key or os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=session_id,
+        system_message=system_message
+    ).with_model(provider, model)
+    return InstrumentedChat(chat, provider, model)
+
 
 # ============= AUTH ROUTES =============
 @api_router.get("/auth/me")
@@ -200,6 +1197,8 @@ async def create_oauth_session(data: dict, response: Response):
             'picture': oauth_data.get('picture'),
             'xp': 0,
             'level': 1,
+            'category_xp': {},
+            'category_xp_backfilled': True,
             'auth_type': 'oauth',
             'created_at': datetime.now(timezone.utc).isoformat()
         }
@@ -250,44 +1249,270 @@ async def logout(request: Request, response: Response):
     response.delete_cookie('session_token', path='/')
     return {'message': 'Logged out successfully'}
 
+# ============= IDEMPOTENCY =============
+# Mutating routes marked @idempotent honour an Idempotency-Key header. The
+# first request with a key claims it in idempotency_keys, runs the handler and
+# stores its response, which a TTL index expires after IDEMPOTENCY_TTL_HOURS.
+# Retries with the same key get the stored response without running anything.
+# A retry arriving while the first request is still running waits for it: on
+# a future in this process, or by polling the claim when another worker owns
+# it. Keys are scoped to the user, and reusing one for a different request is
+# an error. Server errors release the claim so the retry runs again.
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_LEASE_SECONDS = 120  # covers the slowest handler, lesson generation
+IDEMPOTENCY_CACHE_SIZE = 10000
+IDEMPOTENCY_QUERIES = 2  # claim and store, added to the route's query budget
+idempotency_cache = OrderedDict()  # scoped key -> (expires at, fingerprint, status code, body), LRU
+idempotency_inflight = {}  # scoped key -> future of (fingerprint, status code, body)
+
+def replay_response(status_code: int, body: bytes) -> Response:
+    return Response(content=body, status_code=status_code, media_type='application/json', headers={'Idempotent-Replayed': 'true'})
+
+def remember_idempotent(scoped_key: str, expires_at: datetime, fingerprint: str, status_code: int, body: bytes):
+    idempotency_cache[scoped_key] = (expires_at, fingerprint, status_code, body)
+    idempotency_cache.move_to_end(scoped_key)
+    if len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        idempotency_cache.popitem(last=False)
+
+def stored_replay(fingerprint: str, stored_fingerprint: str, status_code: int, body: bytes) -> Response:
+    if fingerprint != stored_fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    return replay_response(status_code, body)
+
+async def claim_idempotency_key(scoped_key: str, fingerprint: str) -> Optional[dict]:
+    """None once this request owns the key, otherwise the finished record it should replay"""
+    waited = 0.0
+    delay = 0.05
+    while True:
+        now = datetime.now(timezone.utc)
+        lease = {'owner': BOOT_ID, 'lease_until': now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+        try:
+            await db.idempotency_keys.insert_one({
+                '_id': scoped_key, 'status': 'pending', 'fingerprint': fingerprint,
+                'expires_at': now + timedelta(hours=IDEMPOTENCY_TTL_HOURS), **lease
+            })
+            return None
+        except DuplicateKeyError:
+            pass
+        record = await db.idempotency_keys.find_one({'_id': scoped_key})
+        if record is None:
+            continue  # expired in between
+        if record['status'] == 'done':
+            return record
+        lease_until = record['lease_until'].replace(tzinfo=timezone.utc)
+        if lease_until < now:
+            # The owner died mid-request; take the key over
+            taken = await db.idempotency_keys.update_one(
+                {'_id': scoped_key, 'status': 'pending', 'lease_until': record['lease_until']}, {'$set': lease}
+            )
+            if taken.modified_count:
+                return None
+            continue
+        if waited >= IDEMPOTENCY_LEASE_SECONDS:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, 1.0)
+
+def idempotent(endpoint):
+    """Serve retries of this route that carry the same Idempotency-Key from the stored first response"""
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        request = kwargs['request']
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return await endpoint(*args, **kwargs)
+        try:
+            current_user = await get_current_user_from_request(request)
+        except HTTPException:
+            return await endpoint(*args, **kwargs)  # rejects the request itself
+        scoped_key = f"{current_user['id']}:{key}"
+        fingerprint = hashlib.sha1(b'%s %s\n%s' % (request.method.encode(), request.url.path.encode(), await request.body())).hexdigest()
+
+        cached = idempotency_cache.get(scoped_key)
+        if cached and cached[0] > datetime.now(timezone.utc):
+            return stored_replay(fingerprint, *cached[1:])
+        if scoped_key in idempotency_inflight:
+            return stored_replay(fingerprint, *await asyncio.shield(idempotency_inflight[scoped_key]))
+
+        future = asyncio.get_running_loop().create_future()
+        idempotency_inflight[scoped_key] = future
+        try:
+            record = await claim_idempotency_key(scoped_key, fingerprint)
+            if record is not None:
+                remember_idempotent(scoped_key, record['expires_at'].replace(tzinfo=timezone.utc), record['fingerprint'], record['status_code'], record['body'])
+                future.set_result((record['fingerprint'], record['status_code'], record['body']))
+                return stored_replay(fingerprint, record['fingerprint'], record['status_code'], record['body'])
+            try:
+                result = await endpoint(*args, **kwargs)
+                status_code = result.status_code if isinstance(result, Response) else 200
+                body = result.body if isinstance(result, Response) else orjson.dumps(jsonable_encoder(result))
+            except HTTPException as e:
+                if e.status_code >= 500:
+                    raise
+                status_code, body = e.status_code, orjson.dumps({'detail': e.detail})
+                outcome = e
+            else:
+                outcome = result
+            expires_at = datetime.now(timezone.utc) + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+            await db.idempotency_keys.update_one({'_id': scoped_key}, {'$set': {
+                'status': 'done', 'status_code': status_code, 'body': body, 'expires_at': expires_at
+            }})
+            remember_idempotent(scoped_key, expires_at, fingerprint, status_code, body)
+            future.set_result((fingerprint, status_code, body))
+            if isinstance(outcome, HTTPException):
+                raise outcome
+            return outcome
+        except BaseException as e:
+            if not future.done():
+                # Not stored: the next retry runs the handler again
+                await db.idempotency_keys.delete_one({'_id': scoped_key, 'owner': BOOT_ID, 'status': 'pending'})
+                future.set_exception(e)
+                future.exception()  # retrieved here so an unawaited future does not warn
+            raise
+        finally:
+            idempotency_inflight.pop(scoped_key, None)
+
+    if hasattr(endpoint, 'query_budget'):
+        wrapper.query_budget = endpoint.query_budget + IDEMPOTENCY_QUERIES
+    return wrapper
+
 # ============= SKILLS ROUTES =============
-@api_router.get("/skills")
-async def get_skills(request: Request):
+@api_router.get("/skills", response_model=None, responses={200: {
+    'model': Union[List[SkillWithStatus], SkillViewport],
+    'description': 'A list of every skill, or a SkillViewport when min_x, min_y, max_x and max_y are given',
+}})
+@query_budget(5)
+async def get_skills(
+    request: Request,
+    min_x: Optional[float] = None, min_y: Optional[float] = None,
+    max_x: Optional[float] = None, max_y: Optional[float] = None,
+    zoom: int = SKILL_MAX_ZOOM
+):
+    """Every skill with the caller's status, or with a bounding box over `position` only the visible part of the tree"""
     current_user = await get_current_user_from_request(request)
-    skills = await db.skills.find({}, {'_id': 0}).to_list(1000)
-    user_skills = await db.user_skills.find({'user_id': current_user['id']}, {'_id': 0}).to_list(1000)
+    box = (min_x, min_y, max_x, max_y)
+    viewport = any(v is not None for v in box)
+    if viewport and (None in box or not all(map(math.isfinite, box)) or min_x > max_x or min_y > max_y):
+        raise HTTPException(status_code=400, detail="min_x, min_y, max_x and max_y must all be given and describe a box")
+    zoom = max(0, min(zoom, SKILL_MAX_ZOOM))  # nothing changes past either end
+    etag = user_etag(current_user, 'skills', *((box, zoom) if viewport else ()))
+    if etag_matches(request, etag):
+        return not_modified(etag)
     
-    user_skill_map = {us['skill_id']: us for us in user_skills}
+    catalog = await get_catalog()
+    user_skills = await db.user_skills.find({'user_id': current_user['id']}, {'_id': 0}).to_list(None)
+    user_skill_map = {us['skill_id']: us for us in progress_buffer.apply(current_user['id'], user_skills)}
     
-    for skill in skills:
-        skill_id = skill['id']
-        if skill_id in user_skill_map:
-            skill['user_status'] = user_skill_map[skill_id]['status']
-            skill['user_progress'] = user_skill_map[skill_id]['progress_percent']
-        else:
-            prereqs_met = True
-            for prereq_id in skill.get('prerequisites', []):
-                if prereq_id not in user_skill_map or user_skill_map[prereq_id]['status'] != 'completed':
-                    prereqs_met = False
-                    break
-            skill['user_status'] = 'available' if (prereqs_met and len(skill.get('prerequisites', [])) > 0) or len(skill.get('prerequisites', [])) == 0 else 'locked'
-            skill['user_progress'] = 0
+    if not viewport:
+        return json_bytes_response(catalog.render_skills(user_skill_map), etag)
     
-    return skills
+    skills, clusters, edges = catalog.grid.viewport(box, zoom, catalog.skills, lambda skill: catalog.skill_status(skill, user_skill_map)[0])
+    content = (
+        b'{"skills":' + catalog.render_skills(user_skill_map, skills)
+        + b',"clusters":' + orjson.dumps(clusters) + b',"edges":' + orjson.dumps(edges) + b'}'
+    )
+    return json_bytes_response(content, etag)
+
+@api_router.get("/catalog")
+async def get_public_catalog(request: Request):
+    """The skill catalog without user fields, shareable by any client and cache; pair it with /skills/overlay"""
+    catalog = await get_catalog()
+    content_version, content = catalog.public
+    etag = f'"{content_version}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': f'public, max-age={PUBLIC_CATALOG_MAX_AGE}'})
+    response = json_bytes_response(content)
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = f'public, max-age={PUBLIC_CATALOG_MAX_AGE}'
+    return response
+
+@api_router.get("/catalog/{content_version}")
+async def get_public_catalog_version(content_version: str, request: Request):
+    """One catalog version by its content hash; never changes, so caches may keep it forever.
+
+    Only the current version is kept, so any other one redirects to it.
+    """
+    catalog = await get_catalog()
+    current_version, content = catalog.public
+    if content_version != current_version and await refresh_catalog_version():
+        current_version, content = (await get_catalog()).public  # the client may have seen a newer version elsewhere
+    if content_version != current_version:
+        url = request.url_for('get_public_catalog_version', content_version=current_version)
+        return RedirectResponse(str(url), status_code=302, headers={'Cache-Control': 'no-cache'})
+    response = json_bytes_response(content)
+    response.headers['ETag'] = f'"{current_version}"'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@api_router.get("/skills/overlay")
+@query_budget(5)
+async def get_skill_overlay(request: Request):
+    """The caller's skill statuses against the public catalog: base64 status bytes in catalog order plus sparse progress"""
+    current_user = await get_current_user_from_request(request)
+    etag = user_etag(current_user, 'overlay')
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    catalog = await get_catalog()
+    user_skills = await db.user_skills.find(
+        {'user_id': current_user['id']}, {'_id': 0, 'skill_id': 1, 'status': 1, 'progress_percent': 1}
+    ).to_list(None)
+    statuses, progress = catalog.status_overlay({us['skill_id']: us for us in progress_buffer.apply(current_user['id'], user_skills)})
+    return json_bytes_response(orjson.dumps({
+        'catalog_version': catalog.public[0],
+        'status_codes': SKILL_STATUS_CODES,
+        'statuses': base64.b64encode(statuses).decode(),
+        'progress': {str(i): percent for i, percent in progress.items()}
+    }), etag)
 
-@api_router.get("/skills/{skill_id}")
+@api_router.get("/skills/{skill_id}", response_model=Skill)
+@query_budget(4)
 async def get_skill(skill_id: str, request: Request):
     await get_current_user_from_request(request)
-    skill = await db.skills.find_one({'id': skill_id}, {'_id': 0})
-    if not skill:
+    etag = catalog_etag('skill', skill_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    catalog = await get_catalog_with(skill_id)
+    if skill_id not in catalog.skill_json:
+        raise HTTPException(status_code=404, detail="Skill not found")
+    return json_bytes_response(catalog.skill_json[skill_id], etag)
+
+@api_router.get("/skills/{skill_id}/unlock-path")
+@query_budget(4)
+async def get_unlock_path(skill_id: str, request: Request):
+    """Every skill leading to `skill_id`, in an order they can be learned in, ending with the skill itself"""
+    await get_current_user_from_request(request)
+    catalog = await get_catalog()
+    if skill_id not in catalog.by_id:
+        raise HTTPException(status_code=404, detail="Skill not found")
+    path = catalog.graph.ancestors_of(skill_id) + [skill_id]
+    return {'skill_id': skill_id, 'path': skill_summaries(catalog, path)}
+
+@api_router.get("/skills/{skill_id}/remaining-prerequisites")
+@query_budget(5)
+async def get_remaining_prerequisites(skill_id: str, request: Request):
+    """The skills the current user still has to complete before `skill_id` unlocks"""
+    current_user = await get_current_user_from_request(request)
+    catalog = await get_catalog()
+    if skill_id not in catalog.by_id:
         raise HTTPException(status_code=404, detail="Skill not found")
-    return skill
+    completed = await db.user_skills.distinct('skill_id', {'user_id': current_user['id'], 'status': 'completed'})
+    remaining = skill_summaries(catalog, catalog.graph.remaining(skill_id, set(completed)))
+    return {
+        'skill_id': skill_id,
+        'remaining': remaining,
+        'remaining_xp': sum(skill['xp_value'] for skill in remaining)
+    }
 
 @api_router.post("/user-skills/{skill_id}/start")
+@idempotent
+@query_budget(8)
 async def start_skill(skill_id: str, request: Request):
     current_user = await get_current_user_from_request(request)
-    skill = await db.skills.find_one({'id': skill_id}, {'_id': 0})
-    if not skill:
+    catalog = await get_catalog_with(skill_id)
+    if skill_id not in catalog.by_id:
         raise HTTPException(status_code=404, detail="Skill not found")
     
     existing = await db.user_skills.find_one({'user_id': current_user['id'], 'skill_id': skill_id}, {'_id': 0})
@@ -305,33 +1530,52 @@ async def start_skill(skill_id: str, request: Request):
     }
     
     await db.user_skills.insert_one(user_skill_doc)
+    await bump_user_version(current_user['id'])
+    await record_changes([(current_user['id'], 'user_skills', user_skill_doc['id'])])
+    publish_event(current_user['id'], 'skill_started', skill_id=skill_id)
     user_skill_doc.pop('_id', None)
     return {'message': 'Skill started', 'user_skill': user_skill_doc}
 
 @api_router.put("/user-skills/{skill_id}/progress")
+@query_budget(7)
 async def update_progress(skill_id: str, progress: dict, request: Request):
     current_user = await get_current_user_from_request(request)
-    user_skill = await db.user_skills.find_one({'user_id': current_user['id'], 'skill_id': skill_id}, {'_id': 0})
+    new_progress = progress.get('progress_percent', 0)
+    # Looked up even with progress buffered: a deletion cascade may have removed the row since
+    user_skill = await db.user_skills.find_one({'user_id': current_user['id'], 'skill_id': skill_id}, {'_id': 0, 'id': 1})
     if not user_skill:
         raise HTTPException(status_code=404, detail="User skill not found")
+    user_skill_id = user_skill['id']
     
-    new_progress = progress.get('progress_percent', 0)
-    await db.user_skills.update_one(
-        {'id': user_skill['id']},
-        {'$set': {'progress_percent': new_progress}}
-    )
+    if progress_buffer.enabled():
+        progress_buffer.add(current_user['id'], skill_id, user_skill_id, new_progress)
+    else:
+        await db.user_skills.update_one(
+            {'id': user_skill_id},
+            {'$set': {'progress_percent': new_progress}}
+        )
+        await bump_user_version(current_user['id'])
+        await record_changes([(current_user['id'], 'user_skills', user_skill_id)])
+    publish_event(current_user['id'], 'progress_updated', skill_id=skill_id, progress_percent=new_progress)
     
     return {'message': 'Progress updated', 'progress_percent': new_progress}
 
 @api_router.post("/user-skills/{skill_id}/complete")
+@idempotent
+@query_budget(10)
 async def complete_skill(skill_id: str, request: Request):
     current_user = await get_current_user_from_request(request)
-    skill = await db.skills.find_one({'id': skill_id}, {'_id': 0})
+    catalog = await get_catalog_with(skill_id)
+    skill = catalog.by_id.get(skill_id)
+    if not skill:
+        raise HTTPException(status_code=404, detail="Skill not found")
     user_skill = await db.user_skills.find_one({'user_id': current_user['id'], 'skill_id': skill_id}, {'_id': 0})
     
     if not user_skill:
         raise HTTPException(status_code=404, detail="User skill not found")
+    was_completed = user_skill['status'] == 'completed'
     
+    progress_buffer.discard(current_user['id'], skill_id)  # a late flush must not undo the 100%
     await db.user_skills.update_one(
         {'id': user_skill['id']},
         {'$set': {
@@ -341,35 +1585,72 @@ async def complete_skill(skill_id: str, request: Request):
         }}
     )
     
-    new_xp = current_user['xp'] + skill['xp_value']
-    new_level = 1 + (new_xp // 1000)
-    
-    await db.users.update_one(
+    # One update adding to the stored totals, so concurrent completions each count; the level follows the new xp
+    field = category_field(skill.category)
+    updated_user = await db.users.find_one_and_update(
         {'id': current_user['id']},
-        {'$set': {'xp': new_xp, 'level': new_level}}
+        [
+            {'$set': {
+                'xp': {'$add': [{'$ifNull': ['$xp', 0]}, skill.xp_value]},
+                f'category_xp.{field}': {'$add': [{'$ifNull': [f'$category_xp.{field}', 0]}, skill.xp_value]},
+                'cache_version': {'$add': [{'$ifNull': ['$cache_version', 0]}, 1]},
+            }},
+            {'$set': {'level': {'$add': [1, {'$toInt': {'$floor': {'$divide': ['$xp', 1000]}}}]}}},
+        ],
+        projection={'_id': 0}, return_document=ReturnDocument.AFTER
     )
+    new_xp, new_level = updated_user['xp'], updated_user['level']
+    category_xp = updated_user['category_xp'][field]
+    # Before anything else awaits, so a board reconciled in between already has the write or gets the delta
+    record_score_change(updated_user, None, new_xp - skill.xp_value, new_xp)
+    record_score_change(updated_user, skill.category, category_xp - skill.xp_value, category_xp)
+    await record_changes([(current_user['id'], 'user_skills', user_skill['id']), (current_user['id'], 'users', current_user['id'])])
     
-    return {'message': 'Skill completed', 'xp_earned': skill['xp_value'], 'total_xp': new_xp, 'level': new_level}
+    publish_event(current_user['id'], 'skill_completed', skill_id=skill_id, xp_earned=skill.xp_value)
+    publish_xp_change({**updated_user, 'xp': new_xp - skill.xp_value, 'level': 1 + (new_xp - skill.xp_value) // 1000}, new_xp, new_level)
+    if event_broker.has_listeners(current_user['id']):
+        completed = await db.user_skills.find(
+            {'user_id': current_user['id'], 'status': 'completed'}, {'_id': 0, 'skill_id': 1, 'status': 1}
+        ).to_list(None)
+        before = build_achievements(current_user, [us for us in completed if was_completed or us['skill_id'] != skill_id], catalog)
+        after = build_achievements(updated_user, completed, catalog)
+        for old, new in zip(before, after):
+            if new['unlocked'] and not old['unlocked']:
+                publish_event(current_user['id'], 'achievement_unlocked', achievement=new)
+    
+    return {'message': 'Skill completed', 'xp_earned': skill.xp_value, 'total_xp': new_xp, 'level': new_level}
 
 # ============= LESSONS ROUTES =============
-@api_router.get("/skills/{skill_id}/lessons")
+@api_router.get("/skills/{skill_id}/lessons", response_model=List[LessonWithStatus])
+@query_budget(6)
 async def get_lessons(skill_id: str, request: Request):
     current_user = await get_current_user_from_request(request)
-    lessons = await db.lessons.find({'skill_id': skill_id}, {'_id': 0}).sort('order', 1).to_list(1000)
-    user_lessons = await db.user_lessons.find({'user_id': current_user['id']}, {'_id': 0}).to_list(1000)
-    
-    user_lesson_map = {ul['lesson_id']: ul for ul in user_lessons}
+    etag = user_etag(current_user, 'lessons', skill_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
     
-    for lesson in lessons:
-        lesson['completed'] = user_lesson_map.get(lesson['id'], {}).get('completed', False)
+    catalog = await get_catalog_with(skill_id)
+    if skill_id not in catalog.by_id:
+        raise HTTPException(status_code=404, detail="Skill not found")
+    lessons = await catalog.lessons_for(skill_id)
+    user_lessons = await db.user_lessons.find({
+        'user_id': current_user['id'],
+        'lesson_id': {'$in': [lesson.id for lesson, _ in lessons]},
+        'completed': True
+    }, {'_id': 0, 'lesson_id': 1}).to_list(None)
+    completed_ids = {ul['lesson_id'] for ul in user_lessons}
     
-    return lessons
+    return json_bytes_response(CatalogSnapshot.render_lessons(lessons, completed_ids), etag)
 
 @api_router.post("/lessons/{lesson_id}/complete")
+@idempotent
+@query_budget(12)
 async def complete_lesson(lesson_id: str, request: Request):
     current_user = await get_current_user_from_request(request)
-    lesson = await db.lessons.find_one({'id': lesson_id}, {'_id': 0})
-    if not lesson:
+    lesson = await load_one('lessons', lesson_id)
+    skill_id = lesson['skill_id'] if lesson else None
+    catalog = await get_catalog_with(skill_id) if lesson else None
+    if not lesson or skill_id not in catalog.by_id:
         raise HTTPException(status_code=404, detail="Lesson not found")
     
     existing = await db.user_lessons.find_one({'user_id': current_user['id'], 'lesson_id': lesson_id}, {'_id': 0})
@@ -378,6 +1659,7 @@ async def complete_lesson(lesson_id: str, request: Request):
             {'id': existing['id']},
             {'$set': {'completed': True, 'completed_at': datetime.now(timezone.utc).isoformat()}}
         )
+        changed = [(current_user['id'], 'user_lessons', existing['id'])]
     else:
         user_lesson_doc = {
             'id': str(uuid.uuid4()),
@@ -387,12 +1669,17 @@ async def complete_lesson(lesson_id: str, request: Request):
             'completed_at': datetime.now(timezone.utc).isoformat()
         }
         await db.user_lessons.insert_one(user_lesson_doc)
+        # The skill may have been deleted since the catalog was read, and its
+        # cascade may already be past user_lessons: if so, take the row back
+        if not await db.skills.find_one({'id': skill_id, **LIVE_SKILLS}, {'_id': 1}):
+            await db.user_lessons.delete_one({'id': user_lesson_doc['id']})
+            raise HTTPException(status_code=404, detail="Lesson not found")
+        changed = [(current_user['id'], 'user_lessons', user_lesson_doc['id'])]
     
-    skill_id = lesson['skill_id']
-    all_lessons = await db.lessons.find({'skill_id': skill_id}, {'_id': 0}).to_list(1000)
+    all_lessons = [lesson_item for lesson_item, _ in await catalog.lessons_for(skill_id)]
     completed_lessons = await db.user_lessons.find({
         'user_id': current_user['id'],
-        'lesson_id': {'$in': [lesson_item['id'] for lesson_item in all_lessons]},
+        'lesson_id': {'$in': [lesson_item.id for lesson_item in all_lessons]},
         'completed': True
     }, {'_id': 0}).to_list(1000)
     
@@ -400,10 +1687,15 @@ async def complete_lesson(lesson_id: str, request: Request):
     
     user_skill = await db.user_skills.find_one({'user_id': current_user['id'], 'skill_id': skill_id}, {'_id': 0})
     if user_skill:
+        progress_buffer.discard(current_user['id'], skill_id)
         await db.user_skills.update_one(
             {'id': user_skill['id']},
             {'$set': {'progress_percent': progress_percent}}
         )
+        changed.append((current_user['id'], 'user_skills', user_skill['id']))
+    await bump_user_version(current_user['id'])
+    await record_changes(changed)
+    publish_event(current_user['id'], 'lesson_completed', lesson_id=lesson_id, skill_id=skill_id, progress_percent=progress_percent)
     
     return {'message': 'Lesson completed', 'progress_percent': progress_percent}
 
@@ -412,7 +1704,7 @@ async def complete_lesson(lesson_id: str, request: Request):
 async def recommend_skills(request: Request):
     current_user = await get_current_user_from_request(request)
     user_skills = await db.user_skills.find({'user_id': current_user['id']}, {'_id': 0}).to_list(1000)
-    all_skills = await db.skills.find({}, {'_id': 0}).to_list(1000)
+    all_skills = await reader('catalog').skills.find(LIVE_SKILLS, {'_id': 0}).to_list(1000)
     
     completed_skills = [us['skill_id'] for us in user_skills if us['status'] == 'completed']
     in_progress_skills = [us['skill_id'] for us in user_skills if us['status'] == 'in_progress']
@@ -421,12 +1713,11 @@ async def recommend_skills(request: Request):
     in_progress_skill_names = [s['name'] for s in all_skills if s['id'] in in_progress_skills]
     
     # Use Claude Sonnet 4 for recommendations (safety/deep reasoning)
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    chat = LlmChat(
-        api_key=api_key,
+    chat = llm_chat(
+        "anthropic", "claude-3-7-sonnet-20250219",
         session_id=f"recommend_{current_user['id']}_{datetime.now(timezone.utc).timestamp()}",
         system_message="You are a learning path advisor. Analyze completed and in-progress skills, then recommend the next 3-5 skills to learn. Consider skill difficulty progression and career paths. Respond with clear recommendations and reasoning."
-    ).with_model("anthropic", "claude-3-7-sonnet-20250219")
+    )
     
     available_skills = [s for s in all_skills if s['id'] not in completed_skills and s['id'] not in in_progress_skills]
     available_skill_names = [f"{s['name']} ({s['difficulty']}, {s['category']})" for s in available_skills[:30]]
@@ -454,12 +1745,11 @@ async def generate_lesson_content(data: dict, request: Request):
     difficulty = data.get('difficulty', 'intermediate')
     
     # Use OpenAI GPT-5 for lesson content generation
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    chat = LlmChat(
-        api_key=api_key,
+    chat = llm_chat(
+        "openai", "gpt-5",
         session_id=f"lesson_{datetime.now(timezone.utc).timestamp()}",
         system_message="You are an expert instructor creating engaging, comprehensive lesson content. Include clear explanations, practical examples, code snippets when relevant, and key takeaways."
-    ).with_model("openai", "gpt-5")
+    )
     
     prompt = f"""Create a detailed lesson about '{lesson_title}' for the skill '{skill_name}' at {difficulty} level.
 
@@ -484,12 +1774,11 @@ async def generate_quiz(data: dict, request: Request):
     skill_name = data.get('skill_name', '')
     lesson_content = data.get('lesson_content', '')
     
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    chat = LlmChat(
-        api_key=api_key,
+    chat = llm_chat(
+        "gemini", "gemini-2.5-pro",
         session_id=f"quiz_{datetime.now(timezone.utc).timestamp()}",
         system_message="You are a quiz creator. Generate 5 multiple-choice questions based on lesson content. Return JSON format: [{question: string, options: [string], correct: number}]"
-    ).with_model("gemini", "gemini-2.5-pro")
+    )
     
     prompt = f"Create 5 multiple-choice questions for the skill '{skill_name}' based on this content: {lesson_content[:1000]}"
     
@@ -500,6 +1789,7 @@ async def generate_quiz(data: dict, request: Request):
 
 # ============= INTEGRATIONS ROUTES =============
 @api_router.get("/integrations")
+@query_budget(3)
 async def get_integrations(request: Request):
     current_user = await get_current_user_from_request(request)
     connections = await db.external_connections.find({'user_id': current_user['id']}, {'_id': 0}).to_list(1000)
@@ -528,6 +1818,7 @@ async def get_integrations(request: Request):
     return result
 
 @api_router.post("/integrations/github/connect")
+@idempotent
 async def connect_github(data: dict, request: Request):
     """Connect GitHub - mock with sample data for MVP"""
     current_user = await get_current_user_from_request(request)
@@ -570,6 +1861,7 @@ async def connect_github(data: dict, request: Request):
     return {'message': 'GitHub connected successfully', 'data': platform_data}
 
 @api_router.post("/integrations/linkedin/connect")
+@idempotent
 async def connect_linkedin(data: dict, request: Request):
     """Connect LinkedIn - mock with sample data for MVP"""
     current_user = await get_current_user_from_request(request)
@@ -611,6 +1903,7 @@ async def connect_linkedin(data: dict, request: Request):
     return {'message': 'LinkedIn connected successfully', 'data': platform_data}
 
 @api_router.post("/integrations/youtube/connect")
+@idempotent
 async def connect_youtube(data: dict, request: Request):
     """Connect YouTube - mock with sample data for MVP"""
     current_user = await get_current_user_from_request(request)
@@ -666,15 +1959,10 @@ async def disconnect_platform(platform: str, request: Request):
     return {'message': f'{platform} disconnected successfully'}
 
 # ============= DASHBOARD ROUTES =============
-@api_router.get("/dashboard/stats")
-async def get_dashboard_stats(request: Request):
-    current_user = await get_current_user_from_request(request)
-    user_skills = await db.user_skills.find({'user_id': current_user['id']}, {'_id': 0}).to_list(1000)
-    all_skills = await db.skills.find({}, {'_id': 0}).to_list(1000)
-    
+def build_dashboard_stats(current_user: dict, user_skills: List[dict], catalog: CatalogSnapshot) -> dict:
     completed = len([us for us in user_skills if us['status'] == 'completed'])
     in_progress = len([us for us in user_skills if us['status'] == 'in_progress'])
-    total_skills = len(all_skills)
+    total_skills = len(catalog.skills)
     
     # Get recent activity
     recent_completions = sorted(
@@ -693,18 +1981,14 @@ async def get_dashboard_stats(request: Request):
         'recent_completions': [rc['skill_id'] for rc in recent_completions]
     }
 
-@api_router.get("/achievements")
-async def get_achievements(request: Request):
-    current_user = await get_current_user_from_request(request)
-    user_skills = await db.user_skills.find({'user_id': current_user['id']}, {'_id': 0}).to_list(1000)
-    completed = len([us for us in user_skills if us['status'] == 'completed'])
+def build_achievements(current_user: dict, user_skills: List[dict], catalog: CatalogSnapshot) -> List[dict]:
+    completed_skill_ids = [us['skill_id'] for us in user_skills if us['status'] == 'completed']
+    completed = len(completed_skill_ids)
     
     # Get unique categories completed
-    all_skills = await db.skills.find({}, {'_id': 0}).to_list(1000)
-    completed_skill_ids = [us['skill_id'] for us in user_skills if us['status'] == 'completed']
-    completed_categories = set([s['category'] for s in all_skills if s['id'] in completed_skill_ids])
+    completed_categories = set([catalog.by_id[sid].category for sid in completed_skill_ids if sid in catalog.by_id])
     
-    achievements = [
+    return [
         {'id': 'first_skill', 'name': 'First Steps', 'description': 'Complete your first skill', 'icon': 'Trophy', 'unlocked': completed >= 1},
         {'id': 'three_skills', 'name': 'On a Roll', 'description': 'Complete 3 skills', 'icon': 'Award', 'unlocked': completed >= 3},
         {'id': 'five_skills', 'name': 'Rising Star', 'description': 'Complete 5 skills', 'icon': 'Star', 'unlocked': completed >= 5},
@@ -712,31 +1996,1023 @@ async def get_achievements(request: Request):
         {'id': 'level_5', 'name': 'Expert Learner', 'description': 'Reach level 5', 'icon': 'Zap', 'unlocked': current_user['level'] >= 5},
         {'id': 'three_categories', 'name': 'Jack of All Trades', 'description': 'Complete skills in 3 categories', 'icon': 'Layers', 'unlocked': len(completed_categories) >= 3},
     ]
+
+def build_activity_feed(user_skills: List[dict], catalog: CatalogSnapshot) -> List[dict]:
+    recent = sorted(
+        [us for us in user_skills if us['status'] == 'completed' and us.get('completed_at')],
+        key=lambda x: x['completed_at'],
+        reverse=True
+    )[:10]
     
-    return achievements
+    activities = []
+    for us in recent:
+        skill = catalog.by_id.get(us['skill_id'])
+        if skill:
+            activities.append({
+                'type': 'skill_completed',
+                'title': f'Completed {skill.name}',
+                'description': f'Earned {skill.xp_value} XP',
+                'timestamp': us['completed_at'],
+                'icon': 'CheckCircle'
+            })
+    return activities
+
+async def load_dashboard_data(current_user: dict) -> tuple:
+    """Load the user's skills and the catalog concurrently; every dashboard section is derived from these"""
+    user_skills, catalog = await asyncio.gather(
+        db.user_skills.find({'user_id': current_user['id']}, {'_id': 0}).to_list(None),
+        get_catalog()
+    )
+    return progress_buffer.apply(current_user['id'], user_skills), catalog
+
+@api_router.get("/dashboard")
+@query_budget(5)
+async def get_dashboard(request: Request):
+    """Stats, achievements and activity feed in one round trip"""
+    current_user = await get_current_user_from_request(request)
+    user_skills, catalog = await load_dashboard_data(current_user)
+    return {
+        'stats': build_dashboard_stats(current_user, user_skills, catalog),
+        'achievements': build_achievements(current_user, user_skills, catalog),
+        'activity_feed': build_activity_feed(user_skills, catalog)
+    }
+
+@api_router.get("/dashboard/stats")
+@query_budget(5)
+async def get_dashboard_stats(request: Request):
+    current_user = await get_current_user_from_request(request)
+    user_skills, catalog = await load_dashboard_data(current_user)
+    return build_dashboard_stats(current_user, user_skills, catalog)
+
+@api_router.get("/achievements")
+@query_budget(5)
+async def get_achievements(request: Request):
+    current_user = await get_current_user_from_request(request)
+    user_skills, catalog = await load_dashboard_data(current_user)
+    return build_achievements(current_user, user_skills, catalog)
 
 @api_router.get("/activity-feed")
+@query_budget(5)
 async def get_activity_feed(request: Request):
     current_user = await get_current_user_from_request(request)
-    user_skills = await db.user_skills.find(
-        {'user_id': current_user['id'], 'status': 'completed'}, 
-        {'_id': 0}
-    ).sort('completed_at', -1).limit(10).to_list(10)
-    
-    activities = []
-    for us in user_skills:
-        if us.get('completed_at'):
-            skill = await db.skills.find_one({'id': us['skill_id']}, {'_id': 0})
-            if skill:
-                activities.append({
-                    'type': 'skill_completed',
-                    'title': f'Completed {skill["name"]}',
-                    'description': f'Earned {skill["xp_value"]} XP',
-                    'timestamp': us['completed_at'],
-                    'icon': 'CheckCircle'
-                })
+    user_skills, catalog = await load_dashboard_data(current_user)
+    return build_activity_feed(user_skills, catalog)
+
+# ============= LEADERBOARD =============
+# Every board (global, or one per category) keeps its top entries sorted in
+# memory and a histogram of all positive scores as a Fenwick tree, so the top
+# N is a slice and a rank is one prefix sum. Both follow XP changes made in
+# this process and are reconciled against Mongo every
+# LEADERBOARD_RECONCILE_SECONDS, which also picks up other workers' changes.
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 100))
+LEADERBOARD_RECONCILE_SECONDS = int(os.environ.get('LEADERBOARD_RECONCILE_SECONDS', 60))
+LEADERBOARD_PROFILE = {'_id': 0, 'id': 1, 'name': 1, 'picture': 1, 'xp': 1, 'level': 1, 'category_xp': 1}
+
+def category_field(category: str) -> str:
+    """Key of a category in users.category_xp; field names cannot contain '.' or start with '$'"""
+    return category.replace('.', '_').lstrip('$') or '_'
+
+class XpHistogram:
+    """Number of users at each score, with O(log max score) counts of users scoring higher"""
+
+    def __init__(self, counts: Optional[Dict[int, int]] = None):
+        self.counts = dict(counts or {})
+        self.total = sum(self.counts.values())
+        self._build(max(self.counts, default=0))
+
+    def _build(self, max_score: int):
+        size = 1024
+        while size <= max_score + 1:
+            size *= 2
+        tree = array('q', [0]) * (size + 1)
+        for score, n in self.counts.items():
+            tree[score + 1] += n
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def add(self, score: int, n: int = 1):
+        count = self.counts.get(score, 0) + n
+        if count:
+            self.counts[score] = count
+        else:
+            self.counts.pop(score, None)
+        self.total += n
+        if score + 1 >= len(self.tree):
+            self._build(score)
+            return
+        i = score + 1
+        while i < len(self.tree):
+            self.tree[i] += n
+            i += i & -i
+
+    def count_above(self, score: int) -> int:
+        i = min(score + 1, len(self.tree) - 1)
+        at_or_below = 0
+        while i > 0:
+            at_or_below += self.tree[i]
+            i -= i & -i
+        return self.total - at_or_below
+
+class TopEntries:
+    """The best `capacity` users of a board, sorted by (score desc, id).
+
+    While full, the list is exactly the top users: anyone outside it scores no
+    more than its last entry. A member falling out leaves the exact top
+    len - 1, so nobody outside is admitted until a reconcile unless they beat
+    the last entry or the list is known to hold every scored user.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.keys = []  # sorted (-score, user id)
+        self.entries = {}  # user id -> entry
+        self.complete = True  # holds every user with a positive score
+
+    def reset(self, entries: List[dict], complete: bool):
+        self.entries = {entry['user_id']: entry for entry in entries}
+        self.keys = sorted((-entry['xp'], entry['user_id']) for entry in entries)
+        self.complete = complete
+
+    def update(self, entry: dict):
+        user_id = entry['user_id']
+        old = self.entries.pop(user_id, None)
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old['xp'], user_id))]
+        key = (-entry['xp'], user_id)
+        if entry['xp'] <= 0 or not (self.complete or (self.keys and key < self.keys[-1])):
+            return
+        bisect.insort(self.keys, key)
+        self.entries[user_id] = entry
+        if len(self.keys) > self.capacity:
+            _, dropped = self.keys.pop()
+            del self.entries[dropped]
+            self.complete = False
+
+    def first(self, n: int) -> List[dict]:
+        return [self.entries[user_id] for _, user_id in self.keys[:n]]
+
+class Leaderboard:
+    def __init__(self, category: Optional[str] = None):
+        self.category = category
+        self.field = f'category_xp.{category_field(category)}' if category else 'xp'
+        self.top = TopEntries(LEADERBOARD_SIZE * 2)  # headroom so falling members rarely force a reload
+        self.histogram = XpHistogram()
+        self.reconciled_at = None
+        self.lock = asyncio.Lock()
+
+    def score(self, user: dict) -> int:
+        if self.category:
+            return user.get('category_xp', {}).get(category_field(self.category), 0)
+        return user.get('xp', 0)
+
+    def entry(self, user: dict, score: int) -> dict:
+        return {'user_id': user['id'], 'name': user['name'], 'picture': user.get('picture'), 'level': user.get('level', 1), 'xp': score}
+
+    def rank(self, score: int) -> Optional[int]:
+        return self.histogram.count_above(score) + 1 if score > 0 else None
+
+    def ranked(self, entries: List[dict]) -> List[dict]:
+        return [{'rank': self.rank(entry['xp']), **entry} for entry in entries]
+
+    def record(self, user: dict, old_score: int, new_score: int):
+        if old_score > 0:
+            self.histogram.add(old_score, -1)
+        if new_score > 0:
+            self.histogram.add(new_score)
+        self.top.update(self.entry(user, new_score))
+
+    def needs_reload(self, limit: int) -> bool:
+        return self.reconciled_at is None or (len(self.top.keys) < limit and not self.top.complete)
+
+    async def reconcile(self):
+        async with self.lock:
+            scored = {self.field: {'$gt': 0}}
+            # From the primary: deltas recorded after a write are applied on top of this, and a
+            # secondary without that write would have them move users out of buckets they are not in
+            users = await db.users.find(scored, LEADERBOARD_PROFILE).sort(
+                [(self.field, -1), ('id', 1)]
+            ).limit(self.top.capacity).to_list(None)
+            counts = await db.users.aggregate([
+                {'$match': scored},
+                {'$group': {'_id': f'${self.field}', 'n': {'$sum': 1}}}
+            ]).to_list(None)
+            self.top.reset([self.entry(user, self.score(user)) for user in users], len(users) < self.top.capacity)
+            self.histogram = XpHistogram({count['_id']: count['n'] for count in counts})
+            self.reconciled_at = time.monotonic()
+
+    async def neighbors(self, user: dict, score: int, count: int):
+        """Up to `count` users ranked just above and just below `user`"""
+        if score <= 0 or count <= 0:
+            return [], []
+        field, user_id = self.field, user['id']
+        above = await db.users.find(
+            {'$or': [{field: {'$gt': score}}, {field: score, 'id': {'$lt': user_id}}]}, LEADERBOARD_PROFILE
+        ).sort([(field, 1), ('id', -1)]).limit(count).to_list(None)
+        below = await db.users.find(
+            {'$or': [{field: {'$lt': score, '$gt': 0}}, {field: score, 'id': {'$gt': user_id}}]}, LEADERBOARD_PROFILE
+        ).sort([(field, -1), ('id', 1)]).limit(count).to_list(None)
+        return (
+            self.ranked([self.entry(u, self.score(u)) for u in reversed(above)]),
+            self.ranked([self.entry(u, self.score(u)) for u in below])
+        )
+
+leaderboards = {}  # category (None for global) -> Leaderboard
+leaderboard_state = {'task': None}
+
+async def get_leaderboard_board(category: Optional[str], limit: int) -> Leaderboard:
+    board = leaderboards.get(category)
+    if board is None:
+        board = leaderboards.setdefault(category, Leaderboard(category))
+    if board.needs_reload(limit):
+        await board.reconcile()
+    return board
+
+def record_score_change(user: dict, category: Optional[str], old_score: int, new_score: int):
+    """Apply an XP change to the board if this process has it loaded; otherwise its first load reads it"""
+    board = leaderboards.get(category)
+    if board is not None and board.reconciled_at is not None and old_score != new_score:
+        board.record(user, old_score, new_score)
+
+async def backfill_category_xp():
+    """Give users who predate users.category_xp their per-category totals, leaving xp and level as they are.
+
+    Completions add to category_xp whether or not a user has been backfilled,
+    so the totals are recomputed from user_skills and replace whatever is
+    there, which makes a pass safe to repeat. Each user's totals are only
+    written if their cache_version is still the one read before their
+    completions were: a skill completed in between leaves the user for the
+    next pass, which counts it.
+    """
+    while True:
+        users = await db.users.find(
+            {'category_xp_backfilled': {'$exists': False}}, {'_id': 0, 'id': 1, 'cache_version': 1}
+        ).limit(CASCADE_CHUNK_SIZE).to_list(None)
+        if not users:
+            return
+        totals = await category_totals([user['id'] for user in users])
+        await db.users.bulk_write([
+            UpdateOne(
+                {'id': user['id'], 'cache_version': user.get('cache_version')},
+                {'$set': {'category_xp': totals[user['id']], 'category_xp_backfilled': True}, '$inc': {'cache_version': 1}}
+            )
+            for user in users
+        ], ordered=False)
+        await record_changes([(user['id'], 'users', user['id']) for user in users])
+
+async def maintain_leaderboards():
+    try:
+        await backfill_category_xp()
+    except Exception as e:
+        logger.error(f"category_xp backfill failed: {e}")
+    while True:
+        await asyncio.sleep(LEADERBOARD_RECONCILE_SECONDS)
+        for board in list(leaderboards.values()):
+            try:
+                await board.reconcile()
+            except Exception as e:
+                logger.error(f"Leaderboard reconcile failed for {board.category or 'global'}: {e}")
+
+@api_router.get("/leaderboard")
+@query_budget(8)
+async def get_leaderboard(request: Request, category: Optional[str] = None, limit: int = 10, neighbors: int = 2):
+    """Top users overall or in one category, plus the caller's rank and the users around them"""
+    current_user = await get_current_user_from_request(request)
+    limit = max(1, min(limit, LEADERBOARD_SIZE))
+    if category is not None:
+        catalog = await get_catalog()
+        if not any(skill.category == category for skill in catalog.skills):
+            raise HTTPException(status_code=404, detail="Category not found")
     
-    return activities
+    board = await get_leaderboard_board(category, limit)
+    score = board.score(current_user)
+    above, below = await board.neighbors(current_user, score, max(0, min(neighbors, 10)))
+    return {
+        'category': category,
+        'top': board.ranked(board.top.first(limit)),
+        'me': {'rank': board.rank(score), **board.entry(current_user, score)},
+        'above': above,
+        'below': below,
+        'ranked_users': board.histogram.total
+    }
+
+# ============= SEARCH =============
+# Skills and lessons are searched through an inverted index held in memory:
+# BM25 over field-weighted term frequencies, with the last word of a query
+# also matched as a prefix for autocomplete. Postings are numpy arrays so a
+# query is a handful of vectorized operations. The index is built once in the
+# background and then kept current by the admin writes that change content;
+# removed documents are masked out and compacted away in bulk.
+SEARCH_FIELDS = {
+    'skill': {'name': 3.0, 'category': 2.0, 'description': 1.0},
+    'lesson': {'title': 2.0, 'content': 1.0}
+}
+SEARCH_KINDS = list(SEARCH_FIELDS)
+SEARCH_STOPWORDS = frozenset('a an and are as at be by for from how in is it of on or that the this to with'.split())
+SEARCH_MIN_PREFIX = 2
+SEARCH_PREFIX_TERMS = 32  # most frequent completions of a prefix that are scored
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+EMPTY_DOCS = np.zeros(0, np.int32)
+EMPTY_WEIGHTS = np.zeros(0, np.float32)
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in SEARCH_STOPWORDS]
+
+class SearchIndex:
+    def __init__(self):
+        self.term_ids = {}  # term -> term id
+        self.terms = []  # every term, sorted when terms_sorted
+        self.terms_sorted = True
+        self.postings = []  # term id -> [doc ids, weights, pending doc ids, pending weights, impacts, their average length]
+        self.df = []  # term id -> live documents containing it
+        self.docs = []  # doc id -> result fields, None once removed
+        self.forward = []  # doc id -> (term ids, weights), None once removed
+        self.by_key = {}  # (kind, id) -> doc id
+        self.lessons_by_skill = {}  # skill id -> lesson ids
+        self.lengths = np.zeros(1024, np.float32)
+        self.kinds = np.zeros(1024, np.int8)
+        self.live = np.zeros(1024, bool)
+        self.live_count = 0
+        self.total_length = 0.0
+        self.dead = 0
+
+    def _term_id(self, term: str, bulk: bool) -> int:
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.postings)
+            self.postings.append([EMPTY_DOCS, EMPTY_WEIGHTS, [], [], None, 0.0])
+            self.df.append(0)
+            if bulk:
+                self.terms.append(term)
+                self.terms_sorted = False
+            else:
+                bisect.insort(self.terms, term)
+        return term_id
+
+    def _grow(self, size: int):
+        if size > len(self.lengths):
+            capacity = max(size, 2 * len(self.lengths))
+            for name in ('lengths', 'kinds', 'live'):
+                old = getattr(self, name)
+                grown = np.zeros(capacity, old.dtype)
+                grown[:len(old)] = old
+                setattr(self, name, grown)
+
+    def add(self, kind: str, key: str, fields: dict, result: dict, bulk: bool = False):
+        """Index (or re-index) one document; with bulk=True postings wait for finish_bulk()"""
+        self.remove(kind, key)
+        weights = {}
+        length = 0.0
+        for field, weight in SEARCH_FIELDS[kind].items():
+            tokens = tokenize(fields.get(field) or '')
+            length += weight * len(tokens)
+            for token in tokens:
+                weights[token] = weights.get(token, 0.0) + weight
+        doc = len(self.docs)
+        self._grow(doc + 1)
+        term_ids = np.fromiter((self._term_id(term, bulk) for term in weights), np.int32, len(weights))
+        term_weights = np.fromiter(weights.values(), np.float32, len(weights))
+        for term_id, weight in zip(term_ids.tolist(), term_weights.tolist()):
+            self.df[term_id] += 1
+            if not bulk:
+                self.postings[term_id][2].append(doc)
+                self.postings[term_id][3].append(weight)
+        self.docs.append(result)
+        self.forward.append((term_ids, term_weights))
+        self.lengths[doc] = length
+        self.kinds[doc] = SEARCH_KINDS.index(kind)
+        self.live[doc] = True
+        self.live_count += 1
+        self.total_length += length
+        self.by_key[(kind, key)] = doc
+        if kind == 'lesson':
+            self.lessons_by_skill.setdefault(result['skill_id'], set()).add(key)
+
+    def add_skill(self, skill: dict, bulk: bool = False):
+        result = {'type': 'skill', 'id': skill['id'], 'title': skill['name'], 'skill_id': skill['id'], 'category': skill['category']}
+        self.add('skill', skill['id'], skill, result, bulk)
+
+    def add_lesson(self, lesson: dict, bulk: bool = False):
+        result = {'type': 'lesson', 'id': lesson['id'], 'title': lesson['title'], 'skill_id': lesson['skill_id']}
+        self.add('lesson', lesson['id'], lesson, result, bulk)
+
+    def remove(self, kind: str, key: str):
+        doc = self.by_key.pop((kind, key), None)
+        if doc is None:
+            return
+        for term_id in self.forward[doc][0].tolist():
+            self.df[term_id] -= 1
+        if kind == 'lesson':
+            self.lessons_by_skill.get(self.docs[doc]['skill_id'], set()).discard(key)
+        self.live[doc] = False
+        self.live_count -= 1
+        self.total_length -= float(self.lengths[doc])
+        self.docs[doc] = None
+        self.forward[doc] = None
+        self.dead += 1
+        if self.dead > 1000 and self.dead > self.live_count // 4:
+            self.compact()
+
+    def remove_skill(self, skill_id: str):
+        for lesson_id in list(self.lessons_by_skill.pop(skill_id, ())):
+            self.remove('lesson', lesson_id)
+        self.remove('skill', skill_id)
+
+    def finish_bulk(self):
+        self._rebuild_postings()
+
+    def compact(self):
+        """Renumber the live documents densely and rebuild postings without the removed ones"""
+        keep = [doc for doc, result in enumerate(self.docs) if result is not None]
+        renumber = {old: new for new, old in enumerate(keep)}
+        self.docs = [self.docs[doc] for doc in keep]
+        self.forward = [self.forward[doc] for doc in keep]
+        for name in ('lengths', 'kinds', 'live'):
+            old = getattr(self, name)
+            compacted = np.zeros(max(1024, len(keep)), old.dtype)
+            compacted[:len(keep)] = old[keep]
+            setattr(self, name, compacted)
+        self.by_key = {key: renumber[doc] for key, doc in self.by_key.items()}
+        self.dead = 0
+        self._rebuild_postings()
+
+    def _rebuild_postings(self):
+        live = [doc for doc, entry in enumerate(self.forward) if entry is not None]
+        if live:
+            term_ids = np.concatenate([self.forward[doc][0] for doc in live])
+            weights = np.concatenate([self.forward[doc][1] for doc in live])
+            docs = np.repeat(np.array(live, np.int32), [len(self.forward[doc][0]) for doc in live])
+            order = np.argsort(term_ids, kind='stable')
+            term_ids, weights, docs = term_ids[order], weights[order], docs[order]
+            bounds = np.searchsorted(term_ids, np.arange(len(self.postings) + 1)).tolist()
+        else:
+            weights, docs, bounds = EMPTY_WEIGHTS, EMPTY_DOCS, [0] * (len(self.postings) + 1)
+        self.postings = [
+            [docs[bounds[t]:bounds[t + 1]], weights[bounds[t]:bounds[t + 1]], [], [], None, 0.0]
+            for t in range(len(self.postings))
+        ]
+
+    def _posting(self, term_id: int, average_length: float):
+        """Doc ids and BM25 term-frequency factors of a term; the factors are cached until the average length drifts"""
+        posting = self.postings[term_id]
+        if posting[2]:
+            posting[0] = np.concatenate([posting[0], np.array(posting[2], np.int32)])
+            posting[1] = np.concatenate([posting[1], np.array(posting[3], np.float32)])
+            posting[2], posting[3], posting[4] = [], [], None
+        if posting[4] is None or abs(posting[5] - average_length) > 0.02 * average_length:
+            docs, weights = posting[0], posting[1]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[docs] / average_length)
+            posting[4] = weights * (BM25_K1 + 1) / (weights + norm)
+            posting[5] = average_length
+        return posting[0], posting[4]
+
+    def completions(self, prefix: str) -> List[int]:
+        """Ids of the most frequent live terms starting with `prefix`"""
+        if not self.terms_sorted:
+            self.terms.sort()
+            self.terms_sorted = True
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + '\uffff', start)
+        term_ids = [self.term_ids[term] for term in self.terms[start:end]]
+        term_ids = [term_id for term_id in term_ids if self.df[term_id] > 0]
+        if len(term_ids) > SEARCH_PREFIX_TERMS:
+            term_ids = sorted(term_ids, key=lambda term_id: -self.df[term_id])[:SEARCH_PREFIX_TERMS]
+        return term_ids
+
+    def search(self, query: str, limit: int = 20, kind: Optional[str] = None, prefix: bool = True) -> List[dict]:
+        words = TOKEN_RE.findall(query.lower())
+        if not words or not self.live_count:
+            return []
+        partial = None
+        if prefix and not query[-1].isspace() and len(words[-1]) >= SEARCH_MIN_PREFIX:
+            partial = words.pop()
+        groups = [[self.term_ids[word]] for word in dict.fromkeys(words) if word in self.term_ids and word not in SEARCH_STOPWORDS]
+        if partial:
+            groups.append(self.completions(partial))
+
+        size = len(self.docs)
+        scores = np.zeros(size, np.float32)
+        n = self.live_count
+        average_length = (self.total_length / n) or 1.0
+        for group in groups:
+            # A prefix counts once per document, through its best completion
+            best = scores if len(group) == 1 else np.zeros(size, np.float32)
+            for term_id in group:
+                df = self.df[term_id]
+                if df <= 0:
+                    continue
+                docs, impacts = self._posting(term_id, average_length)
+                contribution = math.log(1 + (n - df + 0.5) / (df + 0.5)) * impacts
+                if best is scores:
+                    scores[docs] += contribution
+                else:
+                    best[docs] = np.maximum(best[docs], contribution)
+            if best is not scores:
+                scores += best
+        if self.dead:
+            scores *= self.live[:size]
+        if kind in SEARCH_KINDS:
+            scores *= self.kinds[:size] == SEARCH_KINDS.index(kind)
+
+        hits = np.flatnonzero(scores > 0)
+        if len(hits) > limit:
+            hits = hits[np.argpartition(-scores[hits], limit - 1)[:limit]]
+        hits = sorted(hits.tolist(), key=lambda doc: (-scores[doc], doc))
+        return [{**self.docs[doc], 'score': round(float(scores[doc]), 4)} for doc in hits]
+
+search_state = {'index': None, 'task': None}
+
+async def build_search_index() -> SearchIndex:
+    while True:
+        version = cache_versions['catalog']
+        index = SearchIndex()
+        catalog_db = db  # rebuilt after catalog writes, which a secondary may not have yet
+        async for skill in catalog_db.skills.find(LIVE_SKILLS, {'_id': 0, 'id': 1, 'name': 1, 'category': 1, 'description': 1}):
+            index.add_skill(skill, bulk=True)
+        indexed = 0
+        async for lesson in catalog_db.lessons.find({}, {'_id': 0, 'id': 1, 'skill_id': 1, 'title': 1, 'content': 1}):
+            if ('skill', lesson['skill_id']) in index.by_key:
+                index.add_lesson(lesson, bulk=True)
+                indexed += 1
+                if indexed % 500 == 0:
+                    await asyncio.sleep(0)  # let requests through while a large catalog is tokenized
+        index.finish_bulk()
+        # Writes that landed mid-build bumped the version and may be missing: go again
+        if version == cache_versions['catalog']:
+            logger.info(f"Search index built: {index.live_count} documents, {len(index.postings)} terms")
+            return index
+
+async def get_search_index() -> SearchIndex:
+    if search_state['index'] is None:
+        if search_state['task'] is None:
+            search_state['task'] = asyncio.create_task(build_search_index())
+        try:
+            search_state['index'] = await asyncio.shield(search_state['task'])
+        except Exception:
+            search_state['task'] = None
+            raise
+    return search_state['index']
+
+def rebuild_search_index():
+    """Rebuild in the background after another worker changed the catalog; the current index serves until then"""
+    task = search_state['task']
+    if search_state['index'] is None or (task is not None and not task.done()):
+        return  # the build in progress starts over on its own when the version moves under it
+    search_state['task'] = asyncio.create_task(replace_search_index())
+
+async def replace_search_index():
+    try:
+        search_state['index'] = await build_search_index()
+    except Exception as e:
+        logger.error(f"Search index rebuild failed: {e}")
+
+def index_catalog_document(collection: str, doc: dict):
+    """Reflect an added or replaced skill or lesson in the search index, once it is built"""
+    index = search_state['index']
+    if index is not None:
+        if collection == 'skills':
+            index.add_skill(doc)
+        else:
+            index.add_lesson(doc)
+
+def unindex_lesson(lesson_id: str):
+    if search_state['index'] is not None:
+        search_state['index'].remove('lesson', lesson_id)
+
+def unindex_skill(skill_id: str):
+    if search_state['index'] is not None:
+        search_state['index'].remove_skill(skill_id)
+
+@api_router.get("/search")
+@query_budget(3)
+async def search(request: Request, q: str, limit: int = 20, type: Optional[str] = None, prefix: bool = True):
+    """Ranked skills and lessons matching `q`; the last word also matches as a prefix unless prefix=false"""
+    await get_current_user_from_request(request)
+    index = await get_search_index()
+    return {'query': q, 'results': index.search(q, limit=max(1, min(limit, 100)), kind=type, prefix=prefix)}
+
+# ============= CHANGE SEQUENCE =============
+# Every write to a synced document records (scope, collection, id) in the
+# changes collection under a sequence number taken from one atomic counter.
+# There is one row per document, holding its latest sequence number and a
+# deleted flag, so rows double as tombstones. Catalog documents share the
+# 'catalog' scope; progress is scoped to its user. A client keeps the highest
+# sequence it has seen and asks /api/sync for everything after it.
+#
+# Sequence numbers are taken before their rows are written, so a reader could
+# see 12 before 11 lands and move past 11. Each batch therefore registers
+# itself in the counter document, in the same update that takes its numbers,
+# and unregisters once its rows are written. /api/sync reads the counter first
+# and stops below the oldest batch still registered, whichever worker wrote
+# it. A registration only carries a lower bound on its numbers (the highest
+# number its worker had seen, plus one), which may hold readers back further
+# than needed but never too little. A batch registered for longer than
+# SYNC_PENDING_SECONDS is taken to belong to a dead worker and ignored.
+CATALOG_SCOPE = 'catalog'
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 500))
+SYNC_PENDING_SECONDS = int(os.environ.get('SYNC_PENDING_SECONDS', 60))
+CHANGES_COUNTER_ID = 'changes'
+SYNC_PROJECTIONS = {
+    'skills': {'_id': 0},
+    'lessons': {'_id': 0},
+    'user_skills': {'_id': 0},
+    'user_lessons': {'_id': 0},
+    'users': {'_id': 0, 'id': 1, 'email': 1, 'name': 1, 'picture': 1, 'xp': 1, 'level': 1, 'category_xp': 1},
+}
+sequence_state = {'seen': 0}  # highest sequence number this process knows was taken
+
+def settled_sequence(counter: Optional[dict]) -> int:
+    """The highest sequence number up to which every row is written, given the counter document"""
+    if counter is None:
+        return 0
+    sequence_state['seen'] = max(sequence_state['seen'], counter['seq'])
+    live = time.time() - SYNC_PENDING_SECONDS
+    floors = [batch['floor'] for batch in counter.get('pending', {}).values() if batch['at'] >= live]
+    return min(floors) - 1 if floors else counter['seq']
+
+async def record_changes(changes: List[tuple], deleted: bool = False):
+    """Give each (scope, collection, id) in `changes` the next sequence number"""
+    changes = list(dict.fromkeys(changes))
+    if not changes:
+        return
+    batch = uuid.uuid4().hex
+    counter = await db.counters.find_one_and_update(
+        {'_id': CHANGES_COUNTER_ID},
+        {'$inc': {'seq': len(changes)}, '$set': {f'pending.{batch}': {'floor': sequence_state['seen'] + 1, 'at': time.time()}}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    sequence_state['seen'] = max(sequence_state['seen'], counter['seq'])
+    first = counter['seq'] - len(changes) + 1
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.changes.bulk_write([
+            # The seq condition keeps a slower writer from replacing a newer number; it then trips the unique index
+            UpdateOne(
+                {'collection': collection, 'doc_id': doc_id, 'seq': {'$lt': first + i}},
+                {'$set': {'scope': scope, 'seq': first + i, 'deleted': deleted, 'changed_at': now}},
+                upsert=True
+            )
+            for i, (scope, collection, doc_id) in enumerate(changes)
+        ], ordered=False)
+    except BulkWriteError as e:
+        if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+            raise
+    finally:
+        # Also clear out registrations left behind by dead workers
+        expired = [other for other, pending in counter.get('pending', {}).items() if pending['at'] < time.time() - SYNC_PENDING_SECONDS]
+        await db.counters.update_one({'_id': CHANGES_COUNTER_ID}, {'$unset': {f'pending.{key}': '' for key in [batch, *expired]}})
+
+@api_router.get("/sync")
+@query_budget(9)
+async def sync(request: Request, since: int = 0, limit: int = SYNC_PAGE_SIZE):
+    """Catalog documents and the caller's progress changed after sequence number `since`, oldest first"""
+    current_user = await get_current_user_from_request(request)
+    limit = max(1, min(limit, SYNC_PAGE_SIZE))
+    settled = settled_sequence(await db.counters.find_one({'_id': CHANGES_COUNTER_ID}))
+    query = {'scope': {'$in': [CATALOG_SCOPE, current_user['id']]}, 'seq': {'$gt': since, '$lte': settled}}
+    rows = await db.changes.find(query, {'_id': 0}).sort('seq', 1).limit(limit + 1).to_list(None)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    wanted = defaultdict(list)
+    for row in rows:
+        if not row['deleted']:
+            wanted[row['collection']].append(row['doc_id'])
+    docs = {}
+    for collection, ids in wanted.items():
+        query = {'id': {'$in': ids}}
+        if collection in ('user_skills', 'user_lessons'):
+            query['user_id'] = current_user['id']
+        found = await db[collection].find(query, SYNC_PROJECTIONS[collection]).to_list(None)
+        if collection == 'user_skills':
+            found = progress_buffer.apply(current_user['id'], found)
+        for doc in found:
+            docs[(collection, doc['id'])] = doc
+
+    changes = []
+    for row in rows:
+        doc = docs.get((row['collection'], row['doc_id']))
+        if row['collection'] == 'skills' and doc and doc.get('deleted'):
+            doc = None  # tombstoned but the row predates it
+        changes.append({
+            'seq': row['seq'], 'collection': row['collection'], 'id': row['doc_id'],
+            'deleted': doc is None, 'doc': doc
+        })
+    return {'since': since, 'seq': rows[-1]['seq'] if rows else since, 'more': more, 'changes': changes}
+
+# ============= EVENT PUSH =============
+# Write paths publish small per-user events (skill started or completed, XP
+# and level, achievements, admin generation results) and /api/events pushes
+# them over a WebSocket, so clients stop polling to find out. Publishing never
+# waits: the in-process hub hands each event to the user's open sockets.
+# With several workers a socket may live in another process, so events also
+# go through a broker: EVENT_BROKER=mongo relays them through a capped
+# collection that every worker tails. Workers also announce there which users
+# have sockets open with them, so any worker can tell whether an event would
+# reach anyone. Events are hints to refresh; /api/sync stays the source of
+# truth after a reconnect.
+EVENT_QUEUE_SIZE = 100
+EVENT_PING_SECONDS = int(os.environ.get('EVENT_PING_SECONDS', 30))
+EVENT_PRESENCE_SECONDS = int(os.environ.get('EVENT_PRESENCE_SECONDS', 30))
+EVENT_LOG_BYTES = 16 * 1024 * 1024
+EVENT_TAIL_RETRY_SECONDS = 1
+EVENT_SUBPROTOCOL = 'bearer'
+
+class EventHub:
+    """Open event sockets of this process, by user"""
+    def __init__(self):
+        self.subscribers = defaultdict(set)  # user id -> queues of that user's sockets
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        self.subscribers[user_id].discard(queue)
+        if not self.subscribers[user_id]:
+            del self.subscribers[user_id]
+
+    def deliver(self, user_id: str, event: dict):
+        for queue in self.subscribers.get(user_id, ()):
+            if queue.full():
+                # A socket this far behind gets one event telling it to resync instead of a backlog
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({'type': 'resync', 'at': event['at']})
+            else:
+                queue.put_nowait(event)
+
+event_hub = EventHub()
+
+class LocalEventBroker:
+    """Delivers events to this process's sockets only; enough for a single worker"""
+    def has_listeners(self, user_id: str) -> bool:
+        return user_id in event_hub.subscribers
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        return event_hub.subscribe(user_id)
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        event_hub.unsubscribe(user_id, queue)
+
+    def publish(self, user_id: str, event: dict):
+        event_hub.deliver(user_id, event)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+class MongoEventBroker(LocalEventBroker):
+    """Relays events between workers through a capped collection each worker tails"""
+    def __init__(self, collection: str = 'event_log'):
+        self.collection = collection
+        self.outbox = asyncio.Queue()
+        self.tasks = []
+        self.remote = {}  # other worker's BOOT_ID -> (ids of users with sockets there, time.monotonic() of its last snapshot)
+
+    def has_listeners(self, user_id: str) -> bool:
+        if user_id in event_hub.subscribers:
+            return True
+        live = time.monotonic() - 3 * EVENT_PRESENCE_SECONDS  # a worker that stopped announcing is gone
+        return any(user_id in users and seen >= live for users, seen in self.remote.values())
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        if user_id not in event_hub.subscribers:
+            self.outbox.put_nowait({'presence': {'add': [user_id]}, 'origin': BOOT_ID})
+        return super().subscribe(user_id)
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        super().unsubscribe(user_id, queue)
+        if user_id not in event_hub.subscribers:
+            self.outbox.put_nowait({'presence': {'remove': [user_id]}, 'origin': BOOT_ID})
+
+    def publish(self, user_id: str, event: dict):
+        super().publish(user_id, event)
+        self.outbox.put_nowait({'user_id': user_id, 'event': event, 'origin': BOOT_ID})
+
+    def receive(self, doc: dict):
+        """Apply a document another worker wrote to the event log"""
+        if 'presence' not in doc:
+            event_hub.deliver(doc['user_id'], doc['event'])
+            return
+        presence = doc['presence']
+        users, seen = self.remote.get(doc['origin'], (set(), time.monotonic()))
+        if 'all' in presence:
+            users, seen = set(presence['all']), time.monotonic()
+        users = (users | set(presence.get('add', ()))) - set(presence.get('remove', ()))
+        self.remote[doc['origin']] = (users, seen)
+
+    async def announce(self):
+        """Send the full set of this worker's listening users now and then, so other workers converge and expire it"""
+        while True:
+            self.outbox.put_nowait({'presence': {'all': sorted(event_hub.subscribers)}, 'origin': BOOT_ID})
+            await asyncio.sleep(EVENT_PRESENCE_SECONDS)
+
+    async def start(self):
+        try:
+            await db.create_collection(self.collection, capped=True, size=EVENT_LOG_BYTES)
+        except CollectionInvalid:
+            pass  # created by another worker
+        self.tasks = [asyncio.create_task(self.send()), asyncio.create_task(self.tail()), asyncio.create_task(self.announce())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def send(self):
+        while True:
+            batch = [await self.outbox.get()]
+            while not self.outbox.empty() and len(batch) < 100:
+                batch.append(self.outbox.get_nowait())
+            try:
+                await db[self.collection].insert_many(batch)
+            except Exception as e:
+                logger.error(f"Could not relay {len(batch)} events: {e}")
+
+    async def tail(self):
+        query = None  # until the end of the log is known
+        while True:
+            try:
+                if query is None:
+                    newest = await db[self.collection].find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+                    query = {'_id': {'$gt': newest['_id']}} if newest else {}
+                async for doc in db[self.collection].find(query, cursor_type=CursorType.TAILABLE_AWAIT):
+                    query = {'_id': {'$gt': doc['_id']}}
+                    if doc['origin'] != BOOT_ID:
+                        self.receive(doc)
+            except Exception as e:
+                logger.error(f"Event log cursor failed: {e}")
+            await asyncio.sleep(EVENT_TAIL_RETRY_SECONDS)  # a tailable cursor on an empty collection dies at once
+
+EVENT_BROKERS = {'local': LocalEventBroker, 'mongo': MongoEventBroker}
+event_broker = EVENT_BROKERS[os.environ.get('EVENT_BROKER', 'local')]()
+
+def publish_event(user_id: str, event_type: str, **data):
+    event_broker.publish(user_id, {'type': event_type, 'at': datetime.now(timezone.utc).isoformat(), **data})
+
+def publish_xp_change(user: dict, xp: int, level: int):
+    if xp != user.get('xp', 0):
+        publish_event(user['id'], 'xp_changed', xp=xp, level=level, level_up=level > user.get('level', 1))
+
+@api_router.websocket("/events")
+async def event_socket(websocket: WebSocket):
+    """The caller's events as JSON messages.
+
+    Browsers cannot set headers on a WebSocket, so they pass their JWT as a
+    subprotocol, `new WebSocket(url, ['bearer', token])`, which keeps it out
+    of URLs and access logs. The server answers with the `bearer` subprotocol.
+    """
+    protocols = websocket.scope.get('subprotocols') or []
+    bearer = len(protocols) == 2 and protocols[0] == EVENT_SUBPROTOCOL
+    try:
+        if bearer:
+            current_user = await load_one('users', decode_token(protocols[1])['user_id'])
+        else:
+            current_user = await get_current_user_from_request(websocket)
+    except HTTPException:
+        current_user = None
+    if not current_user:
+        await websocket.close(code=4401)
+        return
+
+    user_id = current_user['id']
+    queue = event_broker.subscribe(user_id)
+    receiver = getter = None
+    try:
+        await websocket.accept(subprotocol=EVENT_SUBPROTOCOL if bearer else None)
+        await websocket.send_json({'type': 'ready', 'user_id': user_id})
+        receiver = asyncio.create_task(websocket.receive())  # only a disconnect is expected from the client
+        getter = asyncio.create_task(queue.get())
+        while True:
+            done, _ = await asyncio.wait({receiver, getter}, timeout=EVENT_PING_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                await websocket.send_json({'type': 'ping'})
+            if getter in done:
+                await websocket.send_json(getter.result())
+                getter = asyncio.create_task(queue.get())
+            if receiver in done:
+                if receiver.result()['type'] == 'websocket.disconnect':
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_broker.unsubscribe(user_id, queue)
+        for task in (receiver, getter):
+            if task:
+                task.cancel()
+
+# ============= PROGRESS BUFFER =============
+# Continuous progress reports (video or reading position) would otherwise
+# cost a write each. With PROGRESS_BUFFER_SECONDS set, update_progress only
+# records the latest value per (user, skill) in memory. The buffer is written
+# as one bulk write every interval, as soon as PROGRESS_BUFFER_MAX skills are
+# waiting, and on shutdown. Reads of a user's skills overlay the buffered
+# values, so the user sees their own progress at once. Completing a skill or
+# lesson drops its buffered value so a late flush cannot overwrite it.
+PROGRESS_BUFFER_SECONDS = float(os.environ.get('PROGRESS_BUFFER_SECONDS', 0))
+PROGRESS_BUFFER_MAX = int(os.environ.get('PROGRESS_BUFFER_MAX', 1000))
+
+class ProgressBuffer:
+    """Latest unwritten progress per (user id, skill id), flushed in bulk"""
+    def __init__(self):
+        self.pending = {}  # (user id, skill id) -> (user skill id, progress percent)
+        self.revisions = {}  # user id -> buffered reports since their last flush, part of the user's ETags
+        self.task = None
+        self.flushing = None
+        self.lock = asyncio.Lock()  # interval and threshold flushes take turns, so an older batch never lands last
+
+    @staticmethod
+    def enabled() -> bool:
+        return PROGRESS_BUFFER_SECONDS > 0
+
+    def revision(self, user_id: str) -> str:
+        """Tag for the user's unflushed progress; process-local, so it carries the boot id"""
+        revision = self.revisions.get(user_id)
+        return f'{BOOT_ID}.{revision}' if revision else ''
+
+    def add(self, user_id: str, skill_id: str, user_skill_id: str, progress_percent: int):
+        self.pending[(user_id, skill_id)] = (user_skill_id, progress_percent)
+        self.revisions[user_id] = self.revisions.get(user_id, 0) + 1
+        if len(self.pending) >= PROGRESS_BUFFER_MAX and (self.flushing is None or self.flushing.done()):
+            self.flushing = asyncio.create_task(self.flush())
+
+    def discard(self, user_id: str, skill_id: str):
+        self.pending.pop((user_id, skill_id), None)
+
+    def apply(self, user_id: str, user_skills: List[dict]) -> List[dict]:
+        """`user_skills` with their buffered progress, for any read of one user's skills"""
+        if not self.pending:
+            return user_skills
+        for user_skill in user_skills:
+            entry = self.pending.get((user_id, user_skill['skill_id']))
+            if entry and 'progress_percent' in user_skill:
+                user_skill['progress_percent'] = entry[1]
+        return user_skills
+
+    async def flush(self):
+        async with self.lock:
+            await self.write()
+
+    async def write(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            await db.user_skills.bulk_write([
+                # Another worker may have completed the skill since
+                UpdateOne({'id': user_skill_id, 'status': {'$ne': 'completed'}}, {'$set': {'progress_percent': percent}})
+                for user_skill_id, percent in batch.values()
+            ], ordered=False)
+        except BaseException as e:  # cancelled too: stop() flushes whatever is put back
+            for key, entry in batch.items():
+                self.pending.setdefault(key, entry)  # newer reports win
+            if not isinstance(e, Exception):
+                raise
+            logger.error(f"Progress flush of {len(batch)} skills failed, retrying next time: {e}")
+            return
+        user_ids = {user_id for user_id, _ in batch}
+        await bump_user_version(*user_ids)
+        still_pending = {user_id for user_id, _ in self.pending}
+        for user_id in user_ids - still_pending:
+            self.revisions.pop(user_id, None)  # the new cache_version takes over
+        await record_changes([(user_id, 'user_skills', user_skill_id) for (user_id, _), (user_skill_id, _) in batch.items()])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PROGRESS_BUFFER_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Progress flush failed: {e}")
+
+    def start(self):
+        if self.enabled():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the interval task, let a running flush finish, then write what is left"""
+        if self.task:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        if self.flushing:
+            try:
+                await self.flushing
+            except Exception as e:
+                logger.error(f"Progress flush failed: {e}")
+            self.flushing = None
+        await self.flush()
+
+progress_buffer = ProgressBuffer()
 
 # ============= SEED DATA ROUTE =============
 @api_router.post("/seed-data")
@@ -802,6 +3078,15 @@ async def seed_data():
     ]
     
     await db.lessons.insert_many(lessons_data)
+    await bump_catalog_version()
+    await record_changes(
+        [(CATALOG_SCOPE, 'skills', skill['id']) for skill in skills_data]
+        + [(CATALOG_SCOPE, 'lessons', lesson['id']) for lesson in lessons_data]
+    )
+    for skill in skills_data:
+        index_catalog_document('skills', skill)
+    for lesson in lessons_data:
+        index_catalog_document('lessons', lesson)
     
     return {'message': 'Data seeded successfully', 'skills_count': len(skills_data), 'lessons_count': len(lessons_data)}
 
@@ -816,8 +3101,39 @@ class AdminLessonGenerateRequest(BaseModel):
     xp_points: int
     lesson_count: int
     learning_objective: str
+    new_skill_prerequisites: List[str] = []
+
+class SkillPrerequisitesUpdate(BaseModel):
+    prerequisites: List[str]
+
+def extract_json_array(response_text: str) -> str:
+    """Pull the JSON array out of an LLM reply, with or without a markdown code block"""
+    response_text = response_text.strip()
+    
+    # Extract JSON from response (handle markdown code blocks)
+    if '```json' in response_text:
+        json_start = response_text.find('```json') + 7
+        json_end = response_text.find('```', json_start)
+        if json_end != -1:
+            response_text = response_text[json_start:json_end].strip()
+    elif '```' in response_text:
+        json_start = response_text.find('```') + 3
+        json_end = response_text.find('```', json_start)
+        if json_end != -1:
+            response_text = response_text[json_start:json_end].strip()
+    
+    # If no JSON blocks found, try to find JSON array directly
+    if not response_text.startswith('['):
+        # Look for JSON array in the response
+        start_idx = response_text.find('[')
+        end_idx = response_text.rfind(']')
+        if start_idx != -1 and end_idx != -1:
+            response_text = response_text[start_idx:end_idx+1]
+    
+    return response_text
 
 @api_router.post("/admin/lessons/generate")
+@idempotent
 async def generate_lessons(data: AdminLessonGenerateRequest, request: Request):
     """Admin-only: Generate lessons using AI"""
     admin_user = await get_admin_user(request)
@@ -835,31 +3151,36 @@ async def generate_lessons(data: AdminLessonGenerateRequest, request: Request):
             'description': f"Learn {data.new_skill_name} - {data.topic}",
             'category': data.new_skill_category,
             'difficulty': data.difficulty,
-            'prerequisites': [],
+            'prerequisites': list(dict.fromkeys(data.new_skill_prerequisites)),
             'xp_value': data.xp_points,
             'icon': '🎓',
             'position': {'x': 0, 'y': 0}  # Admin can adjust later
         }
-        await db.skills.insert_one(skill_doc)
+        async with catalog_write() as catalog:  # a prerequisite must not be deleted meanwhile
+            validate_prerequisites(catalog, skill_id, data.new_skill_prerequisites)
+            await db.skills.insert_one(skill_doc)
+            await bump_catalog_version()
+        await record_changes([(CATALOG_SCOPE, 'skills', skill_id)])
+        index_catalog_document('skills', skill_doc)
         skill_id = skill_doc['id']
     else:
         skill_id = data.skill_id
-        skill = await db.skills.find_one({'id': skill_id}, {'_id': 0})
-        if not skill:
+        catalog = await get_catalog_with(skill_id)
+        if skill_id not in catalog.by_id:
             raise HTTPException(status_code=404, detail="Skill not found")
     
     # Generate lessons using AI
-    import json
     try:
         emergent_key = os.environ.get('EMERGENT_LLM_KEY')
         if not emergent_key:
             raise HTTPException(status_code=500, detail="EMERGENT_LLM_KEY not configured")
         
-        llm = LlmChat(
-            api_key=emergent_key,
+        llm = llm_chat(
+            "openai", "gpt-4o-mini",
             session_id=f"admin_lesson_gen_{datetime.now(timezone.utc).timestamp()}",
-            system_message="You are an expert educational content creator. Generate comprehensive, engaging lessons with practical examples and clear explanations."
-        ).with_model("openai", "gpt-4o-mini")
+            system_message="You are an expert educational content creator. Generate comprehensive, engaging lessons with practical examples and clear explanations.",
+            api_key=emergent_key
+        )
         
         prompt = f"""Generate {data.lesson_count} lessons for: {data.topic} (Level: {data.difficulty})
 
@@ -876,27 +3197,7 @@ Keep content concise but informative. Use proper JSON escaping for quotes."""
         response = await llm.send_message(user_message)
         
         # Parse AI response
-        response_text = str(response).strip()
-        
-        # Extract JSON from response (handle markdown code blocks)
-        if '```json' in response_text:
-            json_start = response_text.find('```json') + 7
-            json_end = response_text.find('```', json_start)
-            if json_end != -1:
-                response_text = response_text[json_start:json_end].strip()
-        elif '```' in response_text:
-            json_start = response_text.find('```') + 3
-            json_end = response_text.find('```', json_start)
-            if json_end != -1:
-                response_text = response_text[json_start:json_end].strip()
-        
-        # If no JSON blocks found, try to find JSON array directly
-        if not response_text.startswith('['):
-            # Look for JSON array in the response
-            start_idx = response_text.find('[')
-            end_idx = response_text.rfind(']')
-            if start_idx != -1 and end_idx != -1:
-                response_text = response_text[start_idx:end_idx+1]
+        response_text = extract_json_array(str(response))
         
         if not response_text:
             raise ValueError("No JSON content found in AI response")
@@ -904,7 +3205,7 @@ Keep content concise but informative. Use proper JSON escaping for quotes."""
         # Debug: log the extracted JSON for troubleshooting
         logger.info(f"Extracted JSON for parsing: {response_text[:200]}...")
         
-        lessons_data = json.loads(response_text)
+        lessons_data = orjson.loads(response_text)
         
         # Store lessons in database
         generated_lessons = []
@@ -922,7 +3223,11 @@ Keep content concise but informative. Use proper JSON escaping for quotes."""
             await db.lessons.insert_one(lesson_doc)
             # Remove MongoDB _id field for JSON serialization
             lesson_doc.pop('_id', None)
+            index_catalog_document('lessons', lesson_doc)
             generated_lessons.append(lesson_doc)
+        await bump_catalog_version()
+        await record_changes([(CATALOG_SCOPE, 'lessons', lesson['id']) for lesson in generated_lessons])
+        publish_event(admin_user['id'], 'generation_finished', skill_id=skill_id, lesson_count=len(generated_lessons))
         
         return {
             'message': f'Successfully generated {len(generated_lessons)} lessons',
@@ -930,18 +3235,42 @@ Keep content concise but informative. Use proper JSON escaping for quotes."""
             'lessons': generated_lessons
         }
     
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
+        publish_event(admin_user['id'], 'generation_failed', skill_id=skill_id, error=str(e))
         raise HTTPException(status_code=500, detail=f"Failed to parse AI response: {str(e)}")
     except Exception as e:
+        publish_event(admin_user['id'], 'generation_failed', skill_id=skill_id, error=str(e))
         raise HTTPException(status_code=500, detail=f"Failed to generate lessons: {str(e)}")
 
 @api_router.get("/admin/skills")
 async def get_all_skills_admin(request: Request):
     """Admin-only: Get all skills for dropdown"""
     await get_admin_user(request)
-    skills = await db.skills.find({}, {'_id': 0, 'id': 1, 'name': 1, 'category': 1}).to_list(1000)
+    skills = await reader('catalog').skills.find(LIVE_SKILLS, {'_id': 0, 'id': 1, 'name': 1, 'category': 1}).to_list(1000)
     return skills
 
+@api_router.put("/admin/skills/{skill_id}/prerequisites")
+async def update_skill_prerequisites(skill_id: str, data: SkillPrerequisitesUpdate, request: Request):
+    """Admin-only: Replace a skill's prerequisites, refusing unknown skills and cycles"""
+    await get_admin_user(request)
+    prerequisites = list(dict.fromkeys(data.prerequisites))
+    # Under the lease, so two concurrent edits cannot each pass validation and together close a cycle
+    async with catalog_write() as catalog:
+        if skill_id not in catalog.by_id:
+            raise HTTPException(status_code=404, detail="Skill not found")
+        validate_prerequisites(catalog, skill_id, prerequisites)
+        await db.skills.update_one({'id': skill_id}, {'$set': {'prerequisites': prerequisites}})
+        await bump_catalog_version()
+        await record_changes([(CATALOG_SCOPE, 'skills', skill_id)])
+    return {'message': 'Prerequisites updated', 'prerequisites': prerequisites}
+
+@api_router.get("/admin/catalog/graph")
+async def get_catalog_graph_report(request: Request):
+    """Admin-only: Prerequisite problems in the stored catalog"""
+    await get_admin_user(request)
+    graph = (await get_catalog()).graph
+    return {'skills': len(graph.ids), 'missing_prerequisites': graph.missing, 'cycles': graph.cycles}
+
 @api_router.delete("/admin/lessons/{lesson_id}")
 async def delete_lesson(lesson_id: str, request: Request):
     """Admin-only: Delete a lesson"""
@@ -949,22 +3278,26 @@ async def delete_lesson(lesson_id: str, request: Request):
     result = await db.lessons.delete_one({'id': lesson_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Lesson not found")
+    await bump_catalog_version()
+    await record_changes([(CATALOG_SCOPE, 'lessons', lesson_id)], deleted=True)
+    unindex_lesson(lesson_id)
     return {'message': 'Lesson deleted successfully'}
 
 @api_router.delete("/admin/skills/{skill_id}")
 async def delete_skill(skill_id: str, request: Request):
-    """Admin-only: Delete a skill and all its lessons"""
+    """Admin-only: Delete a skill now; its lessons and users' progress are cleaned up in the background"""
     await get_admin_user(request)
     
-    # Delete all lessons for this skill
-    await db.lessons.delete_many({'skill_id': skill_id})
-    
-    # Delete the skill
-    result = await db.skills.delete_one({'id': skill_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Skill not found")
+    async with catalog_write():  # a concurrent write must not make it a prerequisite of a new skill
+        skill = await db.skills.find_one({'id': skill_id, **LIVE_SKILLS}, {'_id': 0})
+        if not skill:
+            raise HTTPException(status_code=404, detail="Skill not found")
+        
+        job = await create_deletion_job(skill)
+        await tombstone_skill(skill_id)
+    start_cascade(job['id'])
     
-    return {'message': 'Skill and associated lessons deleted successfully'}
+    return {'message': 'Skill deleted successfully', 'job_id': job['id']}
 
 @api_router.put("/admin/users/{user_id}/toggle-admin")
 async def toggle_admin_status(user_id: str, request: Request):
@@ -974,7 +3307,7 @@ async def toggle_admin_status(user_id: str, request: Request):
     if admin_user['id'] == user_id:
         raise HTTPException(status_code=400, detail="Cannot modify your own admin status")
     
-    user = await db.users.find_one({'id': user_id}, {'_id': 0})
+    user = await load_one('users', user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -992,6 +3325,965 @@ async def promote_to_admin(request: Request):
     return {'message': 'You are now an admin!', 'is_admin': True}
 
 
+# ============= CATALOG IMPORT =============
+# Catalogs stream in as NDJSON (one record per line) or as a JSON array of
+# records. A record is a lesson when it has a skill_id (or "type": "lesson")
+# and a skill otherwise. Records are validated and upserted in batches as they
+# arrive; only the skill graph is kept for the whole import, plus any record
+# still waiting for a skill that has not arrived yet. A bad record is reported
+# and skipped without stopping the rest. Each batch of skills is written under
+# the catalog write lease, re-checked first if someone else changed the graph
+# since the last one, so a slow upload never holds up other catalog writes.
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+IMPORT_MAX_ERRORS = 1000
+IMPORT_MAX_RECORD_BYTES = int(os.environ.get('IMPORT_MAX_RECORD_BYTES', 1024 * 1024))
+JSON_STRUCTURE = re.compile(rb'["{}\[\],]')
+JSON_STRING_END = re.compile(rb'["\\]')
+JSON_CLOSERS = {ord('{'): ord('}'), ord('['): ord(']')}
+JSON_WHITESPACE = b' \t\r\n'
+
+def parse_record(raw):
+    try:
+        record = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        return ValueError(f"Invalid JSON: {e}")
+    return record if isinstance(record, dict) else ValueError("Record must be a JSON object")
+
+async def ndjson_records(chunks):
+    """(line number, record or error) for each non-blank line of an NDJSON byte stream.
+
+    Only newly arrived bytes are searched for newlines. A line that grows past
+    IMPORT_MAX_RECORD_BYTES is dropped as it arrives and reported once its
+    newline turns up.
+    """
+    buffer = bytearray()
+    line_number = 0
+    oversized = False
+    async for chunk in chunks:
+        searched = len(buffer)
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b'\n', searched)) != -1:
+            line_number += 1
+            if oversized:
+                yield line_number, ValueError(f"Record is larger than {IMPORT_MAX_RECORD_BYTES} bytes")
+                oversized = False
+            elif buffer[start:end].strip():
+                yield line_number, parse_record(bytes(buffer[start:end]))
+            start = searched = end + 1
+        del buffer[:start]
+        if len(buffer) > IMPORT_MAX_RECORD_BYTES:
+            oversized = True
+            buffer.clear()
+    if oversized:
+        yield line_number + 1, ValueError(f"Record is larger than {IMPORT_MAX_RECORD_BYTES} bytes")
+    elif buffer.strip():
+        yield line_number + 1, parse_record(bytes(buffer))
+
+async def json_array_records(chunks):
+    """(index, record or error) for each element of a JSON array byte stream, split as it arrives.
+
+    Element boundaries come from a scan that follows strings and bracket
+    nesting without decoding anything, so a malformed element is reported on
+    its own and the scan carries on with the next one. Scanned bytes are
+    dropped from the front of the buffer once per chunk; an element that grows
+    past IMPORT_MAX_RECORD_BYTES is not kept at all.
+    """
+    buffer = bytearray()
+    pos = 0  # next byte to scan
+    start = None  # offset of the current element; None until the array opens
+    stack = []  # closing brackets the current element still owes
+    in_string = escaped = broken = oversized = False
+    index = 0
+    async for chunk in chunks:
+        buffer += chunk
+        while pos < len(buffer):
+            if start is None:
+                if buffer[pos] in JSON_WHITESPACE:
+                    pos += 1
+                    continue
+                if buffer[pos] != ord('['):
+                    yield 0, ValueError("Expected a JSON array of records")
+                    return
+                pos = start = pos + 1
+                continue
+            if in_string:
+                if escaped:
+                    pos, escaped = pos + 1, False
+                    continue
+                match = JSON_STRING_END.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                pos = match.end()
+                if match.group() == b'\\':
+                    escaped = True
+                else:
+                    in_string = False
+                continue
+            match = JSON_STRUCTURE.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            byte, pos = buffer[match.start()], match.end()
+            if byte == ord('"'):
+                in_string = True
+            elif byte in JSON_CLOSERS:
+                stack.append(JSON_CLOSERS[byte])
+            elif stack and byte == stack[-1]:
+                stack.pop()
+            elif stack and byte != ord(','):
+                broken = True  # a closer for some other bracket: drop back to where it fits
+                if byte in stack:
+                    del stack[len(stack) - 1 - stack[::-1].index(byte):]
+                else:
+                    stack.clear()
+                    pos = match.start()
+            elif not stack and byte == ord('}'):
+                broken = True
+            elif not stack:  # a top-level ',' or ']' ends the element
+                element = buffer[start:match.start()]
+                if element.strip() or byte == ord(',') or index:
+                    index += 1
+                    if oversized:
+                        yield index, ValueError(f"Record is larger than {IMPORT_MAX_RECORD_BYTES} bytes")
+                    elif broken:
+                        yield index, ValueError("Invalid JSON: unbalanced brackets")
+                    elif not element.strip():
+                        yield index, ValueError("Invalid JSON: empty element")
+                    else:
+                        yield index, parse_record(bytes(element))
+                if byte == ord(']'):
+                    return
+                start, broken, oversized = pos, False, False
+        if start is not None and pos - start > IMPORT_MAX_RECORD_BYTES:
+            oversized = True
+            start = pos  # the element will only be reported, so its bytes can go
+        cut = pos if start is None else start
+        del buffer[:cut]
+        pos -= cut
+        if start is not None:
+            start -= cut
+    if start is None:
+        yield 0, ValueError("Expected a JSON array of records")
+    else:
+        yield index + 1, ValueError("Truncated JSON array")
+
+class CatalogImport:
+    """One streamed import: validation, prerequisite graph checks and batched upserts"""
+
+    def __init__(self, database):
+        self.db = database
+        self.graph = {}  # skill id -> prerequisites, for every skill stored or accepted so far
+        self.referenced = set()  # ids some skill in the graph depends on
+        self.pending_skills = {}  # skill id -> (position, Skill) missing a prerequisite
+        self.waiting = {}  # missing prerequisite id -> ids of pending skills
+        self.pending_lessons = {}  # skill id -> [(position, Lesson)]
+        self.batches = {'skills': {}, 'lessons': {}}
+        self.counts = {'skills': 0, 'lessons': 0}
+        self.errors = []
+        self.error_count = 0
+        self.seen = None  # shared catalog version the graph was last brought up to date with
+
+    async def load_graph(self):
+        self.seen = cache_versions['shared']
+        async for skill in self.db.skills.find(LIVE_SKILLS, {'_id': 0, 'id': 1, 'prerequisites': 1}):
+            self.accept_node(skill['id'], skill.get('prerequisites', []))
+
+    def accept_node(self, skill_id, prerequisites):
+        self.graph[skill_id] = prerequisites
+        self.referenced.update(prerequisites)
+
+    def error(self, position, record_id, message):
+        self.error_count += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({'record': position, 'id': record_id, 'error': message})
+
+    def creates_cycle(self, skill_id: str, prerequisites: List[str]) -> bool:
+        if skill_id not in self.referenced:
+            return False  # nothing depends on it, so it cannot close a loop
+        stack = list(prerequisites)
+        seen = set()
+        while stack:
+            node = stack.pop()
+            if node == skill_id:
+                return True
+            if node not in seen:
+                seen.add(node)
+                stack.extend(self.graph.get(node, ()))
+        return False
+
+    async def add(self, position, record):
+        if isinstance(record, Exception):
+            self.error(position, None, str(record))
+            return
+        kind = record.pop('type', None) or ('lesson' if 'skill_id' in record else 'skill')
+        model = {'skill': Skill, 'lesson': Lesson}.get(kind)
+        if model is None:
+            self.error(position, record.get('id'), f"Unknown record type: {kind}")
+            return
+        try:
+            item = model.model_validate(record)
+        except ValidationError as e:
+            problems = '; '.join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+            self.error(position, record.get('id'), problems)
+            return
+        if kind == 'skill':
+            await self.add_skill(position, item)
+        elif item.skill_id in self.graph:
+            await self.queue('lessons', position, item)
+        else:
+            self.pending_lessons.setdefault(item.skill_id, []).append((position, item))
+
+    async def add_skill(self, position, skill: Skill):
+        ready = [(position, skill)]
+        while ready:
+            position, skill = ready.pop()
+            missing = [p for p in skill.prerequisites if p not in self.graph]
+            if missing:
+                self.pending_skills[skill.id] = (position, skill)
+                for prerequisite in missing:
+                    self.waiting.setdefault(prerequisite, set()).add(skill.id)
+                continue
+            if skill.id in skill.prerequisites or self.creates_cycle(skill.id, skill.prerequisites):
+                self.error(position, skill.id, "Prerequisites would form a cycle")
+                continue
+            self.accept_node(skill.id, skill.prerequisites)
+            await self.queue('skills', position, skill)
+            for lesson_position, lesson in self.pending_lessons.pop(skill.id, []):
+                await self.queue('lessons', lesson_position, lesson)
+            for dependent in self.waiting.pop(skill.id, ()):
+                if dependent in self.pending_skills:
+                    ready.append(self.pending_skills.pop(dependent))
+
+    async def queue(self, collection, position, item: BaseModel):
+        batch = self.batches[collection]
+        batch.pop(item.id, None)  # a later record for the same id wins
+        batch[item.id] = (position, item.model_dump())
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await self.flush(collection)
+
+    def rebase(self, catalog: CatalogSnapshot):
+        """Take in graph writes made elsewhere since this import last wrote, dropping what they now conflict with"""
+        self.graph, self.referenced = {}, set()
+        for skill in catalog.skills:
+            self.accept_node(skill.id, skill.prerequisites)
+        skills = self.batches['skills']
+        for skill_id, (position, doc) in list(skills.items()):
+            missing = [p for p in doc['prerequisites'] if p not in self.graph]
+            if missing or self.creates_cycle(skill_id, doc['prerequisites']):
+                del skills[skill_id]
+                self.error(position, skill_id, f"Unknown prerequisites: {', '.join(missing)}" if missing else "Prerequisites would form a cycle")
+                continue
+            self.accept_node(skill_id, doc['prerequisites'])
+        lessons = self.batches['lessons']
+        for lesson_id, (position, doc) in list(lessons.items()):
+            if doc['skill_id'] not in self.graph:
+                del lessons[lesson_id]
+                self.error(position, lesson_id, f"Skill {doc['skill_id']} was not imported")
+
+    async def flush(self, collection):
+        if not self.batches[collection]:
+            return
+        if collection == 'lessons':
+            await self.flush('skills')  # lessons are never stored ahead of their skill
+            await self.write('lessons')
+            return
+        async with catalog_write() as catalog:
+            if cache_versions['shared'] != self.seen:
+                self.rebase(catalog)
+            if await self.write('skills'):
+                await bump_catalog_version()
+            self.seen = cache_versions['shared']
+
+    async def write(self, collection) -> int:
+        """Upsert the batch; the number of documents stored"""
+        batch = list(self.batches[collection].values())
+        self.batches[collection] = {}
+        if not batch:
+            return 0
+        operations = [ReplaceOne({'id': doc['id']}, doc, upsert=True) for _, doc in batch]
+        failed = set()
+        try:
+            await self.db[collection].bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                failed.add(write_error['index'])
+                position, doc = batch[write_error['index']]
+                self.error(position, doc['id'], write_error.get('errmsg', 'Write failed'))
+        self.counts[collection] += len(batch) - len(failed)
+        await record_changes([(CATALOG_SCOPE, collection, doc['id']) for i, (_, doc) in enumerate(batch) if i not in failed])
+        for i, (_, doc) in enumerate(batch):
+            if i not in failed:
+                index_catalog_document(collection, doc)
+        return len(batch) - len(failed)
+
+    def waits_on_itself(self, skill_id: str) -> bool:
+        """Whether a pending skill is held up, through other pending skills, by itself"""
+        stack = list(self.pending_skills[skill_id][1].prerequisites)
+        seen = set()
+        while stack:
+            node = stack.pop()
+            if node == skill_id:
+                return True
+            if node not in seen and node in self.pending_skills:
+                seen.add(node)
+                stack.extend(self.pending_skills[node][1].prerequisites)
+        return False
+
+    async def finish(self) -> dict:
+        for position, skill in self.pending_skills.values():
+            if self.waits_on_itself(skill.id):
+                self.error(position, skill.id, "Prerequisites would form a cycle")
+                continue
+            missing = [p for p in skill.prerequisites if p not in self.graph]
+            self.error(position, skill.id, f"Unknown prerequisites: {', '.join(missing)}")
+        for skill_id, lessons in self.pending_lessons.items():
+            for position, lesson in lessons:
+                self.error(position, lesson.id, f"Skill {skill_id} was not imported")
+        await self.flush('skills')
+        await self.flush('lessons')
+        if self.counts['lessons']:
+            await bump_catalog_version()  # skill batches bumped it as they were written
+        return {
+            'skills_upserted': self.counts['skills'],
+            'lessons_upserted': self.counts['lessons'],
+            'error_count': self.error_count,
+            'errors': self.errors
+        }
+
+@api_router.post("/admin/import")
+async def import_catalog(request: Request):
+    """Admin-only: Stream in skills and lessons as NDJSON, or as a JSON array with Content-Type application/json"""
+    await get_admin_user(request)
+    is_json = request.headers.get('content-type', '').startswith('application/json')
+    records = json_array_records if is_json else ndjson_records
+    job = CatalogImport(db)
+    await job.load_graph()
+    async for position, record in records(request.stream()):
+        await job.add(position, record)
+    return await job.finish()
+
+
+# ============= SKILL DELETION CASCADE =============
+# Deleting a skill tombstones it at once, so catalog reads stop seeing it, and
+# records a job in cascade_jobs. A background task then works through the
+# job's steps in chunks, saving progress after each one. Every step is safe to
+# repeat, so a job that failed, or whose worker died, is resumed by simply
+# running its current step again: at startup and every CASCADE_RETRY_SECONDS.
+CASCADE_CHUNK_SIZE = int(os.environ.get('CASCADE_CHUNK_SIZE', 500))
+CASCADE_LEASE_SECONDS = 60
+CASCADE_RETRY_SECONDS = int(os.environ.get('CASCADE_RETRY_SECONDS', 300))
+CASCADE_STEPS = ['user_lessons', 'user_skills', 'prerequisites', 'lessons', 'skill']
+cascade_tasks = {}  # job id -> running task
+cascade_state = {'retry': None}
+
+async def create_deletion_job(skill: dict) -> dict:
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        'id': str(uuid.uuid4()),
+        'kind': 'delete_skill',
+        'skill_id': skill['id'],
+        'skill_prerequisites': skill.get('prerequisites', []),
+        'status': 'pending',
+        'step': CASCADE_STEPS[0],
+        'progress': {step: 0 for step in CASCADE_STEPS},
+        'owner': None,
+        'lease_until': '',
+        'error': None,
+        'created_at': now,
+        'updated_at': now
+    }
+    await db.cascade_jobs.insert_one(dict(job))
+    return job
+
+async def tombstone_skill(skill_id: str):
+    await db.skills.update_one(
+        {'id': skill_id},
+        {'$set': {'deleted': True, 'deleted_at': datetime.now(timezone.utc).isoformat()}}
+    )
+    await bump_catalog_version()
+    await record_changes([(CATALOG_SCOPE, 'skills', skill_id)], deleted=True)
+    unindex_skill(skill_id)
+
+def lease_expiry() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=CASCADE_LEASE_SECONDS)).isoformat()
+
+async def claim_cascade_job(job_id: str) -> Optional[dict]:
+    """Take (or renew) the job's lease for this process and return the job as it was; None if another live process holds it"""
+    now = datetime.now(timezone.utc).isoformat()
+    return await db.cascade_jobs.find_one_and_update(
+        {'id': job_id, 'status': {'$ne': 'done'}, '$or': [{'owner': BOOT_ID}, {'lease_until': {'$lt': now}}]},
+        {'$set': {'owner': BOOT_ID, 'lease_until': lease_expiry(), 'status': 'running', 'updated_at': now}},
+        projection={'_id': 0}
+    )
+
+async def record_cascade_progress(job: dict, step: str, processed: int):
+    job['progress'][step] += processed
+    await db.cascade_jobs.update_one({'id': job['id']}, {'$set': {
+        'step': step,
+        f'progress.{step}': job['progress'][step],
+        'lease_until': lease_expiry(),
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }})
+
+async def cascade_user_lessons(job: dict):
+    lesson_ids = [doc['id'] for doc in await db.lessons.find({'skill_id': job['skill_id']}, {'_id': 0, 'id': 1}).to_list(None)]
+    while lesson_ids:
+        chunk = await db.user_lessons.find(
+            {'lesson_id': {'$in': lesson_ids}}, {'_id': 1, 'id': 1, 'user_id': 1}
+        ).limit(CASCADE_CHUNK_SIZE).to_list(None)
+        if not chunk:
+            break
+        # Tombstones first: a rerun after a crash finds the same documents and records them again
+        await record_changes([(doc['user_id'], 'user_lessons', doc['id']) for doc in chunk], deleted=True)
+        await db.user_lessons.delete_many({'_id': {'$in': [doc['_id'] for doc in chunk]}})
+        await record_cascade_progress(job, 'user_lessons', len(chunk))
+
+async def category_totals(user_ids: List[str]) -> Dict[str, Dict[str, int]]:
+    """user id -> {category field: xp} from the users' completed skills that are still in the catalog"""
+    catalog = await get_catalog()
+    completed = await db.user_skills.find(
+        {'user_id': {'$in': user_ids}, 'status': 'completed'}, {'_id': 0, 'user_id': 1, 'skill_id': 1}
+    ).to_list(None)
+    totals = {user_id: {} for user_id in user_ids}
+    for user_skill in completed:
+        skill = catalog.by_id.get(user_skill['skill_id'])
+        if skill:
+            by_category = totals[user_skill['user_id']]
+            field = category_field(skill.category)
+            by_category[field] = by_category.get(field, 0) + skill.xp_value
+    return totals
+
+async def recompute_user_xp(user_ids: List[str]):
+    """Set xp, level and category_xp from the users' completed skills that are still in the catalog"""
+    users = await db.users.find({'id': {'$in': user_ids}}, LEADERBOARD_PROFILE).to_list(None)
+    if not users:
+        return
+    catalog = await get_catalog()
+    categories = {category_field(skill.category): skill.category for skill in catalog.skills}
+    totals = await category_totals([user['id'] for user in users])
+    updated_users = []
+    for user in users:
+        xp = sum(totals[user['id']].values())
+        updated_users.append({**user, 'xp': xp, 'level': 1 + (xp // 1000), 'category_xp': totals[user['id']]})
+    await db.users.bulk_write([
+        UpdateOne({'id': user['id']}, {'$set': {'xp': user['xp'], 'level': user['level'], 'category_xp': user['category_xp']}})
+        for user in updated_users
+    ], ordered=False)
+    for user, updated in zip(users, updated_users):  # leaderboard deltas right after the write, as in complete_skill
+        xp, category_xp = updated['xp'], updated['category_xp']
+        publish_xp_change(user, xp, updated['level'])
+        record_score_change(updated, None, user.get('xp', 0), xp)
+        old_category_xp = user.get('category_xp', {})
+        for field in set(old_category_xp) | set(category_xp):
+            if field in categories:
+                record_score_change(updated, categories[field], old_category_xp.get(field, 0), category_xp.get(field, 0))
+    await record_changes([(user['id'], 'users', user['id']) for user in updated_users])
+
+async def cascade_user_skills(job: dict):
+    while True:
+        chunk = await db.user_skills.find(
+            {'skill_id': job['skill_id']}, {'_id': 1, 'id': 1, 'user_id': 1, 'status': 1}
+        ).limit(CASCADE_CHUNK_SIZE).to_list(None)
+        if not chunk:
+            break
+        # XP first: if we stop before the delete, the rerun recomputes the same totals
+        completed_by = [doc['user_id'] for doc in chunk if doc['status'] == 'completed']
+        if completed_by:
+            await recompute_user_xp(completed_by)
+        await record_changes([(doc['user_id'], 'user_skills', doc['id']) for doc in chunk], deleted=True)
+        await db.user_skills.delete_many({'_id': {'$in': [doc['_id'] for doc in chunk]}})
+        await bump_user_version(*{doc['user_id'] for doc in chunk})
+        await record_cascade_progress(job, 'user_skills', len(chunk))
+
+async def cascade_prerequisites(job: dict):
+    """Point dependents at the deleted skill's own prerequisites, keeping what they transitively required"""
+    skill_id = job['skill_id']
+    dependents = await db.skills.distinct('id', {'prerequisites': skill_id})
+    if job['skill_prerequisites']:
+        await db.skills.update_many(
+            {'prerequisites': skill_id},
+            {'$addToSet': {'prerequisites': {'$each': job['skill_prerequisites']}}}
+        )
+    result = await db.skills.update_many({'prerequisites': skill_id}, {'$pull': {'prerequisites': skill_id}})
+    await bump_catalog_version()
+    await record_changes([(CATALOG_SCOPE, 'skills', dependent) for dependent in dependents])
+    await record_cascade_progress(job, 'prerequisites', result.modified_count)
+
+async def cascade_lessons(job: dict):
+    while True:
+        chunk = await db.lessons.find({'skill_id': job['skill_id']}, {'_id': 1, 'id': 1}).limit(CASCADE_CHUNK_SIZE).to_list(None)
+        if not chunk:
+            break
+        await record_changes([(CATALOG_SCOPE, 'lessons', doc['id']) for doc in chunk], deleted=True)
+        await db.lessons.delete_many({'_id': {'$in': [doc['_id'] for doc in chunk]}})
+        await record_cascade_progress(job, 'lessons', len(chunk))
+
+async def cascade_skill(job: dict):
+    # Only the tombstone: an import may have brought the id back since
+    result = await db.skills.delete_one({'id': job['skill_id'], 'deleted': True})
+    await bump_catalog_version()
+    await record_cascade_progress(job, 'skill', result.deleted_count)
+
+CASCADE_HANDLERS = {
+    'user_lessons': cascade_user_lessons,
+    'user_skills': cascade_user_skills,
+    'prerequisites': cascade_prerequisites,
+    'lessons': cascade_lessons,
+    'skill': cascade_skill,
+}
+
+async def run_cascade(job_id: str):
+    while True:
+        job = await claim_cascade_job(job_id)
+        if job:
+            break
+        current = await db.cascade_jobs.find_one({'id': job_id}, {'_id': 0, 'status': 1, 'lease_until': 1})
+        if not current or current['status'] == 'done':
+            return
+        await asyncio.sleep(CASCADE_LEASE_SECONDS / 4)  # another process holds it; take over if its lease lapses
+    try:
+        if job['status'] == 'pending':
+            await tombstone_skill(job['skill_id'])  # in case the request died before it could
+        for step in CASCADE_STEPS[CASCADE_STEPS.index(job['step']):]:
+            await record_cascade_progress(job, step, 0)
+            await CASCADE_HANDLERS[step](job)
+        await db.cascade_jobs.update_one({'id': job_id}, {'$set': {
+            'status': 'done', 'owner': None, 'error': None, 'updated_at': datetime.now(timezone.utc).isoformat()
+        }})
+        logger.info(f"Cascade for deleted skill {job['skill_id']} finished: {job['progress']}")
+    except Exception as e:
+        logger.exception(f"Cascade job {job_id} failed at step {job['step']}")
+        await db.cascade_jobs.update_one({'id': job_id}, {'$set': {'status': 'failed', 'error': str(e), 'lease_until': ''}})
+
+def start_cascade(job_id: str) -> asyncio.Task:
+    task = cascade_tasks.get(job_id)
+    if task is None or task.done():
+        task = asyncio.create_task(run_cascade(job_id))
+        cascade_tasks[job_id] = task
+        task.add_done_callback(lambda _: cascade_tasks.pop(job_id, None))
+    return task
+
+async def resume_cascade_jobs():
+    """Restart every job that did not finish and that no live worker holds, including ones that failed"""
+    now = datetime.now(timezone.utc).isoformat()
+    async for job in db.cascade_jobs.find({'status': {'$ne': 'done'}, 'lease_until': {'$lt': now}}, {'_id': 0, 'id': 1}):
+        start_cascade(job['id'])
+
+async def retry_cascade_jobs():
+    while True:
+        await asyncio.sleep(CASCADE_RETRY_SECONDS)
+        try:
+            await resume_cascade_jobs()
+        except Exception as e:
+            logger.error(f"Cascade job retry failed: {e}")
+
+@api_router.get("/admin/cascade-jobs/{job_id}")
+async def get_cascade_job(job_id: str, request: Request):
+    """Admin-only: Progress of a background deletion cascade"""
+    await get_admin_user(request)
+    job = await db.cascade_jobs.find_one({'id': job_id}, {'_id': 0, 'owner': 0, 'lease_until': 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+# ============= COMPRESSION =============
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_CACHE_SIZE = int(os.environ.get('COMPRESSION_CACHE_SIZE', 256))
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/x-ndjson')
+
+def available_encodings() -> List[str]:
+    """Encodings we can produce, in order of preference"""
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    candidates = [e for e in available_encodings() if accepted.get(e, accepted.get('*', 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda e: accepted.get(e, accepted.get('*', 0)))
+
+class StreamCompressor:
+    """Incremental compressor that flushes after every chunk so streamed bodies stay live"""
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self._obj = zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == 'br':
+            self._obj = brotli.Compressor(quality=5)
+        else:
+            self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == 'zstd':
+            return self._obj.compress(chunk) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == 'br':
+            return self._obj.process(chunk) + self._obj.flush()
+        return self._obj.compress(chunk) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'zstd':
+            return self._obj.flush()
+        if self.encoding == 'br':
+            return self._obj.finish()
+        return self._obj.flush()
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(body)
+    if encoding == 'br':
+        return brotli.compress(body, quality=9)
+    return zlib.compress(body, 6, wbits=31)
+
+class CompressionMiddleware:
+    """Negotiated zstd/br/gzip compression for JSON and text responses.
+
+    Bodies smaller than COMPRESSION_MIN_SIZE are sent as-is. Streamed responses
+    are compressed chunk by chunk. Responses carrying an ETag are immutable for
+    that tag, so their compressed bodies are cached per (ETag, encoding) and
+    repeat catalog reads skip compression entirely.
+    """
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, cache_size: int = COMPRESSION_CACHE_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        accept_encoding = ''
+        for key, value in scope['headers']:
+            if key == b'accept-encoding':
+                accept_encoding = value.decode('latin-1')
+                break
+        encoding = negotiate_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        state = {'start': None, 'compressor': None, 'passthrough': False}
+
+        async def send_compressed(message):
+            if message['type'] == 'http.response.start':
+                state['start'] = message
+                return
+            if message['type'] != 'http.response.body':
+                return await send(message)
+
+            start = state['start']
+            if state['passthrough']:
+                return await send(message)
+            if state['compressor'] is not None:
+                chunk = state['compressor'].compress(message.get('body', b''))
+                if not message.get('more_body', False):
+                    chunk += state['compressor'].finish()
+                return await send({'type': 'http.response.body', 'body': chunk, 'more_body': message.get('more_body', False)})
+
+            # First body message decides how the whole response is sent
+            headers = MutableHeaders(raw=start['headers'])
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            content_type = headers.get('content-type', '')
+            if (
+                'content-encoding' in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+                or (not more_body and len(body) < self.minimum_size)
+            ):
+                state['passthrough'] = True
+                await send(start)
+                return await send(message)
+
+            headers['Content-Encoding'] = encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['content-length']
+                state['compressor'] = StreamCompressor(encoding)
+                await send(start)
+                return await send({'type': 'http.response.body', 'body': state['compressor'].compress(body), 'more_body': True})
+
+            compressed = self._cached_body(headers.get('etag'), encoding, body)
+            headers['Content-Length'] = str(len(compressed))
+            await send(start)
+            await send({'type': 'http.response.body', 'body': compressed})
+
+        await self.app(scope, receive, send_compressed)
+
+    def _cached_body(self, etag: Optional[str], encoding: str, body: bytes) -> bytes:
+        if not etag:
+            return compress_body(body, encoding)
+        key = (etag, encoding)
+        compressed = self.cache.get(key)
+        record_cache('compression', compressed is not None)
+        if compressed is not None:
+            self.cache.move_to_end(key)
+            return compressed
+        compressed = compress_body(body, encoding)
+        self.cache[key] = compressed
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return compressed
+
+
+# ============= REQUEST CONTEXT MIDDLEWARE =============
+route_paths = {}
+
+def route_template(scope) -> str:
+    """Path template of the matched route, so metric labels stay bounded"""
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    if not route_paths:
+        route_paths.update({route.endpoint: route.path for route in app.routes if hasattr(route, 'endpoint')})
+    return route_paths.get(endpoint, 'unmatched')
+
+class RequestContextMiddleware:
+    """Gives each request an id, a fresh set of loaders and a query count in the logs"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        request_id = None
+        for key, value in scope['headers']:
+            if key == b'x-request-id':
+                request_id = value.decode('latin-1')[:64]
+                break
+        ctx = RequestContext(request_id or uuid.uuid4().hex, scope)
+        token = request_context.set(ctx)
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(scope['method'])
+        in_progress.inc()
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_request_id(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                MutableHeaders(raw=message['headers'])['X-Request-ID'] = ctx.request_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+            check_query_budget(ctx)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress.dec()
+            request_context.reset(token)
+            HTTP_REQUEST_DURATION.labels(scope['method'], ctx.route, status_code).observe(elapsed)
+            logger.info(
+                "%s %s %s %.1fms queries=%d request_id=%s",
+                scope['method'], scope['path'], status_code,
+                elapsed * 1000, ctx.query_count, ctx.request_id
+            )
+
+
+# ============= PROFILING =============
+# An admin can send `X-Profile: 1` to run that one request under a deterministic
+# profiler, or `X-Profile: sample` for a low-overhead sampling profiler. Without
+# the header the middleware only scans the request headers. Only one request
+# is profiled at a time, since a profiler covers the whole event-loop thread;
+# another profiled request meanwhile gets 409. Profiles get a server-made id,
+# returned in X-Profile-ID.
+PROFILE_HEADER = b'x-profile'
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 1))
+PROFILE_HISTORY = int(os.environ.get('PROFILE_HISTORY', 50))
+profiles = OrderedDict()  # profile id -> profile dict, oldest first
+profiling_lock = asyncio.Lock()
+
+# Both profilers see the whole event-loop thread, so time spent in other
+# requests while this one awaits I/O is attributed to their stacks.
+def frame_name(code) -> str:
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+class StackTracer:
+    """Deterministic profiler: wall time between profile events is charged to the current stack"""
+    def __init__(self):
+        self.weights = {}  # collapsed stack -> microseconds
+        self._stack = []
+        self._last = 0
+
+    def start(self):
+        self._last = time.perf_counter_ns()
+        sys.setprofile(self._profile)
+
+    def stop(self):
+        sys.setprofile(None)
+
+    def _profile(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        if self._stack:
+            stack = ';'.join(self._stack)
+            self.weights[stack] = self.weights.get(stack, 0) + (now - self._last) // 1000
+        if event == 'call':
+            self._stack.append(frame_name(frame.f_code))
+        elif event == 'c_call':
+            self._stack.append(f"{getattr(arg, '__qualname__', getattr(arg, '__name__', 'builtin'))} (builtin)")
+        elif self._stack:  # return, c_return, c_exception
+            self._stack.pop()
+        self._last = time.perf_counter_ns()
+
+class StackSampler:
+    """Samples the event-loop thread's Python stack from a background thread"""
+    def __init__(self, interval_ms: float):
+        self.thread_id = threading.get_ident()
+        self.interval_ms = interval_ms
+        self.weights = {}  # collapsed stack -> microseconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        weight = int(self.interval_ms * 1000)
+        while not self._stop.wait(self.interval_ms / 1000):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                self.weights[stack] = self.weights.get(stack, 0) + weight
+
+def collapsed_stacks(profile: dict) -> str:
+    return ''.join(f"{stack} {weight}\n" for stack, weight in profile['weights'].items() if weight > 0)
+
+def speedscope_profile(profile: dict) -> dict:
+    frames, frame_index, samples, weights = [], {}, [], []
+    for stack, weight in profile['weights'].items():
+        indices = []
+        for name in stack.split(';'):
+            if name not in frame_index:
+                frame_index[name] = len(frames)
+                frames.append({'name': name})
+            indices.append(frame_index[name])
+        samples.append(indices)
+        weights.append(weight)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': f"{profile['method']} {profile['path']}",
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': profile['request_id'],
+            'unit': 'microseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights
+        }]
+    }
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        mode = next((value for key, value in scope['headers'] if key == PROFILE_HEADER), None)
+        if mode is None:
+            return await self.app(scope, receive, send)
+        try:
+            await get_admin_user(Request(scope))
+        except HTTPException:
+            return await self.app(scope, receive, send)
+
+        if profiling_lock.locked():
+            response = ORJSONResponse({'detail': "Another request is being profiled"}, status_code=409)
+            return await response(scope, receive, send)
+
+        ctx = request_context.get()
+        request_id = ctx.request_id if ctx else '-'
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_profile_id(message):
+            if message['type'] == 'http.response.start':
+                MutableHeaders(raw=message['headers'])['X-Profile-ID'] = profile_id
+            await send(message)
+
+        async with profiling_lock:
+            profiler = StackSampler(PROFILE_SAMPLE_INTERVAL_MS) if mode == b'sample' else StackTracer()
+            started = time.perf_counter()
+            profiler.start()
+            try:
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                profiler.stop()
+                profiles[profile_id] = {
+                    'id': profile_id,
+                    'request_id': request_id,
+                    'method': scope['method'],
+                    'path': scope['path'],
+                    'profiler': 'sample' if isinstance(profiler, StackSampler) else 'trace',
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+                    'created_at': datetime.now(timezone.utc).isoformat(),
+                    'weights': profiler.weights
+                }
+                while len(profiles) > PROFILE_HISTORY:
+                    profiles.popitem(last=False)
+
+@api_router.get("/admin/profiles")
+async def list_profiles(request: Request):
+    """Admin-only: Recent request profiles, newest first"""
+    await get_admin_user(request)
+    return [
+        {key: value for key, value in profile.items() if key != 'weights'}
+        for profile in reversed(profiles.values())
+    ]
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request, format: str = 'speedscope'):
+    """Admin-only: One profile as speedscope JSON or collapsed stacks (format=collapsed)"""
+    await get_admin_user(request)
+    profile = profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == 'collapsed':
+        return Response(content=collapsed_stacks(profile), media_type='text/plain')
+    return speedscope_profile(profile)
+
+
+# ============= METRICS ROUTE =============
+# Scrapers send `Authorization: Bearer $METRICS_TOKEN`. Without a token
+# configured the route is off, as it reveals traffic per route to anyone.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not secrets.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 # Include the router
 app.include_router(api_router)
 
@@ -1002,6 +4294,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(RequestContextMiddleware)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -1009,6 +4304,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+INDEXES = {
+    'users': [('id', True), ('email', False), ([('xp', -1), ('id', 1)], False), ('category_xp.$**', False)],
+    'user_sessions': [('session_token', False)],
+    'skills': [('id', True), ('prerequisites', False)],
+    'lessons': [('id', True), ([('skill_id', 1), ('order', 1)], False)],
+    'user_skills': [([('user_id', 1), ('skill_id', 1)], False), ('skill_id', False)],
+    'user_lessons': [([('user_id', 1), ('lesson_id', 1)], False), ('lesson_id', False)],
+    'external_connections': [([('user_id', 1), ('platform', 1)], False)],
+    'cascade_jobs': [('id', True), ('status', False)],
+    'changes': [([('collection', 1), ('doc_id', 1)], True), ([('scope', 1), ('seq', 1)], False)],
+    'idempotency_keys': [('expires_at', False, {'expireAfterSeconds': 0})],
+}
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Index every lookup the routes make; a no-op when the indexes already exist"""
+    for collection, indexes in INDEXES.items():
+        for keys, unique, *options in indexes:
+            try:
+                await db[collection].create_index(keys, unique=unique, **(options[0] if options else {}))
+            except Exception as e:
+                logger.error(f"Could not create index {keys} on {collection}: {e}")
+
+@app.on_event("startup")
+async def resume_background_jobs():
+    await resume_cascade_jobs()
+    cascade_state['retry'] = asyncio.create_task(retry_cascade_jobs())
+    search_state['task'] = asyncio.create_task(build_search_index())
+    catalog_state['watcher'] = asyncio.create_task(watch_catalog_version())
+    leaderboard_state['task'] = asyncio.create_task(maintain_leaderboards())
+    await event_broker.start()
+    progress_buffer.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in (leaderboard_state['task'], catalog_state['watcher'], cascade_state['retry']):
+        if task:
+            task.cancel()
+    await event_broker.stop()
+    await progress_buffer.stop()
     client.close()
+    for read_client in read_clients.values():
+        read_client.close()
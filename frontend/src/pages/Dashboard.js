@@ -24,14 +24,10 @@ const Dashboard = ({ user, onLogout }) => {
 
   const fetchDashboardData = async () => {
     try {
-      const [statsRes, achievementsRes, activityRes] = await Promise.all([
-        axios.get(`${API}/dashboard/stats`, { withCredentials: true }),
-        axios.get(`${API}/achievements`, { withCredentials: true }),
-        axios.get(`${API}/activity-feed`, { withCredentials: true })
-      ]);
-      setStats(statsRes.data);
-      setAchievements(achievementsRes.data);
-      setActivityFeed(activityRes.data);
+      const response = await axios.get(`${API}/dashboard`, { withCredentials: true });
+      setStats(response.data.stats);
+      setAchievements(response.data.achievements);
+      setActivityFeed(response.data.activity_feed);
     } catch (error) {
       toast.error('Failed to load dashboard data');
     } finally {
@@ -0,0 +1,67 @@
+"""In-process fixtures: the FastAPI app over ASGI, an isolated database per test and a fake LLM.
+
+Tests use the in-memory mongomock backend unless TEST_MONGO_URL points at a
+local mongod, in which case every test gets its own throwaway database. Query
+budgets declared with @query_budget are enforced strictly. Run in parallel
+with `pytest -n auto`.
+"""
+import os
+import uuid
+
+import pytest
+
+from tests import support
+
+import server  # noqa: E402  (support sets up sys.path and the environment first)
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+def fake_llm():
+    support.FakeLlmChat.latency = 0.0
+    support.FakeLlmChat.responder = None
+    support.FakeLlmChat.calls = []
+    return support.FakeLlmChat
+
+
+@pytest.fixture
+async def database():
+    mongo_url = os.environ.get('TEST_MONGO_URL')
+    if not mongo_url:
+        yield support.memory_database()
+        return
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+    database = support.mongo_database(mongo_url, f'skilltree_test_{worker}_{uuid.uuid4().hex[:8]}')
+    yield database
+    await database.client.drop_database(database.name)
+    database.client.close()
+
+
+@pytest.fixture
+async def client(database, fake_llm, monkeypatch):
+    monkeypatch.setattr(server, 'MONGO_QUERY_BUDGET_STRICT', True)
+    support.install(database, fake_llm)
+    async with support.asgi_client() as http_client:
+        yield http_client
+    await support.drain_background_tasks()
+
+
+@pytest.fixture
+async def seeded(client):
+    response = await client.post('/api/seed-data')
+    assert response.status_code == 200
+    return client
+
+
+@pytest.fixture
+async def user_headers(database):
+    return await support.create_user(database, 'user-1')
+
+
+@pytest.fixture
+async def admin_headers(database):
+    return await support.create_user(database, 'admin-1', is_admin=True)
@@ -0,0 +1,320 @@
+"""Generate a large synthetic SkillTree dataset and bulk-load it into Mongo.
+
+    python -m tests.dataset --mongo-url mongodb://localhost:27017 --db-name skilltree_scale \
+        --skills 5000 --users 200000 --seed 1 --drop
+
+Skills form a valid prerequisite DAG (prerequisites are always earlier skills,
+mostly from the same category), every skill has a handful of lessons, and user
+progress follows a power law: most users have finished a few skills, a few have
+finished hundreds. Users only progress along the DAG and their xp/level match
+what they completed, so the data holds the same invariants the API maintains.
+Users also get sessions and external connections.
+
+Documents are streamed into unordered insert_many batches with several batches
+in flight, so memory stays flat however many users are generated. The same
+arguments (including --as-of, which all timestamps are relative to) always
+produce the same documents.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+COLLECTIONS = ['skills', 'lessons', 'users', 'user_skills', 'user_lessons', 'user_sessions', 'external_connections']
+
+CATEGORIES = [
+    ('Frontend', 'Layout'), ('Backend', 'Server'), ('Databases', 'Database'), ('DevOps', 'GitBranch'),
+    ('Data Science', 'BarChart'), ('Machine Learning', 'Brain'), ('Mobile', 'Smartphone'),
+    ('Security', 'Shield'), ('Cloud', 'Cloud'), ('Systems', 'Cpu'), ('Design', 'PenTool'), ('Testing', 'CheckCircle')
+]
+SUBJECTS = [
+    'Fundamentals', 'Patterns', 'Performance', 'Tooling', 'Architecture', 'Debugging', 'Concurrency', 'Scaling',
+    'Automation', 'Observability', 'Internals', 'APIs', 'Modeling', 'Optimization', 'Deployment', 'Workflows'
+]
+PREFIXES = ['Intro to', 'Practical', 'Applied', 'Advanced', 'Modern', 'Deep Dive:', 'Hands-on', 'Mastering']
+WORDS = (
+    'build test deploy model query index cache stream render schema service request response client server '
+    'module function state event queue thread process memory latency throughput token graph tree node edge '
+    'layer network storage record field value error retry timeout version release review design pattern'
+).split()
+PLATFORMS = ['github', 'linkedin', 'youtube']
+CATEGORY_WIDTH = 40  # tree columns per category, so categories sit side by side
+
+
+class Catalog:
+    """Generated skills and lessons plus the adjacency users progress along"""
+
+    def __init__(self, skills, lessons):
+        self.skills = skills
+        self.lessons = lessons  # skill index -> [lesson doc]
+        index_of = {skill['id']: i for i, skill in enumerate(skills)}
+        self.prerequisite_counts = [len(skill['prerequisites']) for skill in skills]
+        self.children = [[] for _ in skills]
+        for i, skill in enumerate(skills):
+            for prerequisite in skill['prerequisites']:
+                self.children[index_of[prerequisite]].append(i)
+        self.roots = [i for i, count in enumerate(self.prerequisite_counts) if count == 0]
+
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def build_catalog(rng, skill_count, lessons_per_skill, lesson_words):
+    skills = []
+    lessons = []
+    by_category = [[] for _ in CATEGORIES]
+    depths = []
+    slots = {}  # (category, depth) -> skills placed so far
+    for i in range(skill_count):
+        category = rng.randrange(len(CATEGORIES))
+        local = by_category[category]
+        prerequisites = set()
+        if local:
+            for _ in range(rng.choice((0, 1, 1, 1, 2, 2, 3))):
+                if rng.random() < 0.1:
+                    prerequisites.add(rng.randrange(i))
+                else:
+                    prerequisites.add(rng.choice(local[-50:]))
+        depth = 1 + max((depths[p] for p in prerequisites), default=-1)
+        depths.append(depth)
+        slot = slots.get((category, depth), 0)
+        slots[(category, depth)] = slot + 1
+        local.append(i)
+
+        name, icon = CATEGORIES[category]
+        skills.append({
+            'id': f'skill-{i + 1}',
+            'name': f'{rng.choice(PREFIXES)} {name} {rng.choice(SUBJECTS)} {i + 1}',
+            'description': words(rng, 12).capitalize(),
+            'category': name,
+            'difficulty': 'beginner' if depth < 2 else 'intermediate' if depth < 5 else 'advanced',
+            'prerequisites': sorted(f'skill-{p + 1}' for p in prerequisites),
+            'xp_value': 100 + 50 * min(depth, 8) + 10 * rng.randrange(0, 10),
+            'icon': icon,
+            'position': {'x': category * CATEGORY_WIDTH + slot % CATEGORY_WIDTH, 'y': depth}
+        })
+        count = max(1, round(rng.gauss(lessons_per_skill, lessons_per_skill / 3)))
+        lessons.append([{
+            'id': f'lesson-{i + 1}-{n}',
+            'skill_id': f'skill-{i + 1}',
+            'title': f'{rng.choice(SUBJECTS)}: {words(rng, 3)}',
+            'content': words(rng, lesson_words),
+            'order': n,
+            'estimated_time': rng.randrange(10, 61, 5),
+            'resources': [{'title': 'Reference', 'url': f'https://example.com/skill-{i + 1}/{n}'}]
+        } for n in range(1, count + 1)])
+    return Catalog(skills, lessons)
+
+
+def walk(rng, catalog, steps):
+    """Complete up to `steps` skills along the DAG; returns (completed, still available)"""
+    remaining = {}
+    frontier = list(catalog.roots)
+    completed = []
+    while frontier and len(completed) < steps:
+        pick = rng.randrange(len(frontier))
+        frontier[pick], frontier[-1] = frontier[-1], frontier[pick]
+        index = frontier.pop()
+        completed.append(index)
+        for child in catalog.children[index]:
+            left = remaining.get(child, catalog.prerequisite_counts[child]) - 1
+            remaining[child] = left
+            if left == 0:
+                frontier.append(child)
+    return completed, frontier
+
+
+def user_documents(rng, catalog, number, args, as_of):
+    """Every document belonging to user `number`, as (collection, doc) pairs"""
+    user_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    created = as_of - timedelta(seconds=rng.randrange(1, 730 * 86400))
+    span = (as_of - created).total_seconds()
+
+    def moment():
+        return (created + timedelta(seconds=rng.random() * span)).isoformat()
+
+    steps = min(len(catalog.skills), int(rng.paretovariate(args.progress_alpha)) - 1)
+    completed, available = walk(rng, catalog, steps)
+    in_progress = rng.sample(available, min(len(available), rng.choice((0, 0, 1, 1, 2, 3))))
+
+    category_xp = {}
+    for index in completed:
+        skill = catalog.skills[index]
+        category_xp[skill['category']] = category_xp.get(skill['category'], 0) + skill['xp_value']
+        started_at, completed_at = sorted((moment(), moment()))
+        yield 'user_skills', {
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'user_id': user_id,
+            'skill_id': skill['id'],
+            'status': 'completed',
+            'progress_percent': 100,
+            'started_at': started_at,
+            'completed_at': completed_at
+        }
+        if args.lesson_progress:
+            for lesson in catalog.lessons[index]:
+                yield 'user_lessons', {'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)), 'user_id': user_id, 'lesson_id': lesson['id'], 'completed': True, 'completed_at': completed_at}
+    for index in in_progress:
+        lessons = catalog.lessons[index]
+        done = rng.randrange(len(lessons)) if args.lesson_progress else 0
+        yield 'user_skills', {
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'user_id': user_id,
+            'skill_id': catalog.skills[index]['id'],
+            'status': 'in_progress',
+            'progress_percent': int((done / len(lessons)) * 100),
+            'started_at': moment(),
+            'completed_at': None
+        }
+        for lesson in lessons[:done]:
+            yield 'user_lessons', {'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)), 'user_id': user_id, 'lesson_id': lesson['id'], 'completed': True, 'completed_at': moment()}
+
+    oauth = rng.random() < 0.6
+    xp = sum(category_xp.values())
+    yield 'users', {
+        'id': user_id,
+        'email': f'user{number}@example.com',
+        'name': f'User {number}',
+        'picture': f'https://example.com/avatars/{number}.png' if oauth else None,
+        'xp': xp,
+        'level': 1 + (xp // 1000),
+        'category_xp': category_xp,
+        'is_admin': number < args.admins,
+        'created_at': created.isoformat(),
+        'auth_type': 'oauth' if oauth else 'jwt'
+    }
+    if oauth and rng.random() < args.session_rate:
+        for _ in range(rng.randrange(1, 4)):
+            expires_at = as_of + timedelta(days=rng.uniform(-7, 7))
+            yield 'user_sessions', {
+                'user_id': user_id,
+                'session_token': '%032x' % rng.getrandbits(128),
+                'expires_at': expires_at.isoformat(),
+                'created_at': (expires_at - timedelta(days=7)).isoformat()
+            }
+    for platform in PLATFORMS:
+        if rng.random() < args.connection_rate:
+            connected = rng.random() < 0.85
+            yield 'external_connections', {
+                'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                'user_id': user_id,
+                'platform': platform,
+                'connected': connected,
+                'platform_data': {'username': f'user{number}', 'items': rng.randrange(0, 200)} if connected else None,
+                'connected_at': moment() if connected else None
+            }
+
+
+def generate(args, as_of):
+    """Yield (collection, doc) for the whole dataset described by `args`, deterministically"""
+    rng = random.Random(args.seed)
+    catalog = build_catalog(rng, args.skills, args.lessons_per_skill, args.lesson_words)
+    for skill, lessons in zip(catalog.skills, catalog.lessons):
+        yield 'skills', skill
+        for lesson in lessons:
+            yield 'lessons', lesson
+    for number in range(args.users):
+        # A generator per user keeps each user's documents independent of the others' counts
+        yield from user_documents(random.Random(rng.getrandbits(64)), catalog, number, args, as_of)
+
+
+async def load(database, documents, batch_size=5000, concurrency=4):
+    """insert_many(ordered=False) `documents` in batches, `concurrency` batches in flight; returns counts"""
+    buffers = {}
+    counts = {}
+    in_flight = set()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def insert(collection, batch):
+        try:
+            await database[collection].insert_many(batch, ordered=False)
+        finally:
+            slots.release()
+
+    async def flush(collection):
+        batch = buffers.pop(collection)
+        await slots.acquire()
+        task = asyncio.create_task(insert(collection, batch))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    for collection, doc in documents:
+        buffer = buffers.setdefault(collection, [])
+        buffer.append(doc)
+        counts[collection] = counts.get(collection, 0) + 1
+        if len(buffer) >= batch_size:
+            await flush(collection)
+            for task in [t for t in in_flight if t.done()]:
+                task.result()
+    for collection in list(buffers):
+        await flush(collection)
+    await asyncio.gather(*in_flight)
+    return counts
+
+
+async def run(args):
+    as_of = datetime.fromisoformat(args.as_of) if args.as_of else datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if as_of.tzinfo is None:
+        as_of = as_of.replace(tzinfo=timezone.utc)
+    client = AsyncIOMotorClient(args.mongo_url)
+    database = client[args.db_name]
+    try:
+        if args.drop:
+            for collection in COLLECTIONS:
+                await database[collection].drop()
+        elif await database.skills.count_documents({}, limit=1):
+            raise SystemExit(f'{args.db_name} already has skills; pass --drop to replace them')
+
+        started = time.perf_counter()
+        counts = await load(database, generate(args, as_of), args.batch_size, args.concurrency)
+        elapsed = time.perf_counter() - started
+    finally:
+        client.close()
+    total = sum(counts.values())
+    return {
+        'database': args.db_name,
+        'as_of': as_of.isoformat(),
+        'documents': counts,
+        'elapsed_s': round(elapsed, 2),
+        'documents_per_s': round(total / elapsed) if elapsed else total
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo-url', default='mongodb://localhost:27017')
+    parser.add_argument('--db-name', default='skilltree_scale')
+    parser.add_argument('--drop', action='store_true', help='drop the generated collections first')
+    parser.add_argument('--skills', type=int, default=2000)
+    parser.add_argument('--lessons-per-skill', type=float, default=5, help='mean lessons per skill')
+    parser.add_argument('--lesson-words', type=int, default=120, help='words of content per lesson')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--admins', type=int, default=1, help='the first N users are admins')
+    parser.add_argument('--progress-alpha', type=float, default=1.16,
+                        help='Pareto shape of completed skills per user (lower = heavier tail)')
+    parser.add_argument('--no-lesson-progress', dest='lesson_progress', action='store_false',
+                        help='skip user_lessons, by far the largest collection')
+    parser.add_argument('--session-rate', type=float, default=0.5, help='share of OAuth users with sessions')
+    parser.add_argument('--connection-rate', type=float, default=0.2, help='chance of each external connection')
+    parser.add_argument('--as-of', help='ISO timestamp all dates are relative to (default: start of today, UTC)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=4, help='insert_many batches in flight')
+    return parser
+
+
+def main(argv=None):
+    report = asyncio.run(run(build_parser().parse_args(argv)))
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
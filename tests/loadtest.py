@@ -0,0 +1,177 @@
+"""Concurrent load test of realistic user journeys against server.app.
+
+Each journey signs in, views the skill tree (including an ETag revalidation),
+asks for AI recommendations, starts an available skill, works through its lessons, completes it and opens
+the dashboard. Journeys arrive at a fixed rate and run in-process over ASGI
+against an in-memory database (or a local Mongo with --mongo-url) with a
+deterministic fake LLM, so no credentials or running server are needed.
+
+    python -m tests.loadtest --rate 20 --duration 30 --output loadtest.json
+
+The report is JSON: throughput, p50/p95/p99 latency and error rate per route.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+import uuid
+
+from tests import support
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = {}  # route -> [seconds]
+        self.errors = {}  # route -> count
+        self.journeys = {'started': 0, 'completed': 0, 'failed': 0}
+
+    def record(self, route, seconds, ok):
+        self.latencies.setdefault(route, []).append(seconds)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        routes = {}
+        total_requests = 0
+        total_errors = 0
+        for route, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            errors = self.errors.get(route, 0)
+            total_requests += len(values)
+            total_errors += errors
+            routes[route] = {
+                'requests': len(values),
+                'throughput_rps': round(len(values) / elapsed, 2),
+                'error_rate': round(errors / len(values), 4),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2)
+            }
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'requests': total_requests,
+            'throughput_rps': round(total_requests / elapsed, 2) if elapsed else 0,
+            'error_rate': round(total_errors / total_requests, 4) if total_requests else 0,
+            'journeys': self.journeys,
+            'routes': routes
+        }
+
+
+class JourneyClient:
+    def __init__(self, client, headers, stats):
+        self.client = client
+        self.headers = headers
+        self.stats = stats
+
+    async def call(self, method, route, headers=None, expect=(200,), **path_params):
+        started = time.perf_counter()
+        response = await self.client.request(method, route.format(**path_params), headers={**self.headers, **(headers or {})})
+        self.stats.record(f'{method} {route}', time.perf_counter() - started, response.status_code in expect)
+        if response.status_code not in expect:
+            raise RuntimeError(f'{method} {route} returned {response.status_code}')
+        return response
+
+
+async def user_journey(journey, rng):
+    await journey.call('GET', '/api/auth/me')
+    response = await journey.call('GET', '/api/skills')
+    skills = response.json()
+    await journey.call('GET', '/api/skills', headers={'If-None-Match': response.headers.get('etag', '')}, expect=(200, 304))
+    await journey.call('POST', '/api/ai/recommend-skills')
+
+    available = [skill for skill in skills if skill['user_status'] == 'available']
+    if not available:
+        await journey.call('GET', '/api/dashboard')
+        return
+    skill_id = rng.choice(available)['id']
+    await journey.call('GET', '/api/skills/{skill_id}', skill_id=skill_id)
+    await journey.call('POST', '/api/user-skills/{skill_id}/start', skill_id=skill_id)
+    lessons = (await journey.call('GET', '/api/skills/{skill_id}/lessons', skill_id=skill_id)).json()
+    for lesson in lessons:
+        await journey.call('POST', '/api/lessons/{lesson_id}/complete', lesson_id=lesson['id'])
+    await journey.call('POST', '/api/user-skills/{skill_id}/complete', skill_id=skill_id)
+    await journey.call('GET', '/api/dashboard')
+
+
+async def run(args):
+    if args.mongo_url:
+        database = support.mongo_database(args.mongo_url, args.db_name or f'skilltree_load_{uuid.uuid4().hex[:8]}')
+    else:
+        database = support.memory_database()
+    support.FakeLlmChat.latency = args.llm_latency
+    support.install(database)
+
+    rng = random.Random(args.seed)
+    stats = RouteStats()
+    async with support.asgi_client() as client:
+        await client.post('/api/seed-data')
+        users = [await support.create_user(database, f'load-user-{i}') for i in range(args.users)]
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one_journey(index):
+            async with semaphore:
+                stats.journeys['started'] += 1
+                journey = JourneyClient(client, users[index % len(users)], stats)
+                try:
+                    await user_journey(journey, random.Random(rng.random()))
+                    stats.journeys['completed'] += 1
+                except Exception:
+                    stats.journeys['failed'] += 1
+
+        total = int(args.rate * args.duration)
+        started = time.perf_counter()
+        tasks = []
+        for index in range(total):
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one_journey(index)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    report = stats.report(elapsed)
+    report['config'] = {key: value for key, value in vars(args).items() if key not in ('output', 'verbose')}
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10, help='journeys started per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to keep starting journeys')
+    parser.add_argument('--concurrency', type=int, default=50, help='maximum journeys in flight')
+    parser.add_argument('--users', type=int, default=200, help='distinct users journeys cycle through')
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='seconds the fake LLM takes per call')
+    parser.add_argument('--mongo-url', help='use this Mongo instead of the in-memory stand-in')
+    parser.add_argument('--db-name', help='database name with --mongo-url (default: a fresh one)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='keep the per-request access log')
+    args = parser.parse_args(argv)
+    if not args.verbose:
+        logging.getLogger('server').setLevel(logging.WARNING)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0 if report['error_rate'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
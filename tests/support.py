@@ -0,0 +1,239 @@
+"""Shared pieces for driving server.app in-process.
+
+Provides a deterministic stand-in for LlmChat, in-memory (mongomock-motor) or
+real Mongo databases, and helpers to point the server module at them.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import uuid
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+# server.py reads these at import time; nothing connects to this URL unless asked to
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'skilltree_test')
+os.environ.setdefault('JWT_SECRET', 'skilltree-test-secret-skilltree-test-secret')
+os.environ.setdefault('EMERGENT_LLM_KEY', 'fake-llm-key')
+
+import httpx  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+import server  # noqa: E402
+
+
+class FakeLlmChat:
+    """Deterministic LlmChat: same prompt, same answer, optional fixed latency.
+
+    Set `responder` to a callable (provider, model, text) -> str to script replies.
+    """
+    latency = 0.0
+    responder = None
+    calls = []
+
+    def __init__(self, api_key=None, session_id=None, system_message=None):
+        self.session_id = session_id
+        self.system_message = system_message
+        self.provider = None
+        self.model = None
+
+    def with_model(self, provider, model):
+        self.provider = provider
+        self.model = model
+        return self
+
+    async def send_message(self, message):
+        FakeLlmChat.calls.append((self.provider, self.model, message.text))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if FakeLlmChat.responder is not None:
+            return FakeLlmChat.responder(self.provider, self.model, message.text)
+        match = re.search(r'Generate (\d+) lessons for: (.+?) \(Level', message.text)
+        if match:
+            count, topic = int(match.group(1)), match.group(2)
+            lessons = [
+                {
+                    'title': f'{topic} part {i + 1}',
+                    'content': f'Deterministic lesson {i + 1} about {topic}.',
+                    'estimated_time': 20,
+                    'resources': []
+                }
+                for i in range(count)
+            ]
+            return f"```json\n{json.dumps(lessons)}\n```"
+        return f"[{self.provider}/{self.model}] deterministic reply to: {message.text[:80]}"
+
+
+COMMANDS = {
+    'find': 'find', 'find_one': 'find', 'distinct': 'distinct',
+    'count_documents': 'aggregate', 'aggregate': 'aggregate',
+    'insert_one': 'insert', 'insert_many': 'insert',
+    'update_one': 'update', 'update_many': 'update', 'replace_one': 'update',
+    'delete_one': 'delete', 'delete_many': 'delete', 'bulk_write': 'bulkWrite',
+    'find_one_and_update': 'findAndModify', 'find_one_and_delete': 'findAndModify',
+    'find_one_and_replace': 'findAndModify',
+}
+
+
+class CountingCollection:
+    """Counts commands against the current request the way MongoCommandListener does for a real server"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        command = COMMANDS.get(name)
+        if command is None:
+            return attr
+
+        def counted(*args, **kwargs):
+            ctx = server.request_context.get()
+            if ctx is not None:
+                ctx.query_count += 1
+                ctx.commands.append((command, self._collection.name))
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountingDatabase:
+    def __init__(self, database):
+        self._database = database
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self._database, name)
+        return CountingCollection(attr) if hasattr(attr, 'find_one') else attr
+
+
+def memory_database(name: str = 'skilltree_test'):
+    """In-memory database; mongomock emits no command events, so commands are counted by a proxy"""
+    import mongomock_motor
+    return CountingDatabase(mongomock_motor.AsyncMongoMockClient()[name])
+
+
+def mongo_database(url: str, name: str):
+    return AsyncIOMotorClient(url, event_listeners=[server.MongoCommandListener()])[name]
+
+
+def install(database, llm_class=FakeLlmChat):
+    """Point the server module at `database` and `llm_class`, dropping anything cached from a previous one"""
+    server.db = database
+    server.read_databases.clear()  # every query class reads `database`
+    server.last_writes.clear()
+    server.LlmChat = llm_class
+    server.catalog_state['snapshot'] = None
+    server.cascade_tasks.clear()
+    server.leaderboards.clear()
+    server.search_state.update(index=None, task=None)
+    server.sequence_state['seen'] = 0
+    server.event_hub.subscribers.clear()
+    server.progress_buffer.pending.clear()
+    server.idempotency_cache.clear()
+    server.idempotency_inflight.clear()
+    server.observe_catalog_version({'epoch': uuid.uuid4().hex, 'seq': 0})  # a fresh epoch: no ETag carries over
+
+
+async def drain_background_tasks():
+    """Wait for background work the last requests started, such as deletion cascades"""
+    while server.cascade_tasks:
+        await asyncio.gather(*list(server.cascade_tasks.values()))
+
+
+def asgi_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url='http://skilltree.test')
+
+
+class WebSocketSession:
+    """A WebSocket connection to the app over raw ASGI, since the httpx transport only speaks HTTP"""
+    def __init__(self, path: str, query: str = '', headers: dict = None, subprotocols: list = ()):
+        self.scope = {
+            'type': 'websocket', 'asgi': {'version': '3.0'}, 'scheme': 'ws', 'http_version': '1.1',
+            'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': query.encode(),
+            'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+            'client': ('127.0.0.1', 50000), 'server': ('skilltree.test', 80), 'subprotocols': list(subprotocols),
+        }
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        self.task = None
+
+    async def __aenter__(self):
+        await self.incoming.put({'type': 'websocket.connect'})
+        self.task = asyncio.create_task(server.app(self.scope, self.incoming.get, self.outgoing.put))
+        self.opening = await asyncio.wait_for(self.outgoing.get(), 1)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, 1)
+
+    async def receive_json(self, timeout: float = 1) -> dict:
+        message = await asyncio.wait_for(self.outgoing.get(), timeout)
+        assert message['type'] == 'websocket.send', message
+        return json.loads(message['text'])
+
+
+async def create_user(database, user_id: str, is_admin: bool = False) -> dict:
+    """Insert a user and return Authorization headers for it"""
+    await database.users.insert_one({
+        'id': user_id,
+        'email': f'{user_id}@example.com',
+        'name': user_id,
+        'xp': 0,
+        'level': 1,
+        'category_xp': {},
+        'category_xp_backfilled': True,
+        'is_admin': is_admin,
+        'auth_type': 'jwt',
+        'created_at': '2025-01-01T00:00:00+00:00'
+    })
+    return {'Authorization': f'Bearer {server.create_token(user_id)}'}
+
+
+def synthetic_skill_docs(count: int, seed: int = 7) -> list:
+    """A catalog of `count` skills whose prerequisites form a DAG over earlier skills"""
+    rng = random.Random(seed)
+    categories = [f'Category {i}' for i in range(max(1, min(40, count // 50)))]
+    docs = []
+    for i in range(count):
+        prereq_count = 0 if i == 0 else rng.choice((0, 1, 1, 2, 3))
+        prerequisites = sorted({f'skill-{rng.randrange(max(0, i - 200), i)}' for _ in range(prereq_count)})
+        docs.append({
+            'id': f'skill-{i}',
+            'name': f'Skill {i}',
+            'description': f'Learn everything about topic number {i}',
+            'category': rng.choice(categories),
+            'difficulty': rng.choice(('beginner', 'intermediate', 'advanced')),
+            'prerequisites': prerequisites,
+            'xp_value': rng.randrange(100, 600, 10),
+            'icon': 'Code',
+            'position': {'x': i % 100, 'y': i // 100},
+        })
+    return docs
+
+
+def synthetic_user_skills(skill_docs: list, count: int, user_id: str = 'user-1', seed: int = 11) -> list:
+    """`count` user_skills over the catalog, about two thirds completed"""
+    rng = random.Random(seed)
+    chosen = rng.sample(skill_docs, min(count, len(skill_docs)))
+    user_skills = []
+    for i, skill in enumerate(chosen):
+        completed = rng.random() < 0.67
+        user_skills.append({
+            'id': f'us-{i}',
+            'user_id': user_id,
+            'skill_id': skill['id'],
+            'status': 'completed' if completed else 'in_progress',
+            'progress_percent': 100 if completed else rng.randrange(0, 100),
+            'started_at': f'2025-01-01T00:00:{i % 60:02d}+00:00',
+            'completed_at': f'2025-02-{1 + i % 28:02d}T{i % 24:02d}:00:00+00:00' if completed else None,
+        })
+    return user_skills
@@ -0,0 +1,1001 @@
+"""Functional tests for the API, driven in-process (see conftest.py)."""
+import asyncio
+import base64
+import json
+import random
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import server
+from tests import support
+
+pytestmark = pytest.mark.anyio
+
+
+async def skill_statuses(client, headers):
+    response = await client.get('/api/skills', headers=headers)
+    assert response.status_code == 200
+    return {skill['id']: skill['user_status'] for skill in response.json()}
+
+
+async def test_auth_me_requires_a_valid_token(client, user_headers):
+    assert (await client.get('/api/auth/me')).status_code == 401
+    assert (await client.get('/api/auth/me', headers={'Authorization': 'Bearer nonsense'})).status_code == 401
+
+    response = await client.get('/api/auth/me', headers=user_headers)
+    assert response.status_code == 200
+    assert response.json()['id'] == 'user-1'
+    assert response.headers['x-request-id']
+
+
+async def test_seed_data_is_idempotent(seeded):
+    response = await seeded.post('/api/seed-data')
+    assert response.json() == {'message': 'Data already seeded'}
+
+
+async def test_skill_tree_statuses_follow_prerequisites(seeded, user_headers):
+    statuses = await skill_statuses(seeded, user_headers)
+    assert statuses['skill-1'] == 'available'
+    assert statuses['skill-2'] == 'locked'
+
+    assert (await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)).status_code == 200
+    assert (await skill_statuses(seeded, user_headers))['skill-1'] == 'in_progress'
+
+    response = await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    assert response.json() == {'message': 'Skill completed', 'xp_earned': 100, 'total_xp': 100, 'level': 1}
+
+    statuses = await skill_statuses(seeded, user_headers)
+    assert statuses['skill-1'] == 'completed'
+    assert statuses['skill-2'] == 'available'
+    assert statuses['skill-19'] == 'locked'
+
+
+async def test_start_skill_errors(seeded, user_headers):
+    assert (await seeded.post('/api/user-skills/missing/start', headers=user_headers)).status_code == 404
+    assert (await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)).status_code == 200
+    assert (await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)).status_code == 400
+    assert (await seeded.post('/api/user-skills/skill-2/complete', headers=user_headers)).status_code == 404
+
+
+async def test_progress_update(seeded, user_headers):
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    response = await seeded.put('/api/user-skills/skill-1/progress', json={'progress_percent': 40}, headers=user_headers)
+    assert response.json()['progress_percent'] == 40
+    skills = (await seeded.get('/api/skills', headers=user_headers)).json()
+    assert next(s for s in skills if s['id'] == 'skill-1')['user_progress'] == 40
+
+
+async def test_lessons_and_lesson_completion(seeded, user_headers):
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    lessons = (await seeded.get('/api/skills/skill-1/lessons', headers=user_headers)).json()
+    assert [lesson['order'] for lesson in lessons] == [1, 2, 3]
+    assert not any(lesson['completed'] for lesson in lessons)
+
+    response = await seeded.post(f"/api/lessons/{lessons[0]['id']}/complete", headers=user_headers)
+    assert response.json() == {'message': 'Lesson completed', 'progress_percent': 33}
+
+    lessons = (await seeded.get('/api/skills/skill-1/lessons', headers=user_headers)).json()
+    assert [lesson['completed'] for lesson in lessons] == [True, False, False]
+    assert (await seeded.post('/api/lessons/missing/complete', headers=user_headers)).status_code == 404
+
+
+async def test_etag_revalidation_and_invalidation(seeded, user_headers):
+    first = await seeded.get('/api/skills', headers=user_headers)
+    etag = first.headers['etag']
+    assert first.headers['cache-control'] == 'private, no-cache'
+
+    revalidated = await seeded.get('/api/skills', headers={**user_headers, 'If-None-Match': etag})
+    assert revalidated.status_code == 304
+
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    changed = await seeded.get('/api/skills', headers={**user_headers, 'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['etag'] != etag
+    assert (await seeded.get('/api/skills/missing', headers={**user_headers, 'If-None-Match': '*'})).status_code == 404
+
+
+async def test_malformed_documents_are_skipped_not_fatal(seeded, database, user_headers):
+    await database.skills.insert_one({'id': 'skill-broken', 'name': 'No XP or category'})
+    await database.lessons.insert_one({
+        'id': 'lesson-broken', 'skill_id': 'skill-1', 'title': 'Generated', 'content': '...', 'order': 4,
+        'estimated_time': 10, 'resources': [{'title': 'Video', 'minutes': 12}]
+    })
+    await server.bump_catalog_version()
+
+    skills = (await seeded.get('/api/skills', headers=user_headers)).json()
+    assert len(skills) == 20 and 'skill-broken' not in {skill['id'] for skill in skills}
+    lessons = (await seeded.get('/api/skills/skill-1/lessons', headers=user_headers)).json()
+    assert [lesson['id'] for lesson in lessons] == ['lesson-1-1', 'lesson-1-2', 'lesson-1-3']
+
+
+async def test_catalog_writes_by_another_worker_are_picked_up(seeded, database, user_headers):
+    etag = (await seeded.get('/api/skills/skill-1', headers=user_headers)).headers['etag']
+    # Another worker renames a skill, adds one and bumps the shared version
+    await database.skills.update_one({'id': 'skill-1'}, {'$set': {'name': 'HTML Essentials'}})
+    await database.skills.insert_one({**(await database.skills.find_one({'id': 'skill-7'}, {'_id': 0})), 'id': 'skill-new'})
+    await database.counters.update_one({'_id': 'catalog_version'}, {'$inc': {'seq': 1}})
+
+    # A skill this worker has not seen yet is looked up again rather than reported missing
+    assert (await seeded.post('/api/user-skills/skill-new/start', headers=user_headers)).status_code == 200
+    response = await seeded.get('/api/skills/skill-1', headers={**user_headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()['name'] == 'HTML Essentials'
+
+    # Progress versions live on the user document, so every worker sees them
+    user = await database.users.find_one({'id': 'user-1'})
+    assert user['cache_version'] == 1
+
+
+async def test_large_responses_are_compressed(seeded, user_headers):
+    response = await seeded.get('/api/skills', headers={**user_headers, 'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert len(response.json()) == 20
+
+    small = await seeded.get('/api/auth/me', headers={**user_headers, 'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in small.headers
+
+
+async def test_dashboard_matches_individual_endpoints(seeded, user_headers):
+    for skill_id in ('skill-1', 'skill-7', 'skill-11'):
+        await seeded.post(f'/api/user-skills/{skill_id}/start', headers=user_headers)
+        await seeded.post(f'/api/user-skills/{skill_id}/complete', headers=user_headers)
+
+    dashboard = (await seeded.get('/api/dashboard', headers=user_headers)).json()
+    assert dashboard['stats'] == (await seeded.get('/api/dashboard/stats', headers=user_headers)).json()
+    assert dashboard['achievements'] == (await seeded.get('/api/achievements', headers=user_headers)).json()
+    assert dashboard['activity_feed'] == (await seeded.get('/api/activity-feed', headers=user_headers)).json()
+
+    assert dashboard['stats']['skills_completed'] == 3
+    unlocked = {a['id'] for a in dashboard['achievements'] if a['unlocked']}
+    assert unlocked == {'first_skill', 'three_skills', 'three_categories'}
+    assert dashboard['activity_feed'][0]['title'] == 'Completed SQL Basics'
+
+
+async def test_integrations_connect_and_disconnect(client, user_headers):
+    integrations = (await client.get('/api/integrations', headers=user_headers)).json()
+    assert [i['connected'] for i in integrations] == [False, False, False]
+
+    assert (await client.post('/api/integrations/github/connect', json={}, headers=user_headers)).status_code == 200
+    integrations = {i['platform']: i for i in (await client.get('/api/integrations', headers=user_headers)).json()}
+    assert integrations['github']['connected'] is True
+
+    assert (await client.post('/api/integrations/github/disconnect', headers=user_headers)).status_code == 200
+    assert (await client.post('/api/integrations/youtube/disconnect', headers=user_headers)).status_code == 404
+
+
+async def test_ai_routes_use_the_configured_llm(seeded, user_headers, fake_llm):
+    fake_llm.responder = lambda provider, model, text: f'{provider}:{model}'
+    response = await seeded.post('/api/ai/recommend-skills', headers=user_headers)
+    assert response.json()['recommendations'] == 'anthropic:claude-3-7-sonnet-20250219'
+
+    response = await seeded.post('/api/ai/generate-quiz', json={'skill_name': 'HTML'}, headers=user_headers)
+    assert response.json() == {'quiz': 'gemini:gemini-2.5-pro'}
+
+
+async def test_admin_generates_lessons_for_a_new_skill(client, admin_headers, user_headers):
+    body = {
+        'new_skill_name': 'Rust',
+        'new_skill_category': 'Systems',
+        'topic': 'Ownership',
+        'difficulty': 'intermediate',
+        'xp_points': 300,
+        'lesson_count': 3,
+        'learning_objective': 'Understand borrowing'
+    }
+    assert (await client.post('/api/admin/lessons/generate', json=body, headers=user_headers)).status_code == 403
+
+    response = await client.post('/api/admin/lessons/generate', json=body, headers=admin_headers)
+    assert response.status_code == 200
+    skill_id = response.json()['skill_id']
+    assert len(response.json()['lessons']) == 3
+
+    skills = (await client.get('/api/admin/skills', headers=admin_headers)).json()
+    assert skill_id in [skill['id'] for skill in skills]
+    lessons = (await client.get(f'/api/skills/{skill_id}/lessons', headers=user_headers)).json()
+    assert [lesson['title'] for lesson in lessons] == ['Ownership part 1', 'Ownership part 2', 'Ownership part 3']
+
+
+async def test_admin_deletes(seeded, admin_headers, user_headers):
+    assert (await seeded.delete('/api/admin/lessons/lesson-1-1', headers=admin_headers)).status_code == 200
+    assert (await seeded.delete('/api/admin/lessons/lesson-1-1', headers=admin_headers)).status_code == 404
+    lessons = (await seeded.get('/api/skills/skill-1/lessons', headers=user_headers)).json()
+    assert [lesson['id'] for lesson in lessons] == ['lesson-1-2', 'lesson-1-3']
+
+    assert (await seeded.delete('/api/admin/skills/skill-20', headers=admin_headers)).status_code == 200
+    assert (await seeded.get('/api/skills/skill-20', headers=user_headers)).status_code == 404
+    assert (await seeded.delete('/api/admin/skills/skill-20', headers=admin_headers)).status_code == 404
+
+
+async def test_skill_deletion_cascades_in_the_background(seeded, database, admin_headers, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'CASCADE_CHUNK_SIZE', 2)
+    for n in range(3):
+        other = await support.create_user(database, f'user-{n + 2}')
+        await seeded.post('/api/user-skills/skill-1/start', headers=other)
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    for lesson in (await seeded.get('/api/skills/skill-1/lessons', headers=user_headers)).json():
+        await seeded.post(f"/api/lessons/{lesson['id']}/complete", headers=user_headers)
+    await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-2/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-2/complete', headers=user_headers)
+    assert (await seeded.get('/api/auth/me', headers=user_headers)).json()['xp'] == 250
+
+    response = await seeded.delete('/api/admin/skills/skill-1', headers=admin_headers)
+    job_id = response.json()['job_id']
+    assert (await seeded.get('/api/skills/skill-1', headers=user_headers)).status_code == 404
+    assert (await seeded.get('/api/skills/skill-1/lessons', headers=user_headers)).status_code == 404
+    assert (await seeded.post('/api/lessons/lesson-1-1/complete', headers=user_headers)).status_code == 404
+    await support.drain_background_tasks()
+
+    job = (await seeded.get(f'/api/admin/cascade-jobs/{job_id}', headers=admin_headers)).json()
+    assert job['status'] == 'done'
+    assert job['progress'] == {'user_lessons': 3, 'user_skills': 4, 'prerequisites': 2, 'lessons': 3, 'skill': 1}
+    assert await database.skills.count_documents({'id': 'skill-1'}) == 0
+    assert await database.user_skills.count_documents({'skill_id': 'skill-1'}) == 0
+    assert await database.user_lessons.count_documents({}) == 0
+    me = (await seeded.get('/api/auth/me', headers=user_headers)).json()
+    assert (me['xp'], me['level']) == (150, 1)
+    assert (await database.users.find_one({'id': 'user-1'}))['category_xp'] == {'Web Development': 150}
+    assert (await seeded.get('/api/skills/skill-2', headers=user_headers)).json()['prerequisites'] == []
+
+
+async def test_unfinished_cascades_resume(seeded, database):
+    skill = await database.skills.find_one({'id': 'skill-2'}, {'_id': 0})
+    job = await server.create_deletion_job(skill)
+    await server.tombstone_skill('skill-2')
+    await database.cascade_jobs.update_one({'id': job['id']}, {'$set': {
+        'status': 'running', 'step': 'prerequisites', 'owner': 'crashed', 'lease_until': '2000-01-01T00:00:00+00:00'
+    }})
+
+    held = await server.create_deletion_job(await database.skills.find_one({'id': 'skill-3'}, {'_id': 0}))
+    await database.cascade_jobs.update_one({'id': held['id']}, {'$set': {
+        'status': 'running', 'owner': 'alive', 'lease_until': server.lease_expiry()
+    }})
+
+    await server.resume_cascade_jobs()
+    assert list(server.cascade_tasks) == [job['id']]  # the live worker keeps its job
+    await support.drain_background_tasks()
+    job = await database.cascade_jobs.find_one({'id': job['id']})
+    assert (job['status'], job['progress']['skill']) == ('done', 1)
+    assert await database.skills.count_documents({'prerequisites': 'skill-2'}) == 0
+
+
+async def test_lesson_completion_racing_a_deletion_leaves_no_row(seeded, database, user_headers):
+    await seeded.get('/api/skills', headers=user_headers)
+    # Deleted by another worker whose catalog version this one has not seen yet
+    await database.skills.update_one({'id': 'skill-1'}, {'$set': {'deleted': True}})
+    assert (await seeded.post('/api/lessons/lesson-1-1/complete', headers=user_headers)).status_code == 404
+    assert await database.user_lessons.count_documents({}) == 0
+
+
+async def test_toggle_admin(client, admin_headers, user_headers):
+    assert (await client.put('/api/admin/users/admin-1/toggle-admin', headers=admin_headers)).status_code == 400
+    response = await client.put('/api/admin/users/user-1/toggle-admin', headers=admin_headers)
+    assert response.json()['is_admin'] is True
+
+
+async def test_metrics_endpoint(seeded, user_headers, monkeypatch):
+    assert (await seeded.get('/metrics')).status_code == 404  # off until a token is configured
+    monkeypatch.setattr(server, 'METRICS_TOKEN', 'scrape-token')
+    assert (await seeded.get('/metrics', headers=user_headers)).status_code == 401
+
+    await seeded.get('/api/skills', headers=user_headers)
+    text = (await seeded.get('/metrics', headers={'Authorization': 'Bearer scrape-token'})).text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/skills",status="200"}' in text
+    assert 'cache_requests_total' in text
+
+
+async def test_profiling_header_is_admin_only(seeded, admin_headers, user_headers):
+    response = await seeded.get('/api/skills', headers={**user_headers, 'X-Profile': '1'})
+    assert 'x-profile-id' not in response.headers
+
+    response = await seeded.get('/api/skills', headers={**admin_headers, 'X-Profile': '1', 'X-Request-ID': 'chosen'})
+    profile_id = response.headers['x-profile-id']
+    assert profile_id != 'chosen'  # clients cannot overwrite each other's profiles
+    collapsed = await seeded.get(f'/api/admin/profiles/{profile_id}?format=collapsed', headers=admin_headers)
+    assert collapsed.status_code == 200
+    assert (await seeded.get('/api/admin/profiles', headers=user_headers)).status_code == 403
+
+    async with server.profiling_lock:  # another profiled request is running
+        busy = await seeded.get('/api/skills', headers={**admin_headers, 'X-Profile': '1'})
+    assert busy.status_code == 409
+
+
+async def test_query_budget_is_enforced(seeded, user_headers, monkeypatch):
+    monkeypatch.setattr(server.get_skills, 'query_budget', 1)
+    with pytest.raises(server.QueryBudgetExceeded):
+        await seeded.get('/api/skills', headers=user_headers)
+
+
+def chunked(payload: bytes, size: int = 7):
+    async def chunks():
+        for start in range(0, len(payload), size):
+            yield payload[start:start + size]
+    return chunks()
+
+
+def skill_record(skill_id, prerequisites=(), **extra):
+    return {'id': skill_id, 'name': skill_id.title(), 'description': 'Imported', 'category': 'Imported',
+            'difficulty': 'beginner', 'prerequisites': list(prerequisites), 'xp_value': 100, 'icon': 'Code',
+            'position': {'x': 0, 'y': 0}, **extra}
+
+
+def lesson_record(lesson_id, skill_id, order=1):
+    return {'id': lesson_id, 'skill_id': skill_id, 'title': lesson_id, 'content': 'Text', 'order': order, 'estimated_time': 10}
+
+
+async def test_admin_import_streams_ndjson_and_reports_bad_records(seeded, admin_headers, user_headers):
+    records = [
+        lesson_record('imp-lesson-1', 'imp-b'),  # its skill arrives later
+        skill_record('imp-b', ['imp-a']),  # so does its prerequisite
+        skill_record('imp-a', ['skill-1']),
+        lesson_record('imp-lesson-2', 'imp-a'),
+        skill_record('imp-bad', ['nowhere']),
+        skill_record('skill-1', ['imp-b']),  # would close skill-1 -> imp-a -> imp-b -> skill-1
+        {'id': 'imp-invalid', 'name': 'No fields'},
+    ]
+    payload = b'\n'.join(json.dumps(r).encode() for r in records) + b'\n{not json\n'
+    headers = {**admin_headers, 'Content-Type': 'application/x-ndjson'}
+    assert (await seeded.post('/api/admin/import', content=payload, headers=user_headers)).status_code == 403
+
+    report = (await seeded.post('/api/admin/import', content=chunked(payload), headers=headers)).json()
+    assert (report['skills_upserted'], report['lessons_upserted']) == (2, 2)
+    errors = {error['record']: error for error in report['errors']}
+    assert report['error_count'] == len(errors) == 4
+    assert errors[5]['error'] == 'Unknown prerequisites: nowhere'
+    assert 'cycle' in errors[6]['error']
+    assert 'description' in errors[7]['error']
+    assert errors[8]['error'].startswith('Invalid JSON')
+
+    skill = (await seeded.get('/api/skills/imp-b', headers=user_headers)).json()
+    assert skill['prerequisites'] == ['imp-a']
+    lessons = (await seeded.get('/api/skills/imp-b/lessons', headers=user_headers)).json()
+    assert [lesson['id'] for lesson in lessons] == ['imp-lesson-1']
+    assert (await seeded.get('/api/skills/skill-1', headers=user_headers)).json()['prerequisites'] == []
+
+
+async def test_admin_import_accepts_a_json_array(client, admin_headers, user_headers):
+    records = [skill_record('imp-a')] + [lesson_record(f'imp-a-{n}', 'imp-a', n) for n in range(1, 4)]
+    headers = {**admin_headers, 'Content-Type': 'application/json'}
+    report = (await client.post('/api/admin/import', content=chunked(json.dumps(records).encode(), 5), headers=headers)).json()
+    assert report == {'skills_upserted': 1, 'lessons_upserted': 3, 'error_count': 0, 'errors': []}
+
+    truncated = json.dumps(records).encode()[:-10]
+    report = (await client.post('/api/admin/import', content=truncated, headers=headers)).json()
+    assert report['error_count'] == 1 and report['errors'][0]['error'] == 'Truncated JSON array'
+
+
+async def test_admin_import_json_array_resumes_after_a_bad_element(client, admin_headers, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'IMPORT_MAX_RECORD_BYTES', 400)
+    good = [json.dumps(skill_record(skill_id)) for skill_id in ('imp-a', 'imp-b', 'imp-c')]
+    elements = [good[0], '{"id": "x",, }', '{"id": "y", "tags": [1}', good[1],
+                json.dumps(skill_record('imp-huge', description='x' * 1000)),
+                json.dumps(skill_record('imp-loop-1', ['imp-loop-2'])), json.dumps(skill_record('imp-loop-2', ['imp-loop-1'])),
+                good[2]]
+    headers = {**admin_headers, 'Content-Type': 'application/json'}
+    payload = ('[' + ', '.join(elements) + ']').encode()
+    report = (await client.post('/api/admin/import', content=chunked(payload, 64), headers=headers)).json()
+    assert report['skills_upserted'] == 3
+    errors = {error['record']: error['error'] for error in report['errors']}
+    assert errors[2].startswith('Invalid JSON') and errors[3] == 'Invalid JSON: unbalanced brackets'
+    assert errors[5] == 'Record is larger than 400 bytes'
+    assert errors[6] == errors[7] == 'Prerequisites would form a cycle'
+    assert report['error_count'] == 5
+    assert (await client.get('/api/skills/imp-c', headers=user_headers)).status_code == 200
+
+
+async def test_admin_import_ndjson_skips_an_oversized_line(client, admin_headers, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'IMPORT_MAX_RECORD_BYTES', 400)
+    lines = [json.dumps(skill_record('imp-a')), json.dumps(skill_record('imp-huge', description='x' * 5000)),
+             json.dumps(skill_record('imp-b')), '{"id": "imp-tail", "description": "' + 'y' * 1000]
+    headers = {**admin_headers, 'Content-Type': 'application/x-ndjson'}
+    report = (await client.post('/api/admin/import', content=chunked('\n'.join(lines).encode(), 64), headers=headers)).json()
+    assert report['skills_upserted'] == 2
+    assert report['errors'] == [
+        {'record': 2, 'id': None, 'error': 'Record is larger than 400 bytes'},
+        {'record': 4, 'id': None, 'error': 'Record is larger than 400 bytes'},
+    ]
+    assert (await client.get('/api/skills/imp-b', headers=user_headers)).status_code == 200
+
+
+async def test_admin_import_rechecks_its_batch_against_graph_writes_made_meanwhile(seeded, database):
+    job = server.CatalogImport(database)
+    await job.load_graph()
+    await job.add(1, skill_record('skill-7', ['skill-3']))
+    await job.add(2, skill_record('imp-a', ['skill-2']))
+    await job.add(3, lesson_record('imp-lesson', 'imp-a'))
+    await job.add(4, skill_record('imp-b'))
+
+    # Another worker, between two of this import's batches
+    await database.skills.update_one({'id': 'skill-1'}, {'$set': {'prerequisites': ['skill-7']}})
+    await database.skills.update_one({'id': 'skill-2'}, {'$set': {'deleted': True}})
+    await database.counters.update_one({'_id': server.CATALOG_VERSION_ID}, {'$inc': {'seq': 1}})
+
+    report = await job.finish()
+    assert (report['skills_upserted'], report['lessons_upserted']) == (1, 0)
+    assert [(error['record'], error['error']) for error in report['errors']] == [
+        (1, 'Prerequisites would form a cycle'), (2, 'Unknown prerequisites: skill-2'), (3, 'Skill imp-a was not imported'),
+    ]
+    assert (await database.skills.find_one({'id': 'skill-7'}))['prerequisites'] == []
+
+
+async def test_leaderboard_ranks_and_incremental_updates(seeded, database, user_headers):
+    for user_id, xp in (('lb-a', 500), ('lb-b', 300), ('lb-c', 300), ('lb-d', 100)):
+        await support.create_user(database, user_id)
+        await database.users.update_one({'id': user_id}, {'$set': {'xp': xp, 'category_xp': {'Data Science': xp}}})
+
+    board = (await seeded.get('/api/leaderboard', headers=user_headers)).json()
+    assert [(e['user_id'], e['rank']) for e in board['top']] == [('lb-a', 1), ('lb-b', 2), ('lb-c', 2), ('lb-d', 4)]
+    assert board['me']['rank'] is None and board['above'] == []
+    reconciled_at = server.leaderboards[None].reconciled_at
+
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    board = (await seeded.get('/api/leaderboard?neighbors=2', headers=user_headers)).json()
+    assert server.leaderboards[None].reconciled_at == reconciled_at
+    assert [(e['user_id'], e['rank']) for e in board['top']][-2:] == [('lb-d', 4), ('user-1', 4)]
+    assert (board['me']['rank'], board['me']['xp'], board['ranked_users']) == (4, 100, 5)
+    assert [e['user_id'] for e in board['above']] == ['lb-c', 'lb-d'] and board['below'] == []
+
+    board = (await seeded.get('/api/leaderboard?category=Web Development', headers=user_headers)).json()
+    assert [(e['user_id'], e['rank']) for e in board['top']] == [('user-1', 1)]
+    board = (await seeded.get('/api/leaderboard?category=Data Science&limit=1', headers=user_headers)).json()
+    assert [e['user_id'] for e in board['top']] == ['lb-a'] and board['me']['rank'] is None
+    assert (await seeded.get('/api/leaderboard?category=Nope', headers=user_headers)).status_code == 404
+
+
+async def test_category_xp_backfill_leaves_xp_alone(seeded, database, user_headers):
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-7/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-7/complete', headers=user_headers)
+    legacy = {'$unset': {'category_xp': '', 'category_xp_backfilled': ''}, '$set': {'xp': 1234, 'level': 2}}
+    await database.users.update_one({'id': 'user-1'}, legacy)
+    # A legacy user completing a skill before the backfill reaches them
+    await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    assert (await database.users.find_one({'id': 'user-1'}))['category_xp'] == {'Web Development': 100}
+
+    await server.backfill_category_xp()
+    user = await database.users.find_one({'id': 'user-1'})
+    assert (user['xp'], user['level'], user['category_xp']) == (1334, 2, {'Web Development': 100, 'Backend': 200})
+    await server.backfill_category_xp()  # nothing left to do
+
+
+async def test_concurrent_completions_each_award_their_xp(seeded, database, user_headers):
+    for skill_id in ('skill-1', 'skill-7'):
+        await seeded.post(f'/api/user-skills/{skill_id}/start', headers=user_headers)
+    await database.users.update_one({'id': 'user-1'}, {'$set': {'xp': 900}})
+    responses = await asyncio.gather(*(seeded.post(f'/api/user-skills/{skill_id}/complete', headers=user_headers) for skill_id in ('skill-1', 'skill-7')))
+    totals = sorted(response.json()['total_xp'] for response in responses)
+    assert totals[0] in (1000, 1100) and totals[1] == 1200
+    user = await database.users.find_one({'id': 'user-1'})
+    assert (user['xp'], user['level']) == (1200, 2)
+
+
+def test_leaderboard_structures():
+    histogram = server.XpHistogram({100: 2, 300: 1})
+    histogram.add(5000)
+    histogram.add(100, -1)
+    assert [histogram.count_above(score) for score in (0, 100, 300, 4999, 5000)] == [3, 2, 1, 1, 0]
+
+    top = server.TopEntries(capacity=2)
+    top.reset([{'user_id': 'a', 'xp': 30}, {'user_id': 'b', 'xp': 20}], complete=False)
+    top.update({'user_id': 'c', 'xp': 10})  # not known to beat anyone outside the list
+    assert [e['user_id'] for e in top.first(5)] == ['a', 'b']
+    top.update({'user_id': 'c', 'xp': 25})
+    assert [e['user_id'] for e in top.first(5)] == ['a', 'c']
+    top.update({'user_id': 'a', 'xp': 5})  # falls out; c is still exactly first
+    assert [e['user_id'] for e in top.first(5)] == ['c']
+
+
+async def search(client, headers, query, **params):
+    response = await client.get('/api/search', params={'q': query, **params}, headers=headers)
+    assert response.status_code == 200
+    return [(hit['type'], hit['id']) for hit in response.json()['results']]
+
+
+async def test_search_ranks_skills_and_lessons(seeded, user_headers):
+    assert (await seeded.get('/api/search?q=html')).status_code == 401
+    assert (await search(seeded, user_headers, 'html'))[0] == ('skill', 'skill-1')
+    assert (await search(seeded, user_headers, 'box model', type='lesson'))[0] == ('lesson', 'lesson-2-3')
+    assert (await search(seeded, user_headers, 'javasc'))[0] == ('skill', 'skill-3')
+    assert await search(seeded, user_headers, 'javasc', prefix='false') == []
+    assert await search(seeded, user_headers, 'the') == []
+
+
+async def test_search_follows_admin_writes(seeded, admin_headers, user_headers):
+    assert ('lesson', 'lesson-2-3') in await search(seeded, user_headers, 'box model')
+    await seeded.delete('/api/admin/lessons/lesson-2-3', headers=admin_headers)
+    assert ('lesson', 'lesson-2-3') not in await search(seeded, user_headers, 'box model')
+
+    await seeded.delete('/api/admin/skills/skill-1', headers=admin_headers)
+    assert [hit for hit in await search(seeded, user_headers, 'html') if hit[1].startswith(('skill-1', 'lesson-1-'))] == []
+
+    body = {'new_skill_name': 'Rust', 'new_skill_category': 'Systems', 'topic': 'Ownership', 'difficulty': 'beginner',
+            'xp_points': 100, 'lesson_count': 2, 'learning_objective': 'Borrowing'}
+    skill_id = (await seeded.post('/api/admin/lessons/generate', json=body, headers=admin_headers)).json()['skill_id']
+    hits = await search(seeded, user_headers, 'ownership', type='lesson')
+    assert len(hits) == 2
+    assert await search(seeded, user_headers, 'rust') == [('skill', skill_id)]
+
+
+def test_search_index_compacts_removed_documents():
+    index = server.SearchIndex()
+    for n in range(3000):
+        index.add_lesson({'id': f'l{n}', 'skill_id': 's', 'title': f'topic{n % 7}', 'content': 'shared words'}, bulk=True)
+    index.finish_bulk()
+    for n in range(2000):
+        index.remove('lesson', f'l{n}')
+    assert index.dead < 1000 and index.live_count == 1000
+    hits = index.search('topic3', limit=1000, prefix=False)
+    assert sorted(int(hit['id'][1:]) for hit in hits) == [n for n in range(2000, 3000) if n % 7 == 3]
+
+
+async def test_skills_are_served_with_a_layered_layout(seeded, user_headers):
+    skills = (await seeded.get('/api/skills', headers=user_headers)).json()
+    layout = {skill['id']: skill['position'] for skill in skills}
+    assert len({(p['x'], p['y']) for p in layout.values()}) == len(skills)
+    for skill in skills:
+        assert all(layout[p]['y'] < layout[skill['id']]['y'] for p in skill['prerequisites'])
+
+
+def test_layout_reduces_crossings_and_survives_cycles():
+    docs = support.synthetic_skill_docs(2000)
+    docs[0]['prerequisites'] = [docs[-1]['id']]  # closes a cycle
+    positions, stats = server.layered_layout([server.Skill(**doc) for doc in docs])
+    assert len(positions) == len(docs)
+    assert stats['crossings'] <= stats['initial_crossings']
+    assert server.count_crossings(*map(server.np.array, ([0, 0, 1, 1], [0, 1, 1, 0], [0, 1], [2, 3]))) == 1
+
+
+async def test_prerequisite_edits_are_validated(seeded, admin_headers, user_headers):
+    async def set_prerequisites(skill_id, prerequisites):
+        return await seeded.put(f'/api/admin/skills/{skill_id}/prerequisites', json={'prerequisites': prerequisites}, headers=admin_headers)
+
+    assert (await set_prerequisites('skill-1', ['skill-3'])).json()['detail'] == 'Prerequisites would form a cycle'
+    assert (await set_prerequisites('skill-1', ['skill-1'])).status_code == 400
+    assert (await set_prerequisites('skill-1', ['nope'])).json()['detail'] == 'Unknown prerequisites: nope'
+    assert (await set_prerequisites('nope', [])).status_code == 404
+    assert (await skill_statuses(seeded, user_headers))['skill-2'] == 'locked'
+    assert (await set_prerequisites('skill-2', [])).status_code == 200
+    assert (await skill_statuses(seeded, user_headers))['skill-2'] == 'available'
+
+    report = (await seeded.get('/api/admin/catalog/graph', headers=admin_headers)).json()
+    assert report['missing_prerequisites'] == {} and report['cycles'] == []
+
+
+async def test_prerequisite_edits_wait_for_another_workers_graph_write(seeded, database, admin_headers):
+    await server.get_catalog()  # this worker's snapshot predates the other write
+    lease = {'writer': 'other-worker', 'writer_until': time.time() + 60}
+    await database.counters.update_one({'_id': server.CATALOG_VERSION_ID}, {'$set': lease})
+    edit = asyncio.create_task(seeded.put('/api/admin/skills/skill-7/prerequisites', json={'prerequisites': ['skill-3']}, headers=admin_headers))
+    await asyncio.sleep(0.2)
+    assert not edit.done()
+
+    # The other worker makes skill-7 a prerequisite of skill-1, then lets go
+    await database.skills.update_one({'id': 'skill-1'}, {'$set': {'prerequisites': ['skill-7']}})
+    await database.counters.update_one({'_id': server.CATALOG_VERSION_ID}, {'$inc': {'seq': 1}, '$unset': {'writer': '', 'writer_until': ''}})
+    response = await edit
+    assert response.status_code == 400 and response.json()['detail'] == 'Prerequisites would form a cycle'
+    assert 'writer' not in await database.counters.find_one({'_id': server.CATALOG_VERSION_ID})
+
+
+async def test_unlock_path_and_remaining_prerequisites(seeded, user_headers):
+    path = (await seeded.get('/api/skills/skill-6/unlock-path', headers=user_headers)).json()['path']
+    assert [skill['id'] for skill in path] == ['skill-1', 'skill-3', 'skill-5', 'skill-6']
+
+    async def remaining(skill_id):
+        response = await seeded.get(f'/api/skills/{skill_id}/remaining-prerequisites', headers=user_headers)
+        return [skill['id'] for skill in response.json()['remaining']]
+
+    assert await remaining('skill-6') == ['skill-1', 'skill-3', 'skill-5']
+    for skill_id in ('skill-1', 'skill-3'):
+        await seeded.post(f'/api/user-skills/{skill_id}/start', headers=user_headers)
+        await seeded.post(f'/api/user-skills/{skill_id}/complete', headers=user_headers)
+    assert await remaining('skill-6') == ['skill-5']
+    assert await remaining('skill-1') == []
+    assert (await seeded.get('/api/skills/nope/unlock-path', headers=user_headers)).status_code == 404
+
+
+def test_prerequisite_graph_closure_and_cycles():
+    def skill(skill_id, *prerequisites):
+        return server.Skill(id=skill_id, name=skill_id, description='', category='c', difficulty='beginner',
+                            prerequisites=list(prerequisites), xp_value=10, icon='', position={'x': 0, 'y': 0})
+
+    graph = server.PrerequisiteGraph([
+        skill('d', 'b', 'c'), skill('b', 'a'), skill('c', 'a'), skill('a'),
+        skill('x', 'y', 'ghost'), skill('y', 'x'), skill('z', 'y'),
+    ])
+    assert graph.ancestors_of('d')[0] == 'a' and sorted(graph.ancestors_of('d')) == ['a', 'b', 'c']
+    assert sorted(graph.unlocks('a')) == ['b', 'c', 'd']
+    assert graph.depends_on('d', 'a') and not graph.depends_on('a', 'd')
+    assert graph.creates_cycle('a', ['d']) and not graph.creates_cycle('d', ['a'])
+    assert graph.remaining('d', {'b'}) == ['a', 'c']
+    assert graph.missing == {'x': ['ghost']}
+    assert [sorted(cycle) for cycle in graph.cycles] == [['x', 'y']]
+    assert set(graph.ancestors_of('z')) == {'x', 'y'}
+
+    rng = random.Random(3)
+    ids = [f's{n}' for n in range(200)]
+    edges = {skill_id: rng.sample(ids[:n] if n % 40 else ids, min(n, 3)) for n, skill_id in enumerate(ids)}
+    graph = server.PrerequisiteGraph([skill(skill_id, *edges[skill_id]) for skill_id in ids])
+
+    def closure(skill_id):
+        seen, stack = set(), list(edges[skill_id])
+        while stack:
+            node = stack.pop()
+            if node not in seen:
+                seen.add(node)
+                stack.extend(edges[node])
+        return seen
+
+    for skill_id in rng.sample(ids, 40):
+        ancestors = closure(skill_id)
+        assert set(graph.ancestors_of(skill_id)) == ancestors
+        assert all(graph.depends_on(skill_id, other) == (other in ancestors) for other in rng.sample(ids, 20))
+        assert set(graph.unlocks(skill_id)) == {other for other in ids if skill_id in closure(other)}
+    assert {skill_id for cycle in graph.cycles for skill_id in cycle} == {s for s in ids if s in closure(s)}
+
+
+async def test_skills_viewport_returns_visible_nodes_edges_and_clusters(seeded, user_headers):
+    async def viewport(box, **params):
+        bounds = dict(zip(('min_x', 'min_y', 'max_x', 'max_y'), box))
+        response = await seeded.get('/api/skills', params={**bounds, **params}, headers=user_headers)
+        assert response.status_code == 200
+        server.SkillViewport.model_validate(response.json())  # the shape the OpenAPI schema documents
+        return response.json()
+
+    # Boxes are in layout coordinates: x is the slot within a layer, y the layer
+    view = await viewport((2, 0, 3, 1))
+    assert [skill['id'] for skill in view['skills']] == ['skill-1', 'skill-2', 'skill-3']
+    assert view['skills'][0]['user_status'] == 'available' and view['clusters'] == []
+    assert view['skills'][2]['position'] == {'x': 3, 'y': 1}
+    assert {(e['from'], e['to']) for e in view['edges']} == {
+        ('skill-1', 'skill-2'), ('skill-1', 'skill-3'), ('skill-2', 'skill-4'), ('skill-3', 'skill-5'),
+    }
+
+    view = await viewport((0.3, 3.3, 0.7, 3.7))  # empty, but an edge passes through
+    assert view['skills'] == [] and [(e['from'], e['to'], e['path']) for e in view['edges']] == [('skill-6', 'skill-20', [[1, 3], [0, 4]])]
+
+    view = await viewport((2, 0, 3, 1), zoom=3)
+    assert view['skills'] == [] and len(view['clusters']) == 1
+    cluster = view['clusters'][0]
+    assert cluster['count'] == 3 and cluster['statuses'] == {'available': 1, 'locked': 2}
+    assert sorted(e['to'] for e in view['edges'] if e['from'] == cluster['id']) == ['skill-4', 'skill-5']
+
+    assert sorted(c['count'] for c in (await viewport((-2, 0, 3, 4), zoom=0))['clusters']) == [6, 14]
+    assert (await viewport((-2, 0, 3, 4), zoom=-1000))['clusters'] == (await viewport((-2, 0, 3, 4), zoom=0))['clusters']
+    huge = await viewport((-1e300, -1e300, 1e300, 1e300))
+    assert len(huge['skills']) == 20 and huge['clusters'] == []
+    assert (await viewport((100, 100, 1e300, 1e300)))['skills'] == []
+    assert (await seeded.get('/api/skills?min_x=0', headers=user_headers)).status_code == 400
+    for bad in ('inf', 'nan', '-inf'):
+        response = await seeded.get(f'/api/skills?min_x={bad}&min_y=0&max_x=1&max_y=1', headers=user_headers)
+        assert response.status_code == 400
+
+    schema = (await seeded.get('/openapi.json')).json()['paths']['/api/skills']['get']['responses']['200']
+    shapes = schema['content']['application/json']['schema']['anyOf']
+    assert {'$ref': '#/components/schemas/SkillViewport'} in shapes
+
+
+def test_skill_grid_matches_a_full_scan():
+    snapshot = server.CatalogSnapshot(1, support.synthetic_skill_docs(3000))
+    first = snapshot.skills[0]
+    far = first.model_copy(update={'id': 'far', 'prerequisites': [first.id], 'position': {'x': 10000, 'y': 10000}})
+    grid = server.SkillGrid(snapshot.skills + [far], cell=8)
+    assert len(grid.edges) - 1 in grid.long_edges  # far-reaching, so no cell holds it
+    rng = random.Random(5)
+    far_hits = 0
+    for n in range(60):
+        y = rng.uniform(-5, 60)
+        x = y - 1 if n % 3 == 0 else rng.uniform(-320, 320)  # every third box on the far edge's diagonal
+        box = (x, y, x + rng.uniform(0, 80), y + rng.uniform(0, 15))
+        visible, crossing = grid.query(box)
+        assert visible == [i for i, (px, py) in enumerate(grid.points) if box[0] <= px <= box[2] and box[1] <= py <= box[3]]
+        assert crossing == server.np.flatnonzero(server.segments_hit_box(grid.segments, box)).tolist()
+        far_hits += len(grid.edges) - 1 in crossing
+    assert far_hits >= 15
+    assert grid.query((-1e300, -1e300, 1e300, 1e300))[0] == list(range(len(grid.points)))
+    assert grid.query((20000, 0, 30000, 5)) == ([], [])
+
+
+async def test_public_catalog_and_status_overlay(seeded, user_headers):
+    response = await seeded.get('/api/catalog')
+    assert response.status_code == 200 and response.headers['cache-control'].startswith('public')
+    catalog = response.json()
+    assert 'user_status' not in catalog['skills'][0]
+    ids = [skill['id'] for skill in catalog['skills']]
+    assert ids == sorted(ids)  # the same order, and so the same hash, on every worker
+    assert (await seeded.get('/api/catalog', headers={'If-None-Match': response.headers['etag']})).status_code == 304
+    versioned = await seeded.get(f"/api/catalog/{catalog['version']}")
+    assert versioned.json() == catalog and 'immutable' in versioned.headers['cache-control']
+    stale = await seeded.get('/api/catalog/stale')
+    assert stale.status_code == 302 and stale.headers['location'].endswith(f"/api/catalog/{catalog['version']}")
+
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-2/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    await seeded.put('/api/user-skills/skill-2/progress', json={'progress_percent': 40}, headers=user_headers)
+
+    overlay = (await seeded.get('/api/skills/overlay', headers=user_headers)).json()
+    assert overlay['catalog_version'] == catalog['version']
+    codes = base64.b64decode(overlay['statuses'])
+    decoded = {skill['id']: overlay['status_codes'][code] for skill, code in zip(catalog['skills'], codes)}
+    assert decoded == await skill_statuses(seeded, user_headers)
+    index = [skill['id'] for skill in catalog['skills']].index('skill-2')
+    assert overlay['progress'] == {str(index): 40}
+
+
+async def test_status_overlay_agrees_with_skills_after_a_prerequisite_is_deleted(seeded, admin_headers, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'start_cascade', lambda job_id: None)  # seen before the cascade rewires dependents
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    assert (await seeded.delete('/api/admin/skills/skill-1', headers=admin_headers)).status_code == 200
+
+    statuses = await skill_statuses(seeded, user_headers)
+    assert 'skill-1' not in statuses and statuses['skill-2'] == statuses['skill-3'] == 'available'
+    catalog = (await seeded.get('/api/catalog')).json()
+    overlay = (await seeded.get('/api/skills/overlay', headers=user_headers)).json()
+    codes = base64.b64decode(overlay['statuses'])
+    assert {skill['id']: overlay['status_codes'][code] for skill, code in zip(catalog['skills'], codes)} == statuses
+
+
+def test_status_overlay_matches_per_skill_resolution():
+    docs = support.synthetic_skill_docs(3000)
+    docs[5]['prerequisites'] = docs[5]['prerequisites'] + ['ghost']  # unknown prerequisites are left out by both
+    snapshot = server.CatalogSnapshot(1, docs)
+    user_skill_map = {us['skill_id']: us for us in support.synthetic_user_skills(docs, 1500)}
+    statuses, _ = snapshot.status_overlay(user_skill_map)
+    assert [server.SKILL_STATUS_CODES[code] for code in statuses] == [
+        snapshot.skill_status(skill, user_skill_map)[0] for skill in snapshot.skills
+    ]
+
+
+async def test_sync_returns_changes_since_a_sequence_number(seeded, database, admin_headers, user_headers):
+    async def sync(headers, since, **params):
+        response = await seeded.get('/api/sync', params={'since': since, **params}, headers=headers)
+        assert response.status_code == 200
+        return response.json()
+
+    first = await sync(user_headers, 0, limit=15)
+    assert first['more'] and len(first['changes']) == 15 and first['changes'][0]['collection'] == 'skills'
+    cursor = first['seq']
+    while True:
+        page = await sync(user_headers, cursor)
+        cursor = page['seq']
+        if not page['more']:
+            break
+    assert (await sync(user_headers, cursor))['changes'] == []
+
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+    await seeded.delete('/api/admin/lessons/lesson-2-3', headers=admin_headers)
+    page = await sync(user_headers, cursor)
+    changes = {(c['collection'], c['id']): c for c in page['changes']}
+    assert [c['seq'] for c in page['changes']] == sorted(c['seq'] for c in page['changes'])
+    user_skill = next(c for c in page['changes'] if c['collection'] == 'user_skills')
+    assert user_skill['doc']['status'] == 'completed'  # started and completed collapse into one row
+    assert changes[('users', 'user-1')]['doc']['xp'] == 100
+    assert changes[('lessons', 'lesson-2-3')]['deleted'] and changes[('lessons', 'lesson-2-3')]['doc'] is None
+
+    other_headers = await support.create_user(database, 'user-2')
+    other = await sync(other_headers, cursor)
+    assert [(c['collection'], c['id']) for c in other['changes']] == [('lessons', 'lesson-2-3')]
+
+    # Another worker has taken numbers from page['seq'] + 1 but not written them yet
+    pending = {'floor': page['seq'] + 1, 'at': time.time()}
+    await database.counters.update_one({'_id': 'changes'}, {'$set': {'pending.elsewhere': pending}})
+    await seeded.post('/api/user-skills/skill-2/start', headers=user_headers)
+    held = await sync(user_headers, page['seq'])
+    assert held['changes'] == [] and held['seq'] == page['seq']
+    await database.counters.update_one({'_id': 'changes'}, {'$set': {'pending.elsewhere.at': time.time() - server.SYNC_PENDING_SECONDS - 1}})
+    assert [c['id'] for c in (await sync(user_headers, page['seq']))['changes'] if c['collection'] == 'user_skills']
+
+
+async def test_events_are_pushed_over_a_websocket(seeded, admin_headers, user_headers, fake_llm):
+    async with support.WebSocketSession('/api/events') as anonymous:
+        assert anonymous.opening == {'type': 'websocket.close', 'code': 4401, 'reason': ''}
+
+    token = user_headers['Authorization'].split(' ')[1]
+    async with support.WebSocketSession('/api/events', f'token={token}') as in_url:
+        assert in_url.opening['code'] == 4401  # tokens in URLs end up in access logs
+    async with support.WebSocketSession('/api/events', subprotocols=['bearer', token]) as socket:
+        assert socket.opening == {'type': 'websocket.accept', 'subprotocol': 'bearer', 'headers': []}
+        assert (await socket.receive_json())['type'] == 'ready'
+        await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+        await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+        events = [await socket.receive_json() for _ in range(4)]
+        assert [e['type'] for e in events] == ['skill_started', 'skill_completed', 'xp_changed', 'achievement_unlocked']
+        assert events[2]['xp'] == 100 and events[3]['achievement']['id'] == 'first_skill'
+        await seeded.post('/api/user-skills/skill-1/complete', headers=user_headers)
+        await seeded.post('/api/user-skills/skill-2/start', headers=user_headers)
+        events = [await socket.receive_json() for _ in range(3)]
+        assert [e['type'] for e in events] == ['skill_completed', 'xp_changed', 'skill_started']  # nothing newly unlocked
+
+    async with support.WebSocketSession('/api/events', headers=admin_headers) as socket:
+        await socket.receive_json()
+        body = {'skill_id': 'skill-1', 'topic': 'HTML', 'difficulty': 'beginner', 'xp_points': 100,
+                'lesson_count': 2, 'learning_objective': 'Tags'}
+        await seeded.post('/api/admin/lessons/generate', json=body, headers=admin_headers)
+        event = await socket.receive_json()
+        assert event['type'] == 'generation_finished' and event['skill_id'] == 'skill-1'
+    assert server.event_hub.subscribers == {}
+
+
+async def test_mongo_broker_knows_which_users_other_workers_serve(monkeypatch):
+    monkeypatch.setattr(server, 'event_hub', server.EventHub())
+    broker = server.MongoEventBroker()
+    assert not broker.has_listeners('u1')
+    broker.receive({'presence': {'add': ['u1', 'u2']}, 'origin': 'worker-b'})
+    broker.receive({'presence': {'remove': ['u2']}, 'origin': 'worker-b'})
+    assert broker.has_listeners('u1') and not broker.has_listeners('u2')
+    broker.receive({'presence': {'all': ['u3']}, 'origin': 'worker-b'})
+    assert broker.has_listeners('u3') and not broker.has_listeners('u1')
+    broker.remote['worker-b'] = (broker.remote['worker-b'][0], time.monotonic() - 3 * server.EVENT_PRESENCE_SECONDS - 1)
+    assert not broker.has_listeners('u3')  # that worker stopped announcing
+
+    queue = broker.subscribe('u4')
+    assert broker.has_listeners('u4') and broker.outbox.get_nowait()['presence'] == {'add': ['u4']}
+    broker.unsubscribe('u4', queue)
+    assert broker.outbox.get_nowait()['presence'] == {'remove': ['u4']}
+
+
+async def test_mongo_broker_tail_survives_a_failed_start(monkeypatch):
+    monkeypatch.setattr(server, 'event_hub', server.EventHub())
+    monkeypatch.setattr(server, 'EVENT_TAIL_RETRY_SECONDS', 0)
+    delivered = asyncio.Event()
+
+    class FlakyLog:
+        lookups = 0
+
+        async def find_one(self, *args, **kwargs):
+            FlakyLog.lookups += 1
+            if FlakyLog.lookups == 1:
+                raise AutoReconnect('primary stepped down')
+            return {'_id': 1}
+
+        def find(self, query, cursor_type=None):
+            assert query == {'_id': {'$gt': 1}}
+
+            async def docs():
+                yield {'_id': 2, 'origin': 'worker-b', 'presence': {'add': ['u1']}}
+                delivered.set()
+                await asyncio.sleep(60)
+            return docs()
+
+    monkeypatch.setattr(server, 'db', {'event_log': FlakyLog()})
+    broker = server.MongoEventBroker()
+    task = asyncio.create_task(broker.tail())
+    await asyncio.wait_for(delivered.wait(), 5)
+    task.cancel()
+    assert FlakyLog.lookups == 2 and broker.has_listeners('u1')
+
+
+def test_event_hub_replaces_a_backlog_with_resync():
+    hub = server.EventHub()
+    queue = hub.subscribe('u')
+    for n in range(server.EVENT_QUEUE_SIZE + 1):
+        hub.deliver('u', {'type': 'xp_changed', 'at': str(n)})
+    assert queue.qsize() == 1 and queue.get_nowait()['type'] == 'resync'
+    hub.unsubscribe('u', queue)
+    assert hub.subscribers == {}
+
+
+async def test_buffered_progress_is_coalesced_and_visible_before_the_flush(seeded, database, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'PROGRESS_BUFFER_SECONDS', 60)
+    for skill_id in ('skill-1', 'skill-11'):
+        await seeded.post(f'/api/user-skills/{skill_id}/start', headers=user_headers)
+
+    for percent in (10, 20, 30):
+        response = await seeded.put('/api/user-skills/skill-1/progress', json={'progress_percent': percent}, headers=user_headers)
+        assert response.status_code == 200
+    await seeded.put('/api/user-skills/skill-11/progress', json={'progress_percent': 50}, headers=user_headers)
+    assert (await seeded.put('/api/user-skills/skill-2/progress', json={'progress_percent': 5}, headers=user_headers)).status_code == 404
+
+    stored = await database.user_skills.find_one({'user_id': 'user-1', 'skill_id': 'skill-1'})
+    assert stored['progress_percent'] == 0
+    skills = {skill['id']: skill for skill in (await seeded.get('/api/skills', headers=user_headers)).json()}
+    assert skills['skill-1']['user_progress'] == 30 and skills['skill-11']['user_progress'] == 50
+
+    await seeded.post('/api/user-skills/skill-11/complete', headers=user_headers)  # drops its buffered 50
+    assert list(server.progress_buffer.pending) == [('user-1', 'skill-1')]
+    await server.progress_buffer.flush()
+    assert server.progress_buffer.pending == {}
+    progress = {us['skill_id']: us['progress_percent'] async for us in database.user_skills.find({'user_id': 'user-1'})}
+    assert progress == {'skill-1': 30, 'skill-11': 100}
+
+    await seeded.put('/api/user-skills/skill-1/progress', json={'progress_percent': 40}, headers=user_headers)
+    await database.user_skills.delete_one({'user_id': 'user-1', 'skill_id': 'skill-1'})  # as a deletion cascade would
+    assert (await seeded.put('/api/user-skills/skill-1/progress', json={'progress_percent': 50}, headers=user_headers)).status_code == 404
+
+
+async def test_progress_buffer_flushes_one_batch_at_a_time(seeded, database, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'PROGRESS_BUFFER_SECONDS', 60)
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.put('/api/user-skills/skill-1/progress', json={'progress_percent': 10}, headers=user_headers)
+    user_skill_id = (await database.user_skills.find_one({'skill_id': 'skill-1'}))['id']
+
+    release = asyncio.Event()
+    writes = []  # whether the first write had finished when each one started
+
+    class SlowSkills:
+        async def bulk_write(self, requests, ordered=True):
+            writes.append(release.is_set())
+            if len(writes) == 1:
+                await release.wait()
+            return await database.user_skills.bulk_write(requests, ordered=ordered)
+
+    class SlowDatabase:
+        user_skills = SlowSkills()
+
+        def __getattr__(self, name):
+            return getattr(database, name)
+
+    monkeypatch.setattr(server, 'db', SlowDatabase())
+    interval = asyncio.create_task(server.progress_buffer.flush())
+    await asyncio.sleep(0.05)
+    server.progress_buffer.add('user-1', 'skill-1', user_skill_id, 20)
+    threshold = asyncio.create_task(server.progress_buffer.flush())
+    await asyncio.sleep(0.05)
+    assert writes == [False]  # the newer batch waits for the older one
+    release.set()
+    await asyncio.gather(interval, threshold)
+    assert writes == [False, True]
+    assert (await database.user_skills.find_one({'skill_id': 'skill-1'}))['progress_percent'] == 20
+
+
+async def test_progress_buffer_stop_keeps_a_batch_whose_flush_was_cancelled(seeded, database, user_headers, monkeypatch):
+    monkeypatch.setattr(server, 'PROGRESS_BUFFER_SECONDS', 60)
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    await seeded.put('/api/user-skills/skill-1/progress', json={'progress_percent': 70}, headers=user_headers)
+
+    started = asyncio.Event()
+
+    class StalledSkills:
+        async def bulk_write(self, requests, ordered=True):
+            started.set()
+            await asyncio.sleep(60)
+
+    class StalledDatabase:
+        user_skills = StalledSkills()
+
+    monkeypatch.setattr(server, 'db', StalledDatabase())
+    flushing = asyncio.create_task(server.progress_buffer.flush())
+    await started.wait()
+    flushing.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await flushing
+    assert list(server.progress_buffer.pending) == [('user-1', 'skill-1')]
+
+    monkeypatch.setattr(server, 'db', database)
+    server.progress_buffer.start()
+    await server.progress_buffer.stop()
+    assert server.progress_buffer.task is None and server.progress_buffer.pending == {}
+    assert (await database.user_skills.find_one({'user_id': 'user-1', 'skill_id': 'skill-1'}))['progress_percent'] == 70
+
+
+async def test_idempotency_keys_replay_the_first_response(seeded, database, user_headers, admin_headers, fake_llm):
+    keyed = {**user_headers, 'Idempotency-Key': 'complete-1'}
+    await seeded.post('/api/user-skills/skill-1/start', headers=user_headers)
+    first = await seeded.post('/api/user-skills/skill-1/complete', headers=keyed)
+    server.idempotency_cache.clear()  # the stored copy serves other workers too
+    retry = await seeded.post('/api/user-skills/skill-1/complete', headers=keyed)
+    assert retry.json() == first.json() and retry.headers['idempotent-replayed'] == 'true'
+    assert (await database.users.find_one({'id': 'user-1'}))['xp'] == 100
+
+    reused = await seeded.post('/api/user-skills/skill-2/start', headers=keyed)
+    assert reused.status_code == 422
+    other_user = await support.create_user(database, 'user-2')
+    assert (await seeded.post('/api/user-skills/skill-1/start', headers={**other_user, 'Idempotency-Key': 'complete-1'})).status_code == 200
+
+    missing = {**user_headers, 'Idempotency-Key': 'missing'}
+    assert (await seeded.post('/api/user-skills/nope/start', headers=missing)).status_code == 404
+    assert (await seeded.post('/api/user-skills/nope/start', headers=missing)).headers['idempotent-replayed'] == 'true'
+
+    fake_llm.latency = 0.05
+    body = {'skill_id': 'skill-1', 'topic': 'HTML', 'difficulty': 'beginner', 'xp_points': 100,
+            'lesson_count': 2, 'learning_objective': 'Tags'}
+    generate = {**admin_headers, 'Idempotency-Key': 'generate-1'}
+    responses = await asyncio.gather(*[seeded.post('/api/admin/lessons/generate', json=body, headers=generate) for _ in range(3)])
+    assert len(fake_llm.calls) == 1
+    assert len({response.json()['lessons'][0]['id'] for response in responses}) == 1
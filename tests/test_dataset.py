@@ -0,0 +1,42 @@
+"""The synthetic dataset generator keeps the API's invariants and is reproducible."""
+from datetime import datetime, timezone
+
+import pytest
+
+from tests import dataset, support
+
+pytestmark = pytest.mark.anyio
+
+AS_OF = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+
+def options(*argv):
+    return dataset.build_parser().parse_args(['--skills', '80', '--users', '60', '--seed', '3', *argv])
+
+
+def test_generation_is_reproducible():
+    first = list(dataset.generate(options(), AS_OF))
+    assert first == list(dataset.generate(options(), AS_OF))
+    assert first != list(dataset.generate(options('--seed', '4'), AS_OF))
+
+
+async def test_loaded_dataset_is_consistent():
+    database = support.memory_database('skilltree_dataset')
+    counts = await dataset.load(database, dataset.generate(options(), AS_OF), batch_size=50, concurrency=3)
+    assert counts['skills'] == 80 and counts['users'] == 60
+    for collection, count in counts.items():
+        assert await database[collection].count_documents({}) == count
+
+    skills = {skill['id']: skill for skill in await database.skills.find({}, {'_id': 0}).to_list(None)}
+    order = {skill_id: int(skill_id.split('-')[1]) for skill_id in skills}
+    for skill in skills.values():
+        assert all(order[p] < order[skill['id']] for p in skill['prerequisites'])
+
+    for user in await database.users.find({}, {'_id': 0}).to_list(None):
+        user_skills = await database.user_skills.find({'user_id': user['id']}, {'_id': 0}).to_list(None)
+        completed = {us['skill_id'] for us in user_skills if us['status'] == 'completed'}
+        for user_skill in user_skills:
+            assert set(skills[user_skill['skill_id']]['prerequisites']) <= completed
+        assert user['xp'] == sum(skills[skill_id]['xp_value'] for skill_id in completed)
+        assert sum(user['category_xp'].values()) == user['xp']
+        assert user['level'] == 1 + user['xp'] // 1000
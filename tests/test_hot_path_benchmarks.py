@@ -0,0 +1,133 @@
+"""Micro-benchmarks for the CPU-bound pieces of server.py.
+
+Runs against synthetic catalogs of 20 to 50k skills and user histories of up
+to 10k user_skills, so that algorithmic regressions show up as step changes.
+Save a baseline and compare against it before deploying:
+
+    pytest tests/test_hot_path_benchmarks.py --benchmark-enable --benchmark-only --benchmark-autosave
+    pytest tests/test_hot_path_benchmarks.py --benchmark-enable --benchmark-only --benchmark-compare --benchmark-compare-fail=mean:25%
+"""
+import json
+
+import pytest
+
+import server
+from tests import support
+
+CATALOG_SIZES = [20, 1000, 50000]
+HISTORY_SIZES = [10, 1000, 10000]
+
+_catalogs = {}
+
+
+def catalog(size):
+    if size not in _catalogs:
+        _catalogs[size] = server.CatalogSnapshot(1, support.synthetic_skill_docs(size))
+    return _catalogs[size]
+
+
+def history(size, history_size):
+    snapshot = catalog(size)
+    docs = [skill.model_dump() for skill in snapshot.skills]
+    return support.synthetic_user_skills(docs, history_size)
+
+
+def llm_reply(lesson_count):
+    lessons = [
+        {'title': f'Lesson {i}', 'content': 'Explanation with "quoted" text and code.\n' * 20, 'estimated_time': 25, 'resources': []}
+        for i in range(lesson_count)
+    ]
+    return f"Here are your lessons:\n```json\n{json.dumps(lessons)}\n```\nEnjoy!"
+
+
+@pytest.mark.parametrize('size', CATALOG_SIZES)
+def test_bench_skill_status_resolution(benchmark, size):
+    snapshot = catalog(size)
+    user_skills = history(size, min(size, 10000) // 2)
+    user_skill_map = {us['skill_id']: us for us in user_skills}
+    benchmark(snapshot.render_skills, user_skill_map)
+
+
+@pytest.mark.parametrize('history_size', HISTORY_SIZES)
+def test_bench_achievements(benchmark, history_size):
+    snapshot = catalog(50000)
+    user_skills = history(50000, history_size)
+    user = {'id': 'user-1', 'xp': 12000, 'level': 13}
+    benchmark(server.build_achievements, user, user_skills, snapshot)
+
+
+@pytest.mark.parametrize('history_size', HISTORY_SIZES)
+def test_bench_dashboard_aggregation(benchmark, history_size):
+    snapshot = catalog(50000)
+    user_skills = history(50000, history_size)
+    user = {'id': 'user-1', 'xp': 12000, 'level': 13}
+
+    def dashboard():
+        return (
+            server.build_dashboard_stats(user, user_skills, snapshot),
+            server.build_achievements(user, user_skills, snapshot),
+            server.build_activity_feed(user_skills, snapshot),
+        )
+
+    benchmark(dashboard)
+
+
+def test_bench_decode_token(benchmark):
+    token = server.create_token('user-1')
+    assert benchmark(server.decode_token, token)['user_id'] == 'user-1'
+
+
+@pytest.mark.parametrize('lesson_count', [3, 20])
+def test_bench_generated_lessons_parse(benchmark, lesson_count):
+    reply = llm_reply(lesson_count)
+    lessons = benchmark(lambda: json.loads(server.extract_json_array(reply)))
+    assert len(lessons) == lesson_count
+
+
+def test_extract_json_array_variants():
+    body = '[{"title": "A"}]'
+    assert server.extract_json_array(f'```json\n{body}\n```') == body
+    assert server.extract_json_array(f'```\n{body}\n```') == body
+    assert server.extract_json_array(f'Sure! {body} Hope this helps.') == body
+
+
+@pytest.mark.parametrize('size', [1000, 10000])
+def test_bench_layered_layout(benchmark, size):
+    skills = catalog(size).skills
+    positions, stats = benchmark(server.layered_layout, skills)
+    assert len(positions) == size and stats['crossings'] <= stats['initial_crossings']
+
+
+@pytest.mark.parametrize('size', [1000, 10000, 50000])
+def test_bench_prerequisite_graph(benchmark, size):
+    skills = catalog(size).skills
+    graph = benchmark(server.PrerequisiteGraph, skills)
+    assert graph.cycles == [] and len(graph.ids) == size
+
+
+@pytest.mark.parametrize('size', [1000, 50000])
+def test_bench_prerequisite_queries(benchmark, size):
+    graph = catalog(size).graph
+    deepest = graph.ids[-1]
+
+    def queries():
+        return graph.ancestors_of(deepest), graph.creates_cycle(graph.ids[0], [deepest])
+
+    ancestors, cycle = benchmark(queries)
+    assert cycle == (graph.ids[0] in ancestors)
+
+
+@pytest.mark.parametrize('zoom', [0, server.SKILL_MAX_ZOOM])
+def test_bench_skill_viewport(benchmark, zoom):
+    snapshot = catalog(50000)
+    skills, clusters, edges = benchmark(snapshot.grid.viewport, (-20, 100, 20, 130), zoom, snapshot.skills, lambda skill: 'locked')
+    assert skills or clusters
+
+
+@pytest.mark.parametrize('size', CATALOG_SIZES)
+def test_bench_status_overlay(benchmark, size):
+    snapshot = catalog(size)
+    user_skills = history(size, min(size, 10000) // 2)
+    user_skill_map = {us['skill_id']: us for us in user_skills}
+    statuses, _ = benchmark(snapshot.status_overlay, user_skill_map)
+    assert len(statuses) == size
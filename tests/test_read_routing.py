@@ -0,0 +1,110 @@
+"""Read-preference routing per query class.
+
+The routing itself is checked against a real replica set when
+TEST_MONGO_REPLSET_URL is set. A local three-member one is enough:
+
+    for port in 27017 27018 27019; do
+        mkdir -p /tmp/rs/$port && mongod --replSet rs0 --port $port --dbpath /tmp/rs/$port --fork --logpath /tmp/rs/$port.log
+    done
+    mongosh --port 27017 --eval 'rs.initiate({_id: "rs0", members: [
+        {_id: 0, host: "localhost:27017"}, {_id: 1, host: "localhost:27018"}, {_id: 2, host: "localhost:27019"}]})'
+    TEST_MONGO_REPLSET_URL='mongodb://localhost:27017/?replicaSet=rs0' pytest tests/test_read_routing.py
+"""
+import os
+import time
+import uuid
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern, monitoring
+
+import server
+from tests import support
+
+pytestmark = pytest.mark.anyio
+
+REPLSET_URL = os.environ.get('TEST_MONGO_REPLSET_URL')
+
+
+def test_client_options_per_query_class(monkeypatch):
+    assert server.mongo_client_options('primary') == {'maxPoolSize': 100}
+    assert server.mongo_client_options('catalog') == {
+        'maxPoolSize': 50, 'readPreference': 'secondaryPreferred', 'maxStalenessSeconds': 90
+    }
+    monkeypatch.setenv('MONGO_CATALOG_POOL_SIZE', '4')
+    monkeypatch.setenv('MONGO_CATALOG_MAX_STALENESS', '120')
+    assert server.mongo_client_options('catalog') == {
+        'maxPoolSize': 4, 'readPreference': 'secondaryPreferred', 'maxStalenessSeconds': 120
+    }
+    monkeypatch.setenv('MONGO_CATALOG_READ_PREFERENCE', 'primary')
+    assert server.mongo_client_options('catalog') == {'maxPoolSize': 4, 'readPreference': 'primary'}
+
+
+def test_reader_stays_on_the_primary_until_our_writes_can_have_replicated(monkeypatch):
+    secondary = object()
+    monkeypatch.setattr(server, 'read_databases', {'catalog': secondary})
+    monkeypatch.setattr(server, 'read_staleness', {'catalog': 90})
+    monkeypatch.setattr(server, 'last_writes', {})
+    assert server.reader('catalog') is secondary
+    assert server.reader('leaderboard') is server.db  # not routed
+
+    server.observe_catalog_version({'epoch': 'another-worker', 'seq': 1})
+    assert server.reader('catalog') is server.db
+    server.last_writes['catalog'] = time.monotonic() - 91
+    assert server.reader('catalog') is secondary
+
+
+async def test_leaderboard_reconciles_against_the_primary(seeded, database, user_headers, monkeypatch):
+    lagging = support.memory_database()  # a secondary that has none of the users yet
+    monkeypatch.setattr(server, 'read_databases', {'catalog': lagging, 'analytics': lagging})
+    monkeypatch.setattr(server, 'read_staleness', {'catalog': 90, 'analytics': 90})
+    await database.users.update_one({'id': 'user-1'}, {'$set': {'xp': 500}})
+    board = (await seeded.get('/api/leaderboard', headers=user_headers)).json()
+    assert [entry['user_id'] for entry in board['top']] == ['user-1'] and board['me']['rank'] == 1
+
+
+async def test_catalog_rebuilds_read_the_primary(seeded, monkeypatch):
+    lagging = support.memory_database()  # a secondary that has none of the seeded skills yet
+    monkeypatch.setattr(server, 'read_databases', {'catalog': lagging})
+    monkeypatch.setattr(server, 'read_staleness', {'catalog': 90})
+    server.observe_catalog_version({'epoch': 'another-worker', 'seq': 1})
+    server.last_writes.clear()  # even once the window is over, or for a bump seen late
+    assert server.reader('catalog') is lagging
+    catalog = await server.get_catalog()
+    assert 'skill-1' in catalog.by_id
+
+
+class FindAddresses(monitoring.CommandListener):
+    def __init__(self):
+        self.addresses = []
+
+    def started(self, event):
+        if event.command_name == 'find':
+            self.addresses.append('%s:%d' % event.connection_id)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.mark.skipif(not REPLSET_URL, reason='needs TEST_MONGO_REPLSET_URL')
+async def test_catalog_reads_go_to_a_secondary():
+    listener = FindAddresses()
+    primary = AsyncIOMotorClient(REPLSET_URL)
+    catalog = AsyncIOMotorClient(REPLSET_URL, event_listeners=[listener], **server.mongo_client_options('catalog'))
+    name = f'skilltree_routing_{uuid.uuid4().hex[:8]}'
+    try:
+        hello = await primary.admin.command('hello')
+        assert len(hello['hosts']) >= 3, 'expected a three-member replica set'
+        skills = primary[name].get_collection('skills', write_concern=WriteConcern(w=len(hello['hosts'])))
+        await skills.insert_one({'id': 'skill-1'})
+
+        assert (await catalog[name].skills.find_one({'id': 'skill-1'}))['id'] == 'skill-1'
+        assert listener.addresses and hello['primary'] not in listener.addresses
+        assert set(listener.addresses) <= set(hello['hosts'])
+    finally:
+        await primary.drop_database(name)
+        primary.close()
+        catalog.close()
@@ -0,0 +1,125 @@
+"""Serialization CPU time for the /api/skills and lessons payloads.
+
+Compares the previous dict + jsonable_encoder + json.dumps path with the
+cached, pre-serialized catalog path. Run with:
+
+    pytest tests/test_serialization_benchmark.py --benchmark-enable --benchmark-only
+"""
+import copy
+import json
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+import server
+
+CATALOG_SIZE = 2000
+LESSONS_PER_SKILL = 40
+
+
+def make_skill_docs(count):
+    return [
+        {
+            'id': f'skill-{i}',
+            'name': f'Skill {i}',
+            'description': f'Learn everything about topic number {i}',
+            'category': f'Category {i % 12}',
+            'difficulty': ('beginner', 'intermediate', 'advanced')[i % 3],
+            'prerequisites': [f'skill-{i - 1}'] if i % 5 else [],
+            'xp_value': 100 + i % 500,
+            'icon': 'Code',
+            'position': {'x': i % 40, 'y': i // 40},
+        }
+        for i in range(count)
+    ]
+
+
+def make_lesson_docs(skill_id, count):
+    return [
+        {
+            'id': f'{skill_id}-lesson-{i}',
+            'skill_id': skill_id,
+            'title': f'Lesson {i}',
+            'content': 'Lesson body with examples and key takeaways.\n' * 60,
+            'order': i + 1,
+            'estimated_time': 20,
+            'resources': [{'title': 'MDN', 'url': 'https://developer.mozilla.org'}],
+        }
+        for i in range(count)
+    ]
+
+
+def dict_skills_payload(skill_docs, user_skill_map):
+    skills = copy.deepcopy(skill_docs)
+    for skill in skills:
+        if skill['id'] in user_skill_map:
+            skill['user_status'] = user_skill_map[skill['id']]['status']
+            skill['user_progress'] = user_skill_map[skill['id']]['progress_percent']
+        else:
+            prereqs_met = all(
+                user_skill_map.get(prereq_id, {}).get('status') == 'completed'
+                for prereq_id in skill['prerequisites']
+            )
+            skill['user_status'] = 'available' if prereqs_met else 'locked'
+            skill['user_progress'] = 0
+    return json.dumps(jsonable_encoder(skills)).encode()
+
+
+def dict_lessons_payload(lesson_docs, completed_ids):
+    lessons = copy.deepcopy(lesson_docs)
+    for lesson in lessons:
+        lesson['completed'] = lesson['id'] in completed_ids
+    return json.dumps(jsonable_encoder(lessons)).encode()
+
+
+@pytest.fixture(scope='module')
+def skill_docs():
+    return make_skill_docs(CATALOG_SIZE)
+
+
+@pytest.fixture(scope='module')
+def user_skill_map():
+    return {
+        f'skill-{i}': {'skill_id': f'skill-{i}', 'status': 'completed', 'progress_percent': 100}
+        for i in range(0, CATALOG_SIZE, 3)
+    }
+
+
+@pytest.fixture(scope='module')
+def lesson_docs():
+    return make_lesson_docs('skill-1', LESSONS_PER_SKILL)
+
+
+@pytest.fixture(scope='module')
+def cached_lessons(lesson_docs):
+    lessons = [server.Lesson.model_validate(doc) for doc in lesson_docs]
+    return [(lesson, server.Lesson.__pydantic_serializer__.to_json(lesson)) for lesson in lessons]
+
+
+def test_cached_skills_match_dict_path(skill_docs, user_skill_map):
+    snapshot = server.CatalogSnapshot(1, skill_docs)
+    laid_out = [{**doc, 'position': snapshot.positions[doc['id']]} for doc in skill_docs]
+    assert json.loads(snapshot.render_skills(user_skill_map)) == json.loads(dict_skills_payload(laid_out, user_skill_map))
+
+
+def test_cached_lessons_match_dict_path(lesson_docs, cached_lessons):
+    completed_ids = {lesson_docs[0]['id']}
+    rendered = server.CatalogSnapshot.render_lessons(cached_lessons, completed_ids)
+    assert json.loads(rendered) == json.loads(dict_lessons_payload(lesson_docs, completed_ids))
+
+
+def test_bench_skills_dict_path(benchmark, skill_docs, user_skill_map):
+    benchmark(dict_skills_payload, skill_docs, user_skill_map)
+
+
+def test_bench_skills_cached_catalog(benchmark, skill_docs, user_skill_map):
+    snapshot = server.CatalogSnapshot(1, skill_docs)
+    benchmark(snapshot.render_skills, user_skill_map)
+
+
+def test_bench_lessons_dict_path(benchmark, lesson_docs):
+    benchmark(dict_lessons_payload, lesson_docs, {lesson_docs[0]['id']})
+
+
+def test_bench_lessons_cached_catalog(benchmark, cached_lessons, lesson_docs):
+    benchmark(server.CatalogSnapshot.render_lessons, cached_lessons, {lesson_docs[0]['id']})